@@ -0,0 +1,96 @@
+import time
+import logging
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from server import app, llmHandlers, StreamedCompletion, sseHeaders, httpRequests, httpRequestSeconds, httpRequestsInFlight, tracer, callerOf, acceptsEventStream
+from llm_scheduler import currentCaller
+
+# Async serving mode: `python asgi_server.py` (or `uvicorn asgi_server:asgiApp`). The LLM routes run natively on the
+# event loop, so a request waiting for OpenAI does not hold a worker thread. Every other route is served by the Flask
+# app through a WSGI adapter.
+
+log = logging.getLogger("visar")
+
+
+def corsHeaders(request, preflight=False):
+    # the headers flask_cors adds to the responses of the Flask routes: the origin is reflected, and a preflight
+    # allows every method and the headers it asks for
+    origin = request.headers.get("origin")
+    headers = {"Access-Control-Allow-Origin": origin, "Vary": "Origin"} if origin else {"Access-Control-Allow-Origin": "*"}
+    if preflight:
+        headers["Access-Control-Allow-Methods"] = "DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+        requested = request.headers.get("access-control-request-headers")
+        if requested:
+            headers["Access-Control-Allow-Headers"] = ", ".join(name.strip() for name in requested.split(",") if name.strip())
+    return headers
+
+
+def finishRequestMetrics(route, method, status, start, trace):
+    httpRequestsInFlight.dec(route=route)
+    httpRequests.inc(route=route, method=method, status=status)
+    httpRequestSeconds.observe(time.perf_counter() - start, route=route, method=method)
+    tracer.finishTrace(trace, status=status)
+
+
+async def measuredEvents(events, route, method, start, trace):
+    try:
+        async for event in events:
+            yield event
+    finally:
+        finishRequestMetrics(route, method, 200, start, trace)
+
+
+def llmEndpoint(path, handler):
+    # the same request metrics as the Flask routes record (see startRequestMetrics in server.py)
+    async def endpoint(request):
+        start = time.perf_counter()
+        httpRequestsInFlight.inc(route=path)
+        trace = tracer.startTrace(path, force=request.headers.get("x-trace") == "1", method=request.method)
+        status = 500
+        try:
+            if request.method == "OPTIONS":
+                # CORS preflight, answered like flask_cors does for the Flask routes
+                status = 200
+                return Response(status_code=200, headers=corsHeaders(request, preflight=True))
+            try:
+                payload = await request.json()
+            except ValueError:
+                # like Flask, a body that is not JSON is a bad request
+                status = 400
+                return PlainTextResponse("Bad Request", status_code=400, headers=corsHeaders(request))
+            if acceptsEventStream(request.headers.get("accept")):
+                payload["stream"] = True
+            currentCaller.set(callerOf(payload, path, request.headers))
+            try:
+                result = await handler(payload)
+            except Exception:
+                # answered like the Flask app answers an unhandled exception, with the CORS headers so the browser
+                # lets the client see the status
+                log.exception("Exception on %s [%s]", path, request.method)
+                return PlainTextResponse("Internal Server Error", status_code=500, headers=corsHeaders(request))
+            if isinstance(result, StreamedCompletion):
+                status = None
+                return StreamingResponse(measuredEvents(result.events(), path, request.method, start, trace),
+                                         media_type="text/event-stream", headers={**sseHeaders, **corsHeaders(request)})
+            status = 200
+            with tracer.span("encodeResponse"):
+                return JSONResponse(result, headers=corsHeaders(request))
+        finally:
+            # a stream is measured when it ends
+            if status is not None:
+                finishRequestMetrics(path, request.method, status, start, trace)
+    return endpoint
+
+
+asgiApp = Starlette(routes=[
+    Route(path, llmEndpoint(path, handler), methods=["POST", "OPTIONS"]) for path, handler in llmHandlers.items()
+] + [
+    Mount("/", app=WSGIMiddleware(app)),
+])
+
+
+if __name__ == '__main__':
+    uvicorn.run(asgiApp, port=5000, host="127.0.0.1")
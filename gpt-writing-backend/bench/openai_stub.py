@@ -0,0 +1,137 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI chat completions API, for benchmarks that must not spend API money.
+# `python bench/openai_stub.py --stub-port 8001 --latency 0.4 --token-rate 50 --tokens 60`
+# Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8001/v1 (bench/run.py does this for you).
+
+# Every completion is a numbered list of "perspective: point" lines, which parses as keywords, discussion points and
+# paragraph text alike
+perspectives = ["Economy", "Safety", "Education", "Quality of life", "Job opportunity", "Population", "Location",
+                "Healthcare", "Transportation", "Culture"]
+filler = "the argument holds because the evidence shows a clear and measurable effect on the people involved".split()
+
+
+def completionText(tokens, seed):
+    rng = random.Random(seed)
+    lines = []
+    words = 0
+    while words < tokens:
+        line = [rng.choice(perspectives) + ":"] + rng.sample(filler, min(len(filler), 6 + rng.randrange(6)))
+        lines.append(f"{len(lines) + 1}. {' '.join(line)}")
+        words += len(line) + 1
+    return "\n".join(lines)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "OpenAIStub/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def sendJSON(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.sendJSON(404, {"error": {"message": f"{self.path} is not served by the stub", "type": "invalid_request_error"}})
+            return
+
+        config = self.server.config
+        with self.server.lock:
+            self.server.counters["requests"] += 1
+        if random.random() < config.error_rate:
+            # what a rate limited account sees
+            with self.server.lock:
+                self.server.counters["errors"] += 1
+            self.sendJSON(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}})
+            return
+
+        n = body.get("n", 1)
+        tokens = min(config.tokens, body.get("max_tokens", config.tokens))
+        promptTokens = sum(len(message.get("content", "")) for message in body.get("messages", [])) // 4
+        texts = [completionText(tokens, random.random()) for _ in range(n)]
+        latency = max(0.0, random.gauss(config.latency, config.latency * config.jitter))
+        time.sleep(latency)
+        created = int(time.time())
+        completionId = f"chatcmpl-stub{created}{random.randrange(10 ** 6)}"
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for word in texts[0].split(" "):
+                chunk = {"id": completionId, "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                self.writeChunk(f"data: {json.dumps(chunk)}\n\n")
+                time.sleep(1.0 / config.token_rate)
+            self.writeChunk("data: [DONE]\n\n")
+            self.writeChunk("")
+            return
+
+        # all choices are generated in parallel, like the real API
+        time.sleep(tokens / config.token_rate)
+        completionTokens = sum(len(text.split()) for text in texts)
+        self.sendJSON(200, {
+            "id": completionId,
+            "object": "chat.completion",
+            "created": created,
+            "model": body.get("model"),
+            "choices": [{"index": i, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"} for i, text in enumerate(texts)],
+            "usage": {"prompt_tokens": promptTokens, "completion_tokens": completionTokens, "total_tokens": promptTokens + completionTokens},
+        })
+
+    def writeChunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def startStub(config):
+    # start the stub on a background thread, returns the server (server.server_address has the port)
+    stub = ThreadingHTTPServer(("127.0.0.1", config.stub_port), StubHandler)
+    stub.daemon_threads = True
+    stub.config = config
+    stub.lock = threading.Lock()
+    stub.counters = {"requests": 0, "errors": 0}
+    threading.Thread(target=stub.serve_forever, name="OpenAIStub", daemon=True).start()
+    return stub
+
+
+def addStubArguments(parser):
+    parser.add_argument("--stub-port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.4, help="seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.2, help="standard deviation of the latency, relative to it")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="generated tokens per second")
+    parser.add_argument("--tokens", type=int, default=60, help="tokens per completion (capped by max_tokens)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI compatible stub for benchmarks")
+    addStubArguments(parser)
+    config = parser.parse_args(argv)
+    stub = startStub(config)
+    print(f"OpenAI stub listening on http://127.0.0.1:{stub.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
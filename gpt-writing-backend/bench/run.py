@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from openai_stub import startStub, addStubArguments
+
+# End-to-end benchmark of the backend without OpenAI or a MongoDB server:
+# `python bench/run.py --concurrency 32 --duration 60 --latency 0.4 --token-rate 50`
+# starts the OpenAI stub, starts the backend with bench/serve.py, drives a mix of routes from `--concurrency`
+# closed-loop clients and reports the latency percentiles and throughput of every route.
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+
+# share of the requests per route, like a class session: mostly autosaves and interaction logging
+defaultMix = "keyword=10,prompts=10,generateFromDepGraph=3,rewrite=5,saveDraft=22,logInteractionData=50"
+
+theses = [
+    "Houston is a good city to live in",
+    "Remote work is better than working in an office",
+    "Public transportation should be free",
+    "Social media does more harm than good to teenagers",
+    "Universities should not charge tuition",
+    "Artificial intelligence will create more jobs than it destroys",
+]
+
+
+class BenchUser:
+    # one closed-loop client, it keeps the state the real frontend keeps between requests
+
+    def __init__(self, index, distinctPrompts):
+        self.username = f"bench-{index}"
+        self.sessionId = 0
+        self.version = 0
+        self.saves = 0
+        self.distinctPrompts = distinctPrompts
+
+    def thesis(self):
+        # at most `distinctPrompts` different prompts, so repeated ones can hit the completion cache or be coalesced
+        return f"{random.choice(theses)} ({random.randrange(self.distinctPrompts)})"
+
+    def keyword(self):
+        return {"prompt": self.thesis()}
+
+    def prompts(self):
+        return {"keywords": random.sample(["Economy", "Safety", "Education", "Quality of life"], 3), "context": self.thesis()}
+
+    def rewrite(self):
+        return {"mode": "alternative", "basePrompt": "", "curSent": self.thesis()}
+
+    def generateFromDepGraph(self):
+        graph = {"root": {"type": "root", "prompt": self.thesis(), "text": self.thesis(), "children": [], "parent": None,
+                          "isImplemented": True, "needsUpdate": False}}
+        for k in range(2):
+            keyword = f"k{k}"
+            graph[keyword] = {"type": "featuredBy", "prompt": random.choice(["Economy", "Safety", "Education"]), "children": [],
+                              "parent": "root", "isImplemented": False, "needsUpdate": False}
+            graph["root"]["children"].append(keyword)
+            for d in range(2):
+                point = f"{keyword}d{d}"
+                graph[point] = {"type": random.choice(["elaboratedBy", "supportedBy", "attackedBy"]), "prompt": self.thesis(),
+                                "children": [], "parent": keyword, "isImplemented": False, "needsUpdate": False}
+                graph[keyword]["children"].append(point)
+        return {"dependencyGraph": graph, "rootKeys": ["root"]}
+
+    def saveDraft(self):
+        self.saves += 1
+        editorState = json.dumps({"root": {"children": [{"text": self.thesis()} for _ in range(20)]}, "save": self.saves})
+        return {"username": self.username, "sessionId": self.sessionId, "condition": "1", "baseVersion": self.version,
+                "sections": {"draft": f"draft {self.saves}", "editorState": editorState}}
+
+    def logInteractionData(self):
+        return {"username": self.username, "sessionId": self.sessionId, "type": random.choice(["click", "keyup", "select"]),
+                "interactionData": {"target": "editor", "time": time.time()}}
+
+    def handle(self, route, status, body):
+        if route == "saveDraft" and body is not None and "version" in body:
+            self.version = body["version"]
+
+
+def post(target, route, payload, timeout):
+    request = urllib.request.Request(f"{target}/{route}", data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as e:
+        body = e.read()
+        try:
+            return e.code, json.loads(body)
+        except ValueError:
+            return e.code, None
+
+
+def percentile(samples, p):
+    # nearest rank on sorted samples
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def parseMix(mix):
+    routes = {}
+    for entry in mix.split(","):
+        route, weight = entry.split("=")
+        routes[route.strip()] = float(weight)
+    return routes
+
+
+def drive(target, mix, concurrency, duration, distinctPrompts, think, timeout):
+    users = [BenchUser(index, distinctPrompts) for index in range(concurrency)]
+    for user in users:
+        post(target, "signup", {"username": user.username, "condition": "1"}, timeout)
+
+    routes = list(mix.keys())
+    weights = list(mix.values())
+    results = {route: {"latencies": [], "errors": 0, "statuses": {}} for route in routes}
+    lock = threading.Lock()
+    stopAt = time.time() + duration
+
+    def run(user):
+        while time.time() < stopAt:
+            route = random.choices(routes, weights)[0]
+            payload = getattr(user, route)()
+            start = time.perf_counter()
+            try:
+                status, body = post(target, route, payload, timeout)
+            except Exception:
+                status, body = "exception", None
+            elapsed = time.perf_counter() - start
+            user.handle(route, status, body)
+            with lock:
+                record = results[route]
+                record["statuses"][str(status)] = record["statuses"].get(str(status), 0) + 1
+                # a 409 of /saveDraft is a normal answer of the versioned protocol
+                if status == 200 or (route == "saveDraft" and status == 409):
+                    record["latencies"].append(elapsed)
+                else:
+                    record["errors"] += 1
+            if think > 0:
+                time.sleep(random.expovariate(1.0 / think))
+
+    started = time.time()
+    threads = [threading.Thread(target=run, args=(user,), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    report = {}
+    for route, record in results.items():
+        latencies = sorted(record["latencies"])
+        report[route] = {
+            "requests": len(latencies) + record["errors"],
+            "errors": record["errors"],
+            "rps": len(latencies) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "statuses": record["statuses"],
+        }
+    return report, elapsed
+
+
+def printReport(report, elapsed):
+    print(f"{'route':<22}{'requests':>10}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, row in report.items():
+        values = ["-" if row[p] is None else f"{row[p] * 1000:.1f}" for p in ("p50", "p95", "p99")]
+        print(f"{route:<22}{row['requests']:>10}{row['errors']:>8}{row['rps']:>9.2f}{values[0]:>10}{values[1]:>10}{values[2]:>10}")
+    total = sum(row["requests"] - row["errors"] for row in report.values())
+    print(f"{'total':<22}{sum(row['requests'] for row in report.values()):>10}{sum(row['errors'] for row in report.values()):>8}{total / elapsed:>9.2f}")
+
+
+def waitForServer(target, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError("The backend exited during startup, see its log")
+        try:
+            with urllib.request.urlopen(f"{target}/stats", timeout=1):
+                return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f"The backend did not answer on {target} within {timeout}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the VISAR backend")
+    parser.add_argument("--target", help="benchmark an already running backend at this URL instead of starting one")
+    parser.add_argument("--mode", choices=["flask", "asgi"], default="flask")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--mongo", default="memory", help='"memory" or a MongoDB connection string of a scratch database')
+    parser.add_argument("--completion-cache", action="store_true")
+    parser.add_argument("--replay", help="replay the completions of this fixture file (recorded with llmMode = \"record\") instead of using the stub")
+    parser.add_argument("--replay-timing", choices=["observed", "instant"], default="observed")
+    parser.add_argument("--server-log", default="bench-server.log", help="where the output of the backend goes")
+    parser.add_argument("--mix", default=defaultMix, help="route=weight,... of the requests")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--think", type=float, default=0.0, help="mean seconds a client waits between requests")
+    parser.add_argument("--distinct-prompts", type=int, default=1000000, help="number of different prompts per thesis")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", help="also write the report to this file")
+    addStubArguments(parser)
+    args = parser.parse_args(argv)
+
+    stub = None
+    process = None
+    target = args.target
+    if target is None:
+        stub = startStub(args)
+        target = f"http://127.0.0.1:{args.port}"
+        command = [sys.executable, os.path.join(benchDir, "serve.py"), "--port", str(args.port), "--mode", args.mode,
+                   "--mongo", args.mongo, "--openai-url", f"http://127.0.0.1:{stub.server_address[1]}/v1"]
+        if args.completion_cache:
+            command.append("--completion-cache")
+        if args.replay:
+            command.extend(["--replay", args.replay, "--replay-timing", args.replay_timing])
+        log = open(args.server_log, "w")
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+    try:
+        waitForServer(target, process)
+        report, elapsed = drive(target, parseMix(args.mix), args.concurrency, args.duration, args.distinct_prompts,
+                                args.think, args.timeout)
+        with urllib.request.urlopen(f"{target}/stats", timeout=10) as response:
+            serverStats = json.loads(response.read())
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(30)
+
+    printReport(report, elapsed)
+    if stub is not None:
+        print(f"OpenAI stub: {stub.counters['requests']} requests, {stub.counters['errors']} answered with 429")
+    if "llm" in serverStats:
+        # time spent waiting for the client-side budgets of the gateway shows up in the latencies of the LLM routes
+        llm = serverStats["llm"]
+        print(f"LLM gateway: {llm['calls']} calls, {llm['retries']} retries, {llm['queuedSeconds']:.1f}s queued by the request and token budgets")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"config": vars(args), "elapsed": elapsed, "routes": report, "server": serverStats}, output, indent=2, default=str)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
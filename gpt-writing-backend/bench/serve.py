@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+# Starts the backend for a benchmark: in a scratch working directory (key files, completion cache), against the
+# OpenAI stub, and against a local MongoDB or an in-memory one (`--mongo memory`). The in-memory one needs the
+# mongomock package, a benchmark-only dependency that is not in requirements.txt.
+# bench/run.py starts this as a subprocess, it can also be run by hand:
+# `python bench/serve.py --port 5001 --openai-url http://127.0.0.1:8001/v1 --mongo memory`
+
+backendDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the backend for a benchmark")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--mode", choices=["flask", "asgi"], default="flask", help="serve with the threaded Flask server or with uvicorn")
+    parser.add_argument("--openai-url", default="http://127.0.0.1:8001/v1")
+    parser.add_argument("--mongo", default="memory", help='"memory" or a MongoDB connection string, e.g. mongodb://127.0.0.1:27017')
+    parser.add_argument("--completion-cache", action="store_true", help="keep the completion and similarity caches enabled, off by default so every request reaches the stub")
+    parser.add_argument("--replay", help="serve the completions recorded in this fixture file instead of calling the stub (see llm_replay.py)")
+    parser.add_argument("--replay-timing", choices=["observed", "instant"], default="observed")
+    args = parser.parse_args(argv)
+    replayPath = os.path.abspath(args.replay) if args.replay else None
+
+    workDir = tempfile.mkdtemp(prefix="visar-bench-")
+    with open(os.path.join(workDir, "openai_key.json"), "w") as key_file:
+        json.dump({"key": "bench"}, key_file)
+    with open(os.path.join(workDir, "mongoDB_key.json"), "w") as key_file:
+        json.dump({"key": "mongodb://127.0.0.1:27017" if args.mongo == "memory" else args.mongo}, key_file)
+    os.chdir(workDir)
+    os.environ["OPENAI_BASE_URL"] = args.openai_url
+
+    if args.mongo == "memory":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+
+    sys.path.insert(0, backendDir)
+    import server
+    server.enableCompletionCache = args.completion_cache
+    server.enableSimilarityCache = args.completion_cache
+    if replayPath is not None:
+        from llm_replay import FixtureStore, ReplayBackend
+        server.llmBackend = ReplayBackend(server.llmGateway, FixtureStore(replayPath), "replay", args.replay_timing)
+        server.llmScheduler.backend = server.llmBackend
+    print(f"Benchmark backend in {workDir}, serving on port {args.port} ({args.mode})", flush=True)
+
+    if args.mode == "asgi":
+        import uvicorn
+        import asgi_server
+        uvicorn.run(asgi_server.asgiApp, port=args.port, host="127.0.0.1", log_level="warning")
+    else:
+        import logging
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server.app.run(port=args.port, host="127.0.0.1", threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class CompletionCache:
+    '''
+    Content-addressed cache for chat completion results.
+
+    Entries are keyed on everything that determines a completion (model, messages, temperature, n and max_tokens)
+    and store the content of every returned choice. Lookups go through a small in-memory LRU first and fall back to
+    a SQLite table, so cached results survive a restart of the server. Both tiers expire entries after `ttl` seconds
+    and evict the least recently used entries once they grow beyond their size limit.
+    '''
+
+    def __init__(self, path, memoryEntries=1024, diskEntries=100000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.memoryEntries = memoryEntries
+        self.diskEntries = diskEntries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (expiresAt, choices)
+        self.counters = {"memoryHits": 0, "diskHits": 0, "misses": 0, "writes": 0, "evictions": 0, "expirations": 0}
+        # the connection is shared by the Flask worker threads, every access is guarded by self.lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS completions (
+            key TEXT PRIMARY KEY,
+            choices TEXT NOT NULL,
+            expiresAt REAL NOT NULL,
+            accessedAt REAL NOT NULL
+        )''')
+        self.db.execute("CREATE INDEX IF NOT EXISTS completions_accessedAt ON completions (accessedAt)")
+        self.db.commit()
+
+    @staticmethod
+    def makeKey(model, messages, temperature, n, max_tokens):
+        request = {"model": model, "messages": messages, "temperature": temperature, "n": n, "max_tokens": max_tokens}
+        return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        choices = self.getMemory(key)
+        return choices if choices is not None else self.getDisk(key)
+
+    def getMemory(self, key):
+        # the in-memory tier only, never touches SQLite
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.counters["memoryHits"] += 1
+                    return entry[1]
+                del self.memory[key]
+                self.counters["expirations"] += 1
+            return None
+
+    def getDisk(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT choices, expiresAt FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            if row[1] <= now:
+                self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.db.commit()
+                self.counters["expirations"] += 1
+                self.counters["misses"] += 1
+                return None
+            self.db.execute("UPDATE completions SET accessedAt = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            choices = json.loads(row[0])
+            self._remember(key, row[1], choices)
+            self.counters["diskHits"] += 1
+            return choices
+
+    def set(self, key, choices):
+        expiresAt = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expiresAt, choices)
+        self.setDisk(key, choices, expiresAt)
+
+    def setDisk(self, key, choices, expiresAt):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO completions (key, choices, expiresAt, accessedAt) VALUES (?, ?, ?, ?)",
+                            (key, json.dumps(choices, ensure_ascii=False), expiresAt, now))
+            self.counters["writes"] += 1
+            # trim the disk tier every so often instead of on every write
+            if self.counters["writes"] % 100 == 0:
+                self._evictDisk(now)
+            self.db.commit()
+
+    # The same for the event loop: memory hits are answered right away, SQLite runs in a worker thread so a disk
+    # lookup or write does not block the other requests on the loop.
+    async def getAsync(self, key):
+        choices = self.getMemory(key)
+        return choices if choices is not None else await asyncio.to_thread(self.getDisk, key)
+
+    async def setAsync(self, key, choices):
+        expiresAt = time.time() + self.ttl
+        with self.lock:
+            self._remember(key, expiresAt, choices)
+        await asyncio.to_thread(self.setDisk, key, choices, expiresAt)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.db.execute("DELETE FROM completions")
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            diskSize = self.db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            lookups = self.counters["memoryHits"] + self.counters["diskHits"] + self.counters["misses"]
+            hits = self.counters["memoryHits"] + self.counters["diskHits"]
+            return dict(self.counters, memorySize=len(self.memory), diskSize=diskSize,
+                        hitRate=hits / lookups if lookups else 0.0)
+
+    def _remember(self, key, expiresAt, choices):
+        self.memory[key] = (expiresAt, choices)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memoryEntries:
+            self.memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _evictDisk(self, now):
+        expired = self.db.execute("DELETE FROM completions WHERE expiresAt <= ?", (now,)).rowcount
+        self.counters["expirations"] += expired
+        overflow = self.db.execute("SELECT COUNT(*) FROM completions").fetchone()[0] - self.diskEntries
+        if overflow > 0:
+            self.db.execute('''DELETE FROM completions WHERE key IN (
+                SELECT key FROM completions ORDER BY accessedAt LIMIT ?)''', (overflow,))
+            self.counters["evictions"] += overflow
@@ -0,0 +1,303 @@
+import os
+import re
+import json
+import base64
+import logging
+from datetime import datetime, timezone
+from bson import ObjectId
+from draft_storage import decodeDraft
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger("visar.export")
+
+# the collections that can be exported for research analysis
+exportCollections = ["interactionData", "drafts"]
+
+
+class ExportError(ValueError):
+    pass
+
+
+def parseTime(value):
+    # ISO 8601, e.g. "2024-03-01" or "2024-03-01T12:00:00Z", a time without a zone is UTC
+    if value is None or isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ExportError(f"Invalid time {value}, use ISO 8601, e.g. 2024-03-01T12:00:00Z") from None
+    if parsed is not None and parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def sessionIdValues(sessionIds):
+    # session ids are stored as numbers or strings depending on the client, a session id given as text matches both
+    values = []
+    for sessionId in sessionIds:
+        values.append(sessionId)
+        if isinstance(sessionId, str) and sessionId.lstrip("-").isdigit():
+            values.append(int(sessionId))
+    return values
+
+
+def exportQuery(collection, usernames=(), sessionIds=(), types=(), since=None, until=None, after=None):
+    # The filter of an export. `since` and `until` bound the timestamp of interaction data and the creation time of a
+    # draft (drafts have no timestamp, the time they were created is part of their _id). Interaction data logged
+    # before events had a timestamp is bounded by the creation time in its _id as well. `after` is the _id of the
+    # last document of an earlier export, the export continues behind it.
+    if collection not in exportCollections:
+        raise ExportError(f"Unknown collection {collection}, exportable are {', '.join(exportCollections)}")
+    if types and collection != "interactionData":
+        raise ExportError("Only interactionData can be filtered by type")
+    query = {}
+    if usernames:
+        query["username"] = {"$in": list(usernames)}
+    if sessionIds:
+        query["sessionId"] = {"$in": sessionIdValues(sessionIds)}
+    if types:
+        query["type"] = {"$in": list(types)}
+    since = parseTime(since)
+    until = parseTime(until)
+    timeRange = {}
+    createdRange = {}
+    if since is not None:
+        timeRange["$gte"] = since
+        createdRange["$gte"] = ObjectId.from_datetime(since)
+    if until is not None:
+        timeRange["$lt"] = until
+        createdRange["$lt"] = ObjectId.from_datetime(until)
+    idRange = {}
+    if collection == "interactionData" and timeRange:
+        query["$or"] = [{"timestamp": timeRange}, {"timestamp": {"$exists": False}, "_id": createdRange}]
+    else:
+        idRange.update(createdRange)
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            raise ExportError(f"Invalid after {after}, use the _id of the last exported line")
+        idRange["$gt"] = ObjectId(after)
+    if idRange:
+        query["_id"] = idRange
+    return query
+
+
+def exportBatches(collection, query, batchSize=1000):
+    # The matching documents in _id order, `batchSize` at a time. The cursor walks the _id index instead of sorting
+    # the result, so the first batch comes right away and memory does not grow with the size of the export.
+    cursor = collection.find(query).sort("_id", 1).hint([("_id", 1)]).batch_size(batchSize)
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= batchSize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def plainValue(value):
+    # BSON values as JSON values: ids as strings, times in ISO 8601, binary data in base64
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return (value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)).isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, dict):
+        return {str(key): plainValue(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plainValue(item) for item in value]
+    return value
+
+
+def flatten(document, prefix="", columns=None):
+    # nested objects become dotted columns, e.g. interactionData.node.type, lists and empty objects are kept as JSON
+    columns = {} if columns is None else columns
+    for key, value in document.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            flatten(value, f"{name}.", columns)
+        elif isinstance(value, (dict, list)):
+            columns[name] = json.dumps(value, ensure_ascii=False)
+        else:
+            columns[name] = value
+    return columns
+
+
+def exportRow(collection, document, flat=False):
+    if collection == "drafts":
+        decodeDraft(document)
+    row = plainValue(document)
+    return flatten(row) if flat else row
+
+
+def jsonLine(row):
+    return json.dumps(row, ensure_ascii=False, default=str) + "\n"
+
+
+class JsonLinesWriter:
+    # one JSON document per line. A resumed export cuts the file back to the end of the last checkpointed batch and
+    # appends from there.
+
+    def __init__(self, path, state=None):
+        offset = state["offset"] if state else 0
+        if offset and not os.path.exists(path):
+            raise ExportError(f"{path} of the checkpointed export is missing, start over with --restart")
+        self.file = open(path, "r+b" if offset else "wb")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def write(self, rows):
+        self.file.write("".join(jsonLine(row) for row in rows).encode("utf-8"))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        # everything written is durable, the export may resume behind this batch
+        return {"offset": self.file.tell()}
+
+    def close(self):
+        self.file.close()
+        return None
+
+
+def arrowColumn(values):
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, OverflowError):
+        # values of different types in the same column, e.g. a number in one event and text in the next
+        return pyarrow.array([value if value is None or isinstance(value, str) else json.dumps(value, default=str)
+                              for value in values], type=pyarrow.string())
+
+
+class ParquetWriter:
+    # A Parquet file cannot be appended to, so the export is a directory of part files of about `rowsPerFile` rows,
+    # one row group per batch. A part file is only complete once it is closed, the export resumes behind the last
+    # closed part and writes the part it was in again. The columns of a part are fixed by its first batch, a batch
+    # with new columns (or types that do not convert) starts the next part, readers merge the schemas of the parts.
+
+    def __init__(self, directory, state=None, rowsPerFile=100000):
+        if pyarrow is None:
+            raise ExportError("Parquet export needs the pyarrow package, install it or export JSONL")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.parts = state["parts"] if state else 0
+        for name in os.listdir(directory):
+            # parts of an earlier run that the checkpoint does not cover are written again
+            if re.fullmatch(r"part-\d{5}\.parquet", name) and int(name[5:10]) >= self.parts:
+                os.remove(os.path.join(directory, name))
+        self.rowsPerFile = rowsPerFile
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+
+    def partPath(self):
+        return os.path.join(self.directory, f"part-{self.parts:05d}.parquet")
+
+    def table(self, rows):
+        names = sorted({name for row in rows for name in row})
+        table = pyarrow.table({name: arrowColumn([row.get(name) for row in rows]) for name in names})
+        if self.schema is None or table.schema.equals(self.schema):
+            return table
+        if not set(names) <= set(self.schema.names):
+            return None
+        try:
+            return pyarrow.table({field.name: table[field.name].cast(field.type) if field.name in names
+                                  else pyarrow.nulls(len(rows), field.type) for field in self.schema})
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, pyarrow.ArrowTypeError):
+            return None
+
+    def closePart(self):
+        self.writer.close()
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+        self.parts += 1
+        return {"parts": self.parts}
+
+    def write(self, rows):
+        # returns the state to resume from when a part was completed, None while the current part is open
+        state = None
+        table = self.table(rows)
+        if table is None:
+            self.closePart()
+            table = self.table(rows)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = pyarrow.parquet.ParquetWriter(self.partPath(), self.schema)
+        self.writer.write_table(table)
+        self.rows += len(rows)
+        if self.rows >= self.rowsPerFile:
+            state = self.closePart()
+        return state
+
+    def close(self):
+        return self.closePart() if self.writer is not None else None
+
+
+def loadCheckpoint(path, export):
+    # the state of an earlier run of the same export, None if there is none
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as checkpointFile:
+        checkpoint = json.load(checkpointFile)
+    if checkpoint["export"] != export:
+        raise ExportError(f"The checkpoint {path} belongs to a different export, remove it or start over with --restart")
+    return checkpoint
+
+
+def saveCheckpoint(path, export, state):
+    # written to a temporary file and renamed, a checkpoint is never half written
+    if path is None:
+        return
+    with open(f"{path}.tmp", "w") as checkpointFile:
+        json.dump({"export": export, **state}, checkpointFile)
+    os.replace(f"{path}.tmp", path)
+
+
+def exportCollection(db, collection, output, format="jsonl", flat=False, filters=None, batchSize=1000,
+                     checkpoint=None, restart=False, rowsPerFile=100000):
+    '''
+    Export the documents of `collection` that match `filters` (the keyword arguments of exportQuery) to `output`: a
+    JSONL file, or a directory of Parquet files. Parquet rows are always flattened, JSONL rows with `flat`.
+
+    Documents are read and written one batch at a time, so memory stays flat however big the export is. After every
+    batch that is safely written, the _id of its last document is stored in the `checkpoint` file, and running the
+    same export again resumes from there. `restart` ignores the checkpoint and starts over.
+
+    Returns (documents exported by this run, documents exported in total).
+    '''
+    if format not in ("jsonl", "parquet"):
+        raise ExportError(f"Unknown export format {format}")
+    filters = dict(filters or {})
+    export = {"collection": collection, "format": format, "flat": flat or format == "parquet",
+              "filters": {key: plainValue(value) for key, value in filters.items()}}
+    state = None if restart else loadCheckpoint(checkpoint, export)
+    exportQuery(collection, **filters)  # check the filters before anything is written
+    if state is not None:
+        log.info("resuming the export of %s after %s, %d documents exported", collection, state["lastId"], state["exported"])
+    writer = JsonLinesWriter(output, state) if format == "jsonl" else ParquetWriter(output, state, rowsPerFile)
+
+    exported = state["exported"] if state else 0
+    committed = dict(state) if state else {"lastId": None, "exported": 0}
+    lastId = state["lastId"] if state else None
+    try:
+        for batch in exportBatches(db[collection], exportQuery(collection, after=lastId, **filters), batchSize):
+            written = writer.write([exportRow(collection, document, export["flat"]) for document in batch])
+            exported += len(batch)
+            lastId = plainValue(batch[-1]["_id"])
+            if written is not None:
+                committed = dict(written, lastId=lastId, exported=exported)
+                saveCheckpoint(checkpoint, export, committed)
+        written = writer.close()
+        if written is not None:
+            committed = dict(written, lastId=lastId, exported=exported)
+            saveCheckpoint(checkpoint, export, committed)
+    except BaseException:
+        log.warning("export of %s interrupted, %d documents are checkpointed", collection, committed["exported"])
+        raise
+    return exported - (state["exported"] if state else 0), exported
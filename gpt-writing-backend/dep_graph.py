@@ -0,0 +1,133 @@
+import hashlib
+import json
+
+
+class DependencyGraphError(ValueError):
+    pass
+
+
+class DependencyGraph:
+    '''
+    Indexes of a dependency graph as the client sends it (flowNode key -> {"type", "prompt", "parent", "children",
+    ...}), built once in linear time.
+
+    `levels` are the nodes reachable from the roots, in BFS order one level at a time: a node always comes after its
+    parent. `featuring` maps every node to its nearest "featuredBy" ancestor (the node itself for a "featuredBy"
+    node), so the keyword of a paragraph is looked up instead of walked to. The node dicts are not copied, generated
+    text written to `nodes[key]` ends up in the graph sent back to the client.
+    '''
+
+    def __init__(self, nodes, rootKeys):
+        self.nodes = nodes
+        self.rootKeys = list(dict.fromkeys(rootKeys))
+        self.missingRoots = [key for key in self.rootKeys if key not in nodes]
+        self.missingChildren = []  # (node, child) for children that are not in the graph
+        self.missingParents = set()  # non-root nodes whose parent is not in the graph
+        self.cycles = []  # nodes on a cycle of parent links, one per cycle
+        self.featuring = {}
+        self.levels = []
+        self.indexParents()
+        self.indexLevels()
+
+    def isRoot(self, key):
+        return self.nodes[key]["type"] == "root"
+
+    def indexParents(self):
+        # the nearest "featuredBy" node of every node, following the parent links. Every node is resolved once: a
+        # walk stops at the first node that is already resolved and resolves the whole path it took on the way back.
+        nodes = self.nodes
+        featuring = self.featuring
+        for start in nodes:
+            if start in featuring:
+                continue
+            path = []
+            onPath = set()
+            key = start
+            found = None
+            while True:
+                if key in featuring:
+                    found = featuring[key]
+                    break
+                if key in onPath:
+                    # the walk came back to a node of its own path: everything from there on is a cycle
+                    cycle = path[path.index(key):]
+                    self.cycles.append(cycle)
+                    for member in cycle:
+                        featuring[member] = None
+                    path = path[:path.index(key)]
+                    break
+                node = nodes[key]
+                if node["type"] == "featuredBy":
+                    featuring[key] = key
+                    found = key
+                    break
+                if node["type"] == "root":
+                    featuring[key] = None
+                    break
+                parent = node.get("parent")
+                if parent not in nodes:
+                    self.missingParents.add(key)
+                    featuring[key] = None
+                    break
+                path.append(key)
+                onPath.add(key)
+                key = parent
+            for member in path:
+                featuring[member] = found
+
+    def indexLevels(self):
+        nodes = self.nodes
+        visited = set()
+        level = []
+        for root in self.rootKeys:
+            if root in nodes and root not in visited:
+                visited.add(root)
+                level.append(root)
+        while level:
+            self.levels.append(level)
+            nextLevel = []
+            for key in level:
+                for child in nodes[key].get("children", []):
+                    if child not in nodes:
+                        self.missingChildren.append((key, child))
+                    elif child not in visited:
+                        visited.add(child)
+                        nextLevel.append(child)
+            level = nextLevel
+        self.reachable = visited
+
+    def orphans(self):
+        # nodes that no root leads to, they are never generated
+        return [key for key in self.nodes if key not in self.reachable]
+
+    def validate(self):
+        # raise DependencyGraphError when the graph cannot be generated. Nodes with a missing parent are not an error
+        # here, an implemented one is simply kept as it is (see generateFromDepGraphHandler).
+        if not self.rootKeys or self.missingRoots:
+            raise DependencyGraphError("The root does not exist in the dependency graph")
+        if self.missingChildren:
+            node, child = self.missingChildren[0]
+            raise DependencyGraphError(f"The node {child} does not exist in the dependency graph (child of {node})")
+        if self.cycles:
+            raise DependencyGraphError(f"The dependency graph has a cycle: {' -> '.join(map(str, self.cycles[0]))}")
+        for key in self.reachable:
+            if self.nodes[key]["type"] == "attackedBy" and self.featuring[key] is None and key not in self.missingParents:
+                raise DependencyGraphError(f"The node {key} is not below a featuredBy node")
+
+    def parentOf(self, key):
+        if self.isRoot(key) or key in self.missingParents:
+            return None
+        return self.nodes[self.nodes[key]["parent"]]
+
+    def keywordOf(self, key):
+        # the prompt of the nearest "featuredBy" node, i.e. the keyword of the paragraph the node is in
+        featured = self.featuring.get(key)
+        return self.nodes[featured]["prompt"] if featured is not None else None
+
+    def inputFingerprint(self, key):
+        # hash of everything the generated text of a node depends on: its prompt and type, the text of its parent and
+        # the keyword of the paragraph it is featured in. The text only needs to be regenerated when this changes.
+        node = self.nodes[key]
+        parent = self.parentOf(key)
+        inputs = [node["prompt"], node["type"], parent.get("text") if parent is not None else None, self.keywordOf(key)]
+        return hashlib.sha256(json.dumps(inputs, ensure_ascii=False).encode("utf-8")).hexdigest()
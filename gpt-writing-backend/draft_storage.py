@@ -0,0 +1,110 @@
+import json
+import gzip
+import hashlib
+from bson.binary import Binary
+from pymongo import UpdateOne
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the parts of a draft that are saved independently, each is a string serialized by the client
+draftSections = ["draft", "depGraph", "editorState", "flowSlice", "editorSlice"]
+
+
+def sectionHash(value):
+    # clients can compute the same hash to find out which sections changed since their last save:
+    # sha256 of the compact, key-sorted JSON serialization of the section value
+    return hashlib.sha256(json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def availableCodec(codec):
+    # zstandard is optional, fall back to gzip when it is not installed
+    if codec == "zstd" and zstandard is None:
+        return "gzip"
+    return codec
+
+
+def isEncoded(value):
+    return isinstance(value, dict) and set(value.keys()) == {"codec", "data"}
+
+
+# A compressed section is stored as {"codec": "zstd" or "gzip", "data": <compressed UTF-8 JSON of the value>} instead of
+# the raw value. Raw values are still read as they are, so both kinds of drafts can live in the same collection.
+def encodeSection(value, codec="zstd", minBytes=512):
+    raw = json.dumps(value, ensure_ascii=False).encode("utf-8")
+    if len(raw) < minBytes:
+        # too small to be worth it
+        return value
+    codec = availableCodec(codec)
+    if codec == "zstd":
+        data = zstandard.ZstdCompressor(level=3).compress(raw)
+    elif codec == "gzip":
+        data = gzip.compress(raw, compresslevel=6)
+    else:
+        raise ValueError(f"Unknown draft codec {codec}")
+    return {"codec": codec, "data": Binary(data)}
+
+
+def decodeSection(value):
+    if not isEncoded(value):
+        return value
+    if value["codec"] == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This draft is compressed with zstd, install the zstandard package to read it")
+        raw = zstandard.ZstdDecompressor().decompress(bytes(value["data"]))
+    elif value["codec"] == "gzip":
+        raw = gzip.decompress(bytes(value["data"]))
+    else:
+        raise ValueError(f"Unknown draft codec {value['codec']}")
+    return json.loads(raw.decode("utf-8"))
+
+
+def decodeDraft(document):
+    # decode every compressed section of a draft document in place
+    if document is not None:
+        for field in draftSections:
+            if field in document:
+                document[field] = decodeSection(document[field])
+    return document
+
+
+def migrateDrafts(drafts, codec="zstd", decompress=False, minBytes=512, batchSize=100):
+    # Re-encode every draft of the collection: compress the raw sections, or decompress everything when
+    # decompress is set. Drafts saved before sectionHashes existed get their hashes on the way. A draft is only
+    # rewritten if it still has the version that was read, one saved in between is skipped and left to the next run.
+    # Returns (number of drafts read, number of drafts rewritten, number of drafts skipped).
+    read = 0
+    rewritten = 0
+    skipped = 0
+    operations = []
+
+    def write():
+        nonlocal rewritten, skipped
+        matched = drafts.bulk_write(operations, ordered=False).matched_count
+        rewritten += matched
+        skipped += len(operations) - matched
+
+    for document in drafts.find({}, {field: 1 for field in draftSections + ["sectionHashes", "version"]}).batch_size(batchSize):
+        read += 1
+        changes = {}
+        for field in draftSections:
+            if field not in document:
+                continue
+            value = decodeSection(document[field])
+            stored = value if decompress else encodeSection(value, codec, minBytes)
+            if isEncoded(stored) != isEncoded(document[field]) or (isEncoded(stored) and stored["codec"] != document[field]["codec"]):
+                changes[field] = stored
+            if field not in document.get("sectionHashes", {}):
+                changes[f"sectionHashes.{field}"] = sectionHash(value)
+        if changes:
+            # every save increments the version, drafts saved before versioning have none
+            version = document["version"] if "version" in document else {"$exists": False}
+            operations.append(UpdateOne({"_id": document["_id"], "version": version}, {"$set": changes}))
+        if len(operations) >= batchSize:
+            write()
+            operations = []
+    if operations:
+        write()
+    return read, rewritten, skipped
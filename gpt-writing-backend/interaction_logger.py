@@ -0,0 +1,185 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+log = logging.getLogger("visar.interactions")
+
+
+class BufferedWriter:
+    '''
+    Write-behind buffer in front of a Mongo collection.
+
+    Documents are acknowledged as soon as they are queued and a background thread writes them with insert_many,
+    either when `batchSize` documents are pending or `flushInterval` seconds after the first pending document arrived.
+    The queue is bounded: when it is full, add() waits up to `enqueueTimeout` seconds and then reports the document
+    as rejected so the caller can push back on the client. Pending documents are written when the process exits.
+
+    A batch that still cannot be inserted after three attempts (e.g. MongoDB is down) is appended to the spill file
+    `spillPath`. The writer inserts the spilled documents again `spillRetryInterval` seconds later, once a batch was
+    written, and when the writer of the next process starts, so acknowledged documents are not lost during an outage.
+    '''
+
+    def __init__(self, collection, batchSize=200, flushInterval=1.0, maxPending=10000, enqueueTimeout=0.5,
+                 spillPath=None, spillRetryInterval=30):
+        self.collection = collection
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.enqueueTimeout = enqueueTimeout
+        self.queue = queue.Queue(maxsize=maxPending)
+        self.stopping = threading.Event()
+        self.startLock = threading.Lock()
+        self.thread = None
+        self.spillPath = spillPath
+        self.spillRetryInterval = spillRetryInterval
+        self.lastReplay = 0.0
+        self.lock = threading.Lock()
+        self.counters = {"written": 0, "batches": 0, "rejected": 0, "spilled": 0, "replayed": 0, "failed": 0}
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def start(self):
+        # the writer thread is started lazily, so importing the server (e.g. in the reloader process) stays cheap
+        with self.startLock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="BufferedWriter", daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def add(self, document):
+        self.start()
+        try:
+            self.queue.put(document, timeout=self.enqueueTimeout)
+            return True
+        except queue.Full:
+            self.count("rejected")
+            return False
+
+    def addMany(self, documents):
+        # returns the number of documents that were queued, the rest were rejected by backpressure
+        for index, document in enumerate(documents):
+            if not self.add(document):
+                self.count("rejected", len(documents) - index - 1)
+                return index
+        return len(documents)
+
+    def stop(self, timeout=10):
+        # write everything that is still pending and stop the writer thread
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, pending=self.queue.qsize())
+
+    def hasSpill(self):
+        return self.spillPath is not None and (os.path.exists(self.spillPath) or os.path.exists(f"{self.spillPath}.replaying"))
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self._nextBatch()
+            written = self._write(batch) if batch else False
+            if (written or time.monotonic() - self.lastReplay >= self.spillRetryInterval) and self.hasSpill():
+                self._replaySpill()
+
+    def _nextBatch(self):
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flushInterval
+        while len(batch) < self.batchSize:
+            remaining = deadline - time.monotonic()
+            if self.stopping.is_set():
+                remaining = 0
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, batch):
+        # one insert_many, returns the error if it failed. insert_many assigns an _id to every document before sending
+        # it, so a retry after a partial failure only hits duplicate key errors for the documents that already made it
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                return e
+        except Exception as e:
+            return e
+        return None
+
+    def _write(self, batch):
+        # returns whether the batch was inserted, a batch that was not is spilled
+        for attempt in range(3):
+            error = self._insert(batch)
+            if error is None:
+                self.count("written", len(batch))
+                self.count("batches")
+                return True
+            log.warning("insert_many of %d documents failed (attempt %d): %s", len(batch), attempt + 1, error)
+            time.sleep(0.5 * (attempt + 1))
+        self._spill(batch)
+        return False
+
+    def _spill(self, batch):
+        if self.spillPath is None:
+            log.error("dropped %d documents that could not be inserted", len(batch))
+            self.count("failed", len(batch))
+            return
+        try:
+            with open(self.spillPath, "a") as spill:
+                spill.write("".join(json_util.dumps(document) + "\n" for document in batch))
+                spill.flush()
+                os.fsync(spill.fileno())
+        except OSError as e:
+            log.error("dropped %d documents that could neither be inserted nor spilled to %s: %s", len(batch), self.spillPath, e)
+            self.count("failed", len(batch))
+            return
+        log.error("spilled %d documents that could not be inserted to %s, they are inserted again later", len(batch), self.spillPath)
+        self.count("spilled", len(batch))
+        # retry the spill after spillRetryInterval, not right away
+        self.lastReplay = time.monotonic()
+
+    def _replaySpill(self):
+        # Insert the spilled documents again. The file is renamed first, batches spilled meanwhile start a new one.
+        # A replay that fails keeps the renamed file for the next attempt, the documents it already inserted are
+        # skipped then as duplicate keys.
+        self.lastReplay = time.monotonic()
+        replaying = f"{self.spillPath}.replaying"
+        if not os.path.exists(replaying):
+            os.replace(self.spillPath, replaying)
+        replayed = 0
+        batch = []
+        with open(replaying) as spill:
+            for line in spill:
+                try:
+                    batch.append(json_util.loads(line))
+                except ValueError:
+                    # the last line of a spill that was interrupted by a crash
+                    log.error("skipped an unreadable line of %s", replaying)
+                    continue
+                if len(batch) >= self.batchSize:
+                    error = self._insert(batch)
+                    if error is not None:
+                        log.warning("replay of %s failed: %s", replaying, error)
+                        return
+                    replayed += len(batch)
+                    batch = []
+        if batch:
+            error = self._insert(batch)
+            if error is not None:
+                log.warning("replay of %s failed: %s", replaying, error)
+                return
+            replayed += len(batch)
+        os.remove(replaying)
+        self.count("replayed", replayed)
+        log.info("inserted %d spilled documents", replayed)
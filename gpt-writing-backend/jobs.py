@@ -0,0 +1,217 @@
+import json
+import uuid
+import weakref
+import asyncio
+import hashlib
+import contextvars
+from datetime import datetime, timezone, timedelta
+from pymongo.errors import DuplicateKeyError
+
+
+def jobIdOf(kind, payload, username):
+    # the id of a job is the hash of its request and of the user who submitted it, so submitting the same request
+    # again finds the same job, while the same request of another user is a job of its own
+    return hashlib.sha256(json.dumps([kind, payload, username], sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+
+
+def sseEvent(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class Job:
+    # a job running in this process. `completed` holds the node results of the earlier attempts and of this one
+
+    def __init__(self, runner, jobId, kind, payload, username, completed):
+        self.runner = runner
+        self.jobId = jobId
+        self.kind = kind
+        self.payload = payload
+        self.username = username
+        self.completed = completed
+        self.resumed = len(completed)
+        self.progress = {"done": 0, "total": None}
+        self.events = [sseEvent("node", {"node": node, "result": result}) for node, result in completed.items()]
+        self.changed = asyncio.Event()
+        self.finished = False
+
+    def publish(self, event):
+        self.events.append(event)
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def nodeDone(self, node, result):
+        # persist the result of a node, a retry of the job reuses it instead of generating it again
+        self.completed[node] = result
+        await asyncio.to_thread(self.runner.results.update_one, {"jobId": self.jobId, "node": node},
+                                {"$set": {"result": result, "updatedAt": datetime.now(timezone.utc)}}, upsert=True)
+        self.publish(sseEvent("node", {"node": node, "result": result}))
+
+    async def setProgress(self, done, total):
+        self.progress = {"done": done, "total": total}
+        await asyncio.to_thread(self.runner.jobs.update_one, {"_id": self.jobId},
+                                {"$set": {"progress": self.progress, "updatedAt": datetime.now(timezone.utc)}})
+        self.publish(sseEvent("progress", self.progress))
+
+
+class JobRunner:
+    '''
+    Runs long generations as background jobs on the event loop of the caller, at most `workers` at a time.
+
+    The state of a job is kept in MongoDB: the job document (`jobs`: status, progress, result, error) and the result of
+    every node as soon as it is generated (`results`). A job that failed or was interrupted, e.g. by a restart, is
+    resumed when the same request is submitted again: the nodes that are already stored are not generated again.
+
+    A job belongs to the user who submitted it, status() and events() only show it to that user.
+
+    A job function is `async def function(payload, job)`, registered per kind. It reports its nodes with
+    `await job.nodeDone(node, result)` and may check `job.completed` to skip the nodes of an earlier attempt.
+    '''
+
+    def __init__(self, jobs, results, workers=4, maxQueued=100, staleSeconds=300):
+        self.jobs = jobs
+        self.results = results
+        self.workers = workers
+        self.maxQueued = maxQueued
+        self.staleSeconds = staleSeconds  # a queued or running job that was not updated for this long was interrupted
+        self.owner = uuid.uuid4().hex  # this process
+        self.kinds = {}
+        self.running = {}  # job id -> Job of this process
+        self.submitting = weakref.WeakValueDictionary()  # job id -> lock held while the job is looked up and started
+        self.semaphore = None
+        self.counters = {"submitted": 0, "resumed": 0, "completed": 0, "failed": 0, "rejected": 0}
+
+    def register(self, kind, function):
+        self.kinds[kind] = function
+
+    def isStale(self, document):
+        updatedAt = document["updatedAt"]
+        if updatedAt.tzinfo is None:
+            updatedAt = updatedAt.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - updatedAt > timedelta(seconds=self.staleSeconds)
+
+    async def submit(self, kind, payload, username="anonymous"):
+        # start the job of this request, or find the one already started. Returns the job document without its
+        # result, None when too many jobs are waiting.
+        if kind not in self.kinds:
+            raise KeyError(kind)
+        jobId = jobIdOf(kind, payload, username)
+        # an identical submit that arrives while this one waits for MongoDB finds the job running afterwards
+        lock = self.submitting.get(jobId)
+        if lock is None:
+            lock = self.submitting[jobId] = asyncio.Lock()
+        async with lock:
+            return await self.start(jobId, kind, payload, username)
+
+    async def start(self, jobId, kind, payload, username):
+        if jobId in self.running:
+            return await self.status(jobId, username, withResults=False)
+        document = await asyncio.to_thread(self.jobs.find_one, {"_id": jobId}, {"result": 0})
+        if document is not None:
+            if document["status"] == "done":
+                return document
+            if document["status"] in ("queued", "running") and document.get("owner") != self.owner and not self.isStale(document):
+                # another process is running it
+                return document
+        if len(self.running) >= self.workers + self.maxQueued:
+            self.counters["rejected"] += 1
+            return None
+
+        now = datetime.now(timezone.utc)
+        state = {"kind": kind, "username": username, "status": "queued", "owner": self.owner, "error": None, "updatedAt": now,
+                 "progress": {"done": 0, "total": None}}
+        try:
+            await asyncio.to_thread(self.jobs.update_one, {"_id": jobId}, {"$set": state, "$setOnInsert": {"createdAt": now}}, upsert=True)
+        except DuplicateKeyError:
+            # submitted by another process at the same time, the upsert lost the race
+            return await self.status(jobId, username, withResults=False)
+        completed = {}
+        if document is not None:
+            async for stored in self.cursor(self.results.find, {"jobId": jobId}, {"node": 1, "result": 1}):
+                completed[stored["node"]] = stored["result"]
+        job = Job(self, jobId, kind, payload, username, completed)
+        self.running[jobId] = job
+        self.counters["submitted"] += 1
+        if completed:
+            self.counters["resumed"] += 1
+        # the job outlives the request that submitted it, so it must not run in the request's context (e.g. its trace)
+        contextvars.Context().run(asyncio.get_running_loop().create_task, self.run(job))
+        return dict(state, _id=jobId, resumedNodes=len(completed))
+
+    async def cursor(self, find, *args):
+        for document in await asyncio.to_thread(lambda: list(find(*args))):
+            yield document
+
+    async def run(self, job):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        try:
+            async with self.semaphore:
+                await asyncio.to_thread(self.jobs.update_one, {"_id": job.jobId},
+                                        {"$set": {"status": "running", "updatedAt": datetime.now(timezone.utc)}})
+                job.publish(sseEvent("status", {"status": "running"}))
+                result = await self.kinds[job.kind](job.payload, job)
+            await asyncio.to_thread(self.jobs.update_one, {"_id": job.jobId},
+                                    {"$set": {"status": "done", "result": result, "updatedAt": datetime.now(timezone.utc)}})
+            self.counters["completed"] += 1
+            job.publish(sseEvent("done", {"status": "done", "result": result}))
+        except Exception as e:
+            self.counters["failed"] += 1
+            try:
+                await asyncio.to_thread(self.jobs.update_one, {"_id": job.jobId},
+                                        {"$set": {"status": "failed", "error": str(e), "updatedAt": datetime.now(timezone.utc)}})
+            finally:
+                job.publish(sseEvent("done", {"status": "failed", "error": str(e)}))
+        finally:
+            job.finished = True
+            self.running.pop(job.jobId, None)
+
+    async def status(self, jobId, username, withResults=True):
+        # the job document with the results of its nodes so far, None for an unknown job or a job of another user
+        document = await asyncio.to_thread(self.jobs.find_one, {"_id": jobId})
+        if document is None or document.get("username", "anonymous") != username:
+            return None
+        job = self.running.get(jobId)
+        if job is None and document["status"] in ("queued", "running") and self.isStale(document):
+            document["status"] = "interrupted"
+        if withResults:
+            if job is not None:
+                document["nodes"] = dict(job.completed)
+            else:
+                document["nodes"] = {stored["node"]: stored["result"] async for stored in
+                                     self.cursor(self.results.find, {"jobId": jobId}, {"node": 1, "result": 1})}
+        return document
+
+    async def events(self, jobId, username, keepAlive=15):
+        # server-sent events of a job: "node" for every node result (those already done first), "progress", "status"
+        # and a final "done" with the result or the error
+        job = self.running.get(jobId)
+        if job is not None and job.username != username:
+            job = None
+        if job is None:
+            document = await self.status(jobId, username)
+            if document is None:
+                yield sseEvent("done", {"status": "unknown", "error": "Job not found"})
+                return
+            for node, result in document["nodes"].items():
+                yield sseEvent("node", {"node": node, "result": result})
+            if document["status"] in ("done", "failed", "interrupted"):
+                yield sseEvent("done", {"status": document["status"], "result": document.get("result"), "error": document.get("error")})
+                return
+            # running in another process, which publishes its events there: poll the status instead
+            yield sseEvent("status", {"status": document["status"], "progress": document.get("progress")})
+            return
+        sent = 0
+        while True:
+            while sent < len(job.events):
+                yield job.events[sent]
+                sent += 1
+            if job.finished:
+                return
+            try:
+                await asyncio.wait_for(job.changed.wait(), keepAlive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+
+    def stats(self):
+        running = sum(1 for job in self.running.values() if not job.finished)
+        return dict(self.counters, inProcess=running)
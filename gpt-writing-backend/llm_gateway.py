@@ -0,0 +1,196 @@
+import time
+import random
+import logging
+import asyncio
+import threading
+import httpx
+import openai
+from openai import AsyncOpenAI
+from metrics import Counter, Gauge, Histogram
+
+log = logging.getLogger("visar.llm")
+
+llmBuckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+llmRequestSeconds = Histogram("visar_llm_request_seconds", "Duration of the LLM calls including queueing and retries, until the last token of a stream", ["endpoint", "model"], buckets=llmBuckets)
+llmPromptTokens = Counter("visar_llm_prompt_tokens_total", "Prompt tokens reported by the LLM API", ["endpoint", "model"])
+llmCompletionTokens = Counter("visar_llm_completion_tokens_total", "Completion tokens reported by the LLM API", ["endpoint", "model"])
+llmErrors = Counter("visar_llm_errors_total", "LLM calls that failed after their retries", ["endpoint", "model", "error"])
+llmRetries = Counter("visar_llm_retries_total", "Retried LLM requests", ["endpoint", "model"])
+llmInFlight = Gauge("visar_llm_requests_in_flight", "LLM calls waiting for a budget, a response or the end of a stream", ["endpoint"])
+
+
+class TokenBucket:
+    '''
+    Client-side budget of `perMinute` units (requests or tokens) per minute.
+
+    A reservation always succeeds but may leave the bucket in debt, the caller then waits until the debt is paid
+    back. Every reservation waits behind the ones made before it, so calls over budget are queued in arrival order
+    instead of failing.
+    '''
+
+    def __init__(self, perMinute):
+        self.rate = perMinute / 60.0
+        self.capacity = perMinute
+        self.level = perMinute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        # take `amount` out of the bucket and return the seconds until it is available
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount):
+        # give back units that were reserved but not used, or charge more with a negative amount
+        with self.lock:
+            self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+
+class LLMGateway:
+    '''
+    The single way the server talks to OpenAI.
+
+    - one pooled HTTP client per event loop, the pool of an async client cannot be shared between loops
+    - a deadline per call, covering the time spent queued, every attempt and the backoff between attempts
+    - jittered exponential backoff on 429, 5xx, timeouts and connection errors, honoring Retry-After
+    - request and token budgets per minute (see TokenBucket), the tokens of a call are estimated up front from the
+      prompt and max_tokens and corrected with the usage the API reports
+    '''
+
+    def __init__(self, apiKey, requestsPerMinute=3500, tokensPerMinute=90000, timeout=60, maxRetries=4,
+                 backoffBase=0.5, backoffMax=20, maxConnections=64):
+        self.apiKey = apiKey
+        self.timeout = timeout
+        self.maxRetries = maxRetries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.maxConnections = maxConnections
+        self.requestBudget = TokenBucket(requestsPerMinute)
+        self.tokenBudget = TokenBucket(tokensPerMinute)
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "failures": 0, "deadlineExceeded": 0, "queuedSeconds": 0.0}
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if loop not in self.clients:
+                limits = httpx.Limits(max_connections=self.maxConnections, max_keepalive_connections=self.maxConnections)
+                # retries are done here, with the deadline and the budgets in mind
+                self.clients[loop] = AsyncOpenAI(api_key=self.apiKey, max_retries=0,
+                                                 http_client=httpx.AsyncClient(limits=limits, timeout=self.timeout))
+            return self.clients[loop]
+
+    @staticmethod
+    def estimateTokens(params):
+        # about 4 characters per token for the prompt, plus the most the completion can use
+        promptTokens = sum(len(message["content"]) for message in params.get("messages", [])) // 4
+        return promptTokens + params.get("max_tokens", 256) * params.get("n", 1)
+
+    def isRetryable(self, error):
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    def backoff(self, attempt, error):
+        retryAfter = None
+        if isinstance(error, openai.APIStatusError):
+            try:
+                retryAfter = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        if retryAfter is not None:
+            return retryAfter
+        # full jitter
+        return random.uniform(0, min(self.backoffMax, self.backoffBase * 2 ** attempt))
+
+    async def waitForBudget(self, tokens, deadline):
+        wait = max(self.requestBudget.reserve(1), self.tokenBudget.reserve(tokens))
+        if wait > deadline - time.monotonic():
+            self.requestBudget.refund(1)
+            self.tokenBudget.refund(tokens)
+            self.counters["deadlineExceeded"] += 1
+            raise TimeoutError(f"LLM call would be queued for {wait:.1f}s, beyond its deadline")
+        if wait > 0:
+            self.counters["queuedSeconds"] += wait
+            await asyncio.sleep(wait)
+
+    async def create(self, endpoint=None, timeout=None, **params):
+        # chat.completions.create with the gateway policies, returns what the client returns (a stream when
+        # params has stream=True, retries stop once the stream is returned). `endpoint` labels the call in the
+        # logs and the metrics
+        labels = {"endpoint": endpoint, "model": params.get("model")}
+        if params.get("stream"):
+            # the last chunk of the stream then reports the usage
+            params.setdefault("stream_options", {"include_usage": True})
+        start = time.monotonic()
+        llmInFlight.inc(endpoint=endpoint)
+        try:
+            response = await self.send(labels, timeout, params)
+        except Exception as e:
+            llmInFlight.dec(endpoint=endpoint)
+            llmErrors.inc(error=type(e).__name__, **labels)
+            raise
+        if params.get("stream"):
+            return self.measureStream(response, labels, start)
+        llmInFlight.dec(endpoint=endpoint)
+        llmRequestSeconds.observe(time.monotonic() - start, **labels)
+        self.countUsage(getattr(response, "usage", None), labels)
+        return response
+
+    async def measureStream(self, stream, labels, start):
+        try:
+            async for chunk in stream:
+                self.countUsage(getattr(chunk, "usage", None), labels)
+                yield chunk
+        except Exception as e:
+            llmErrors.inc(error=type(e).__name__, **labels)
+            raise
+        finally:
+            llmInFlight.dec(endpoint=labels["endpoint"])
+            llmRequestSeconds.observe(time.monotonic() - start, **labels)
+
+    def countUsage(self, usage, labels):
+        if usage is not None:
+            llmPromptTokens.inc(usage.prompt_tokens, **labels)
+            llmCompletionTokens.inc(usage.completion_tokens, **labels)
+
+    async def send(self, labels, timeout, params):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        tokens = self.estimateTokens(params)
+        self.counters["calls"] += 1
+        await self.waitForBudget(tokens, deadline)
+
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                response = await self.client().chat.completions.create(timeout=remaining, **params)
+                break
+            except Exception as e:
+                if not self.isRetryable(e) or attempt >= self.maxRetries:
+                    self.counters["failures"] += 1
+                    raise
+                delay = self.backoff(attempt, e)
+                if delay >= deadline - time.monotonic():
+                    self.counters["failures"] += 1
+                    self.counters["deadlineExceeded"] += 1
+                    raise
+                log.info("%s: %s, retrying in %.2fs", labels["endpoint"], type(e).__name__, delay)
+                self.counters["retries"] += 1
+                llmRetries.inc(**labels)
+                attempt += 1
+                await asyncio.sleep(delay)
+                await self.waitForBudget(0, deadline)
+
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.tokenBudget.refund(tokens - usage.total_tokens)
+        return response
+
+    def stats(self):
+        return dict(self.counters, requestBudget=round(self.requestBudget.level), tokenBudget=round(self.tokenBudget.level))
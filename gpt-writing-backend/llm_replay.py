@@ -0,0 +1,121 @@
+import json
+import time
+import types
+import asyncio
+import hashlib
+import threading
+
+
+def requestFingerprint(params):
+    # what identifies an LLM request: everything sent to the API except whether the answer is streamed
+    request = {key: value for key, value in params.items() if key != "stream"}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class FixtureStore:
+    '''
+    Recorded LLM completions, one JSON object per line in `path`:
+    {"fingerprint", "endpoint", "model", "choices", "latency", "firstTokenLatency", "recordedAt"}
+
+    The whole file is loaded on start. Recording appends to the file, a fingerprint that is recorded again is served
+    with its latest recording.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fixtures = {}
+        try:
+            with open(path, encoding="utf-8") as fixtureFile:
+                for line in fixtureFile:
+                    if line.strip():
+                        fixture = json.loads(line)
+                        self.fixtures[fixture["fingerprint"]] = fixture
+        except FileNotFoundError:
+            pass
+
+    def get(self, fingerprint):
+        with self.lock:
+            return self.fixtures.get(fingerprint)
+
+    def add(self, fixture):
+        with self.lock:
+            self.fixtures[fixture["fingerprint"]] = fixture
+            with open(self.path, "a", encoding="utf-8") as fixtureFile:
+                fixtureFile.write(json.dumps(fixture, ensure_ascii=False) + "\n")
+
+    def __len__(self):
+        return len(self.fixtures)
+
+
+class ReplayBackend:
+    '''
+    Stands in for the LLM gateway with the same create() call.
+
+    mode "record": the request goes through the gateway and the completion is written to the fixture store.
+    mode "replay": the recorded completion is served without calling OpenAI, after the latency observed when it was
+    recorded, or right away when `timing` is "instant". A request that was never recorded raises LookupError.
+    '''
+
+    def __init__(self, gateway, store, mode="replay", timing="observed"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown replay mode {mode}")
+        self.gateway = gateway
+        self.store = store
+        self.mode = mode
+        self.timing = timing
+        self.counters = {"recorded": 0, "replayed": 0, "missing": 0}
+
+    async def create(self, endpoint=None, **params):
+        fingerprint = requestFingerprint(params)
+        if self.mode == "record":
+            start = time.monotonic()
+            response = await self.gateway.create(endpoint=endpoint, **params)
+            if params.get("stream"):
+                return self.recordStream(response, fingerprint, endpoint, params, start)
+            self.record(fingerprint, endpoint, params, [choice.message.content for choice in response.choices],
+                        time.monotonic() - start, None)
+            return response
+
+        fixture = self.store.get(fingerprint)
+        if fixture is None:
+            self.counters["missing"] += 1
+            raise LookupError(f"No recorded completion for this {endpoint} request ({fingerprint[:12]}), record it first")
+        self.counters["replayed"] += 1
+        if params.get("stream"):
+            return self.replayStream(fixture)
+        if self.timing == "observed":
+            await asyncio.sleep(fixture["latency"])
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content)) for content in fixture["choices"]],
+            usage=None)
+
+    def record(self, fingerprint, endpoint, params, choices, latency, firstTokenLatency):
+        self.store.add({"fingerprint": fingerprint, "endpoint": endpoint, "model": params.get("model"), "choices": choices,
+                        "latency": latency, "firstTokenLatency": firstTokenLatency, "recordedAt": time.time()})
+        self.counters["recorded"] += 1
+
+    async def recordStream(self, stream, fingerprint, endpoint, params, start):
+        text = ""
+        firstTokenLatency = None
+        async for chunk in stream:
+            if firstTokenLatency is None:
+                firstTokenLatency = time.monotonic() - start
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+            yield chunk
+        self.record(fingerprint, endpoint, params, [text], time.monotonic() - start, firstTokenLatency)
+
+    async def replayStream(self, fixture):
+        # the first token after the observed time to first token, the rest spread over the remaining time
+        words = fixture["choices"][0].split(" ")
+        firstTokenLatency = fixture["firstTokenLatency"] if fixture["firstTokenLatency"] is not None else fixture["latency"]
+        interval = max(0.0, fixture["latency"] - firstTokenLatency) / max(1, len(words) - 1)
+        for index, word in enumerate(words):
+            if self.timing == "observed":
+                await asyncio.sleep(firstTokenLatency if index == 0 else interval)
+            content = word if index == len(words) - 1 else word + " "
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=content))])
+
+    def stats(self):
+        return dict(self.counters, mode=self.mode, timing=self.timing, fixtures=len(self.store))
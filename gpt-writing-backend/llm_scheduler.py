@@ -0,0 +1,246 @@
+import time
+import asyncio
+import threading
+import itertools
+import contextvars
+from collections import deque
+from llm_gateway import LLMGateway
+from metrics import Gauge, Histogram
+
+# Who an LLM call is made for: (username, priority class). Set once per request or job with runAs, the calls the
+# handler makes inherit it like the current span of tracing.py.
+currentCaller = contextvars.ContextVar("currentCaller", default=("anonymous", "interactive"))
+
+llmQueueSeconds = Histogram("visar_llm_queue_seconds", "Time LLM calls waited in the fair scheduler", ["priority"],
+                            buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+llmQueued = Gauge("visar_llm_queued", "LLM calls waiting in the fair scheduler", ["priority"])
+
+
+async def runAs(caller, coroutine):
+    # await the coroutine with its LLM calls scheduled for `caller`
+    currentCaller.set(caller)
+    return await coroutine
+
+
+class Waiter:
+    def __init__(self, loop, username, priority, cost, start, finish, order):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.username = username
+        self.priority = priority
+        self.cost = cost
+        self.start = start
+        self.finish = finish
+        self.order = order
+        self.granted = False
+        self.queued = time.monotonic()
+
+    def grant(self):
+        self.granted = True
+        self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class UserState:
+    def __init__(self, tokensPerMinute):
+        self.inFlight = {"interactive": 0, "bulk": 0}
+        self.level = tokensPerMinute
+        self.updated = time.monotonic()
+
+
+class FairScheduler:
+    '''
+    Decides which LLM call goes next, in front of the backend (gateway or replay), with the same create().
+
+    - at most `maxConcurrent` calls run at a time, `interactiveReserve` of them are kept for interactive calls so a
+      bulk generation can never take all of them
+    - every user may run `userConcurrency` calls of each class at a time and spend `userTokensPerMinute` estimated
+      tokens per minute, a user over the quota waits while the others go ahead. Calls without a username share the
+      "anonymous" flow, which has no per-user limits.
+    - a call is charged its estimated tokens (prompt and max_tokens for every choice) up front, and refunded what it
+      did not use once the usage is known: from the response, or from the last chunk or the streamed text of a stream
+    - waiting calls are served by weighted fair queuing: each (user, class) flow is a queue, and the call with the
+      smallest virtual finish tag goes next. The tag grows by the estimated tokens of a call divided by the weight of
+      its class, so a user with a big outline does not get more turns than a user asking for one rewrite, and
+      interactive calls get `weights["interactive"]` times the share of bulk ones.
+    '''
+
+    def __init__(self, backend, maxConcurrent=48, interactiveReserve=16, userConcurrency=6, userTokensPerMinute=30000,
+                 weights=None, maxWait=60):
+        self.backend = backend
+        self.maxConcurrent = maxConcurrent
+        self.interactiveReserve = interactiveReserve
+        self.userConcurrency = userConcurrency
+        self.userTokensPerMinute = userTokensPerMinute
+        self.weights = weights or {"interactive": 4, "bulk": 1}
+        self.maxWait = maxWait  # seconds an interactive call may wait for its turn, bulk calls wait as long as it takes
+        self.lock = threading.Lock()
+        self.flows = {}  # (username, priority) -> deque of waiters in arrival order
+        self.lastFinish = {}  # (username, priority) -> finish tag of the last call queued
+        self.users = {}
+        self.virtualTime = 0.0
+        self.inFlight = {"interactive": 0, "bulk": 0}
+        self.order = itertools.count()
+        self.retryHandle = None
+        self.counters = {"granted": 0, "timedOut": 0, "quotaWaits": 0, "waitedSeconds": 0.0}
+
+    def user(self, username):
+        if username not in self.users:
+            self.users[username] = UserState(self.userTokensPerMinute)
+        return self.users[username]
+
+    def quotaWait(self, username, state):
+        # seconds until the user is out of token debt
+        if username == "anonymous":
+            return 0.0
+        now = time.monotonic()
+        rate = self.userTokensPerMinute / 60.0
+        state.level = min(self.userTokensPerMinute, state.level + (now - state.updated) * rate)
+        state.updated = now
+        return max(0.0, -state.level / rate)
+
+    def eligible(self, waiter):
+        if sum(self.inFlight.values()) >= self.maxConcurrent:
+            return False
+        if waiter.priority == "bulk" and self.inFlight["bulk"] >= self.maxConcurrent - self.interactiveReserve:
+            return False
+        if waiter.username == "anonymous":
+            return True
+        return self.user(waiter.username).inFlight[waiter.priority] < self.userConcurrency
+
+    def dispatch(self):
+        # grant the waiting calls that may run now, smallest finish tag first. Returns the seconds until a call held
+        # back by its user's token quota may run, None if there is none.
+        retry = None
+        with self.lock:
+            while True:
+                best = None
+                for flow in self.flows.values():
+                    waiter = flow[0]
+                    if (best is None or (waiter.finish, waiter.order) < (best.finish, best.order)) and self.eligible(waiter):
+                        state = self.user(waiter.username)
+                        wait = self.quotaWait(waiter.username, state)
+                        if wait > 0:
+                            retry = wait if retry is None else min(retry, wait)
+                            continue
+                        best = waiter
+                if best is None:
+                    return retry
+                flowKey = (best.username, best.priority)
+                self.flows[flowKey].popleft()
+                if not self.flows[flowKey]:
+                    del self.flows[flowKey]
+                state = self.user(best.username)
+                if best.username != "anonymous":
+                    state.level -= min(best.cost, self.userTokensPerMinute)
+                state.inFlight[best.priority] += 1
+                self.inFlight[best.priority] += 1
+                self.virtualTime = max(self.virtualTime, best.start)
+                self.counters["granted"] += 1
+                best.grant()
+
+    def scheduleDispatch(self):
+        retry = self.dispatch()
+        if retry is not None:
+            # nothing else frees a quota, come back when the first user is out of debt
+            loop = asyncio.get_running_loop()
+            with self.lock:
+                if self.retryHandle is not None:
+                    self.retryHandle.cancel()
+                self.retryHandle = loop.call_later(retry, self.scheduleDispatch)
+
+    async def acquire(self, username, priority, cost):
+        loop = asyncio.get_running_loop()
+        flowKey = (username, priority)
+        with self.lock:
+            start = max(self.virtualTime, self.lastFinish.get(flowKey, 0.0))
+            finish = start + cost / self.weights[priority]
+            self.lastFinish[flowKey] = finish
+            waiter = Waiter(loop, username, priority, cost, start, finish, next(self.order))
+            self.flows.setdefault(flowKey, deque()).append(waiter)
+            if username != "anonymous" and self.quotaWait(username, self.user(username)) > 0:
+                self.counters["quotaWaits"] += 1
+        llmQueued.inc(priority=priority)
+        try:
+            self.scheduleDispatch()
+            # bulk work (e.g. a background job) waits for its turn rather than failing
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.maxWait if priority == "interactive" else None)
+        except BaseException as e:
+            with self.lock:
+                granted = waiter.granted
+                if not granted:
+                    self.flows[flowKey].remove(waiter)
+                    if not self.flows[flowKey]:
+                        del self.flows[flowKey]
+            if not isinstance(e, asyncio.TimeoutError):
+                if granted:
+                    self.release(username, priority)
+                raise
+            if not granted:
+                self.counters["timedOut"] += 1
+                raise TimeoutError(f"LLM call waited {self.maxWait}s for its turn") from None
+            # granted just as the wait ran out, the call runs after all
+        finally:
+            llmQueued.dec(priority=priority)
+        waited = time.monotonic() - waiter.queued
+        self.counters["waitedSeconds"] += waited
+        llmQueueSeconds.observe(waited, priority=priority)
+        return waiter
+
+    def release(self, username, priority, refund=0):
+        with self.lock:
+            state = self.user(username)
+            state.inFlight[priority] -= 1
+            self.inFlight[priority] -= 1
+            if username != "anonymous":
+                state.level = min(self.userTokensPerMinute, state.level + refund)
+            if not any(state.inFlight.values()) and state.level >= self.userTokensPerMinute and \
+                    not any(key[0] == username for key in self.flows):
+                # an idle user with a full quota has nothing worth remembering
+                del self.users[username]
+                self.lastFinish.pop((username, "interactive"), None)
+                self.lastFinish.pop((username, "bulk"), None)
+        self.scheduleDispatch()
+
+    async def create(self, endpoint=None, **params):
+        username, priority = currentCaller.get()
+        cost = LLMGateway.estimateTokens(params)
+        await self.acquire(username, priority, cost)
+        try:
+            response = await self.backend.create(endpoint=endpoint, **params)
+        except BaseException:
+            self.release(username, priority)
+            raise
+        if params.get("stream"):
+            promptTokens = LLMGateway.estimateTokens(dict(params, max_tokens=0))
+            return self.releaseAfter(response, username, priority, cost, promptTokens)
+        usage = getattr(response, "usage", None)
+        self.release(username, priority, cost - usage.total_tokens if usage is not None else 0)
+        return response
+
+    async def releaseAfter(self, stream, username, priority, cost, promptTokens):
+        # a streamed call holds its slot until the stream ends, and is refunded with the usage of its last chunk or,
+        # when the stream does not report it (or ends early), with an estimate of what it streamed
+        used = None
+        characters = 0
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage is not None:
+                    used = usage.total_tokens
+                for choice in chunk.choices:
+                    characters += len(choice.delta.content or "")
+                yield chunk
+        finally:
+            self.release(username, priority, cost - (used if used is not None else promptTokens + characters // 4))
+
+    def idle(self, share=0.5):
+        # no call is waiting and at most `share` of the slots are taken, e.g. room for speculative work
+        with self.lock:
+            return not self.flows and sum(self.inFlight.values()) < self.maxConcurrent * share
+
+    def stats(self):
+        with self.lock:
+            queued = {"interactive": 0, "bulk": 0}
+            for (username, priority), flow in self.flows.items():
+                queued[priority] += len(flow)
+            return dict(self.counters, inFlight=dict(self.inFlight), queued=queued, users=len(self.users))
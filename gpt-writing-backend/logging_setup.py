@@ -0,0 +1,85 @@
+import sys
+import queue
+import atexit
+import reprlib
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# Logging of the backend. Every module logs to a child of the "visar" logger, the routes to "visar.routes.<route>"
+# so their level can be set one by one. Records are handed to a background thread through a bounded queue, so a
+# request never waits for stdout. Log calls pass their values as arguments (log.debug("request: %s", Payload(x))),
+# which are only formatted when the record is actually emitted.
+
+payloadRepr = reprlib.Repr()
+payloadRepr.maxlevel = 4
+payloadRepr.maxdict = 20
+payloadRepr.maxlist = 20
+payloadRepr.maxstring = 200
+payloadRepr.maxother = 200
+
+
+class Payload:
+    # A request payload, graph or response in a log message. Formatting it costs the same no matter how large the
+    # value is: nested containers and long strings are cut, with "..." where something was left out.
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if isinstance(self.value, str):
+            return self.value if len(self.value) <= payloadRepr.maxstring else self.value[:payloadRepr.maxstring] + "..."
+        return payloadRepr.repr(self.value)
+
+
+class TruncatingFormatter(logging.Formatter):
+    def __init__(self, fmt, maxLength):
+        super().__init__(fmt)
+        self.maxLength = maxLength
+
+    def format(self, record):
+        text = super().format(record)
+        if len(text) > self.maxLength:
+            return f"{text[:self.maxLength]}... ({len(text) - self.maxLength} more characters)"
+        return text
+
+
+class DroppingQueueHandler(QueueHandler):
+    # when the writer falls behind, records are dropped (and counted) rather than blocking the request
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {"pending": self.queue.qsize(), "dropped": self.dropped}
+
+
+def routeLogger(route):
+    return logging.getLogger(f"visar.routes.{route}")
+
+
+def setupLogging(level="INFO", routeLevels=None, maxMessageLength=2000, maxPending=10000, stream=None):
+    # send everything logged under "visar" through the queue to `stream` (stdout by default), returns the queue handler
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(TruncatingFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s", maxMessageLength))
+    records = queue.Queue(maxsize=maxPending)
+    listener = QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("visar")
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    queueHandler = DroppingQueueHandler(records)
+    logger.addHandler(queueHandler)
+    logger.setLevel(level)
+    logger.propagate = False
+    for route, routeLevel in (routeLevels or {}).items():
+        routeLogger(route).setLevel(routeLevel)
+    return queueHandler
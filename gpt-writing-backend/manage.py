@@ -0,0 +1,105 @@
+import sys
+import json
+import argparse
+from pymongo import MongoClient
+from draft_storage import migrateDrafts
+from mongo_indexes import ensureIndexes, indexReport, collectionScans
+from data_export import exportCollection, exportCollections, ExportError
+
+# Maintenance commands for the backend database, e.g. `python manage.py migrate-drafts --codec gzip`
+
+
+def connect():
+    with open('mongoDB_key.json') as key_file:
+        mongoDB_key = json.load(key_file)['key']
+    return MongoClient(mongoDB_key).gptwriting
+
+
+def migrate_drafts(db, args):
+    read, rewritten, skipped = migrateDrafts(db.drafts, codec=args.codec, decompress=args.decompress,
+                                             minBytes=args.min_bytes, batchSize=args.batch_size)
+    print(f"Migrated drafts: {rewritten} of {read} rewritten")
+    if skipped:
+        print(f"{skipped} drafts were saved during the migration and skipped, run it again to migrate them")
+    return 0
+
+
+def ensure_indexes(db, args):
+    failures = ensureIndexes(db)
+    print(f"Ensured indexes, {len(failures)} failed")
+    return 1 if failures else 0
+
+
+def check_indexes(db, args):
+    # fails when a required index is missing or a hot query would scan its whole collection
+    report = indexReport(db)
+    scans = collectionScans(db)
+    for name in report["missing"]:
+        print(f"missing index: {name}")
+    for name in report["unused"]:
+        print(f"unused index: {name}")
+    for name in report["unknown"]:
+        print(f"undeclared index: {name}")
+    for scan in scans:
+        print(f"collection scan: {scan['collection']} filtered by {', '.join(scan['filter'])}")
+    if report["missing"] or scans:
+        return 1
+    print("All hot queries are indexed")
+    return 0
+
+
+def export(db, args):
+    # e.g. `python manage.py export interactionData study.jsonl --username alice --since 2024-03-01`
+    filters = {"usernames": args.username, "sessionIds": args.session_id, "types": args.type,
+               "since": args.since, "until": args.until}
+    checkpoint = args.checkpoint or f"{args.output}.checkpoint"
+    try:
+        exported, total = exportCollection(db, args.collection, args.output, format=args.format, flat=args.flatten,
+                                           filters=filters, batchSize=args.batch_size, checkpoint=checkpoint,
+                                           restart=args.restart, rowsPerFile=args.rows_per_file)
+    except ExportError as e:
+        print(f"Export failed: {e}")
+        return 1
+    print(f"Exported {exported} documents of {args.collection} to {args.output}, {total} in total")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the VISAR backend")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-drafts", help="compress (or decompress) the sections of every stored draft")
+    migrate.add_argument("--codec", choices=["zstd", "gzip"], default="zstd")
+    migrate.add_argument("--decompress", action="store_true", help="store every section uncompressed again")
+    migrate.add_argument("--min-bytes", type=int, default=512, help="leave sections smaller than this uncompressed")
+    migrate.add_argument("--batch-size", type=int, default=100)
+    migrate.set_defaults(run=migrate_drafts)
+
+    ensure = commands.add_parser("ensure-indexes", help="create the indexes declared in mongo_indexes.py")
+    ensure.set_defaults(run=ensure_indexes)
+
+    check = commands.add_parser("check-indexes", help="report missing and unused indexes, fail if a hot query is a collection scan")
+    check.set_defaults(run=check_indexes)
+
+    exporter = commands.add_parser("export", help="stream interactionData or drafts to JSONL or Parquet for research analysis")
+    exporter.add_argument("collection", choices=exportCollections)
+    exporter.add_argument("output", help="JSONL file, or directory of Parquet files")
+    exporter.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl", help="parquet needs pyarrow")
+    exporter.add_argument("--flatten", action="store_true", help="write nested fields as dotted columns (always on for parquet)")
+    exporter.add_argument("--username", action="append", default=[], help="only these users, may be repeated")
+    exporter.add_argument("--session-id", action="append", default=[], help="only these sessions, may be repeated")
+    exporter.add_argument("--type", action="append", default=[], help="only these interaction types, may be repeated")
+    exporter.add_argument("--since", help="ISO 8601 time, inclusive")
+    exporter.add_argument("--until", help="ISO 8601 time, exclusive")
+    exporter.add_argument("--batch-size", type=int, default=1000)
+    exporter.add_argument("--rows-per-file", type=int, default=100000, help="rows per Parquet part file")
+    exporter.add_argument("--checkpoint", help="resume file, default <output>.checkpoint")
+    exporter.add_argument("--restart", action="store_true", help="ignore the checkpoint and export everything again")
+    exporter.set_defaults(run=export)
+
+    args = parser.parse_args(argv)
+    return args.run(connect(), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import math
+import threading
+
+# Minimal Prometheus instrumentation: counters, gauges and histograms with labels, registered in one process-wide
+# registry and rendered in the Prometheus text exposition format by exposition(), which GET /metrics serves.
+
+registry = []
+
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatLabels(names, values, extra=()):
+    pairs = [f'{name}="{escapeLabel(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def formatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> value
+        registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelNames):
+            raise ValueError(f"{self.name} expects the labels {self.labelNames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, self.labelNames, key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, labelNames, key, extra, value in self.samples():
+            lines.append(f"{name}{formatLabels(labelNames, key, extra)} {formatValue(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=defaultBuckets):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            series = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    samples.append((f"{self.name}_bucket", self.labelNames, key, (("le", formatValue(bound)),), count))
+                samples.append((f"{self.name}_sum", self.labelNames, key, (), series["sum"]))
+                samples.append((f"{self.name}_count", self.labelNames, key, (), series["count"]))
+        return samples
+
+
+def exposition():
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,98 @@
+import logging
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger("visar.indexes")
+
+# Indexes the backend relies on, per collection. Every hot lookup of server.py is covered by one of them.
+requiredIndexes = {
+    "users": [
+        {"name": "username_unique", "keys": [("username", 1)], "unique": True},
+    ],
+    "drafts": [
+        # the latest draft of a user, and the upsert key of /saveDraft
+        {"name": "username_sessionId_unique", "keys": [("username", 1), ("sessionId", 1)], "unique": True},
+    ],
+    "problemset": [
+        {"name": "id", "keys": [("id", 1)]},
+    ],
+    "interactionData": [
+        # research queries by user, by session and by time range within a session
+        {"name": "username_sessionId_timestamp", "keys": [("username", 1), ("sessionId", 1), ("timestamp", 1)]},
+    ],
+    "jobs": [
+        # background jobs (see jobs.py) are kept for a week after their last update
+        {"name": "updatedAt_ttl", "keys": [("updatedAt", 1)], "expireAfterSeconds": 7 * 24 * 3600},
+    ],
+    "jobResults": [
+        # the node results of a job, and the upsert key of a stored result
+        {"name": "jobId_node_unique", "keys": [("jobId", 1), ("node", 1)], "unique": True},
+        {"name": "updatedAt_ttl", "keys": [("updatedAt", 1)], "expireAfterSeconds": 7 * 24 * 3600},
+    ],
+}
+
+# Filters of the hot queries with representative values, their plans must not be collection scans
+hotQueries = [
+    ("users", {"username": "username"}),
+    ("drafts", {"username": "username", "sessionId": 0}),
+    ("problemset", {"id": 1}),
+    ("interactionData", {"username": "username", "sessionId": 0}),
+    ("jobResults", {"jobId": "jobId"}),
+]
+
+
+def ensureIndexes(db):
+    # Create every required index that does not exist yet. Creating an existing index is a no-op, so this is cheap
+    # to run on every startup. Returns the indexes that could not be created, e.g. a unique index over duplicates.
+    failures = []
+    for collection, indexes in requiredIndexes.items():
+        for index in indexes:
+            try:
+                options = {"expireAfterSeconds": index["expireAfterSeconds"]} if "expireAfterSeconds" in index else {}
+                db[collection].create_index(index["keys"], name=index["name"], unique=index.get("unique", False), **options)
+            except OperationFailure as e:
+                log.warning("could not create %s.%s: %s", collection, index["name"], e)
+                failures.append({"collection": collection, "index": index["name"], "error": str(e)})
+    return failures
+
+
+def indexReport(db):
+    # Compare the indexes of the database with the required ones: "missing" required indexes, "unused" indexes that
+    # have not served an operation since the server started, "unknown" indexes that are not declared here.
+    report = {"missing": [], "unused": [], "unknown": []}
+    for collection, indexes in requiredIndexes.items():
+        existing = db[collection].index_information()
+        required = {index["name"] for index in indexes}
+        for index in indexes:
+            if index["name"] not in existing:
+                report["missing"].append(f"{collection}.{index['name']}")
+        for name in existing:
+            if name != "_id_" and name not in required:
+                report["unknown"].append(f"{collection}.{name}")
+        try:
+            for stats in db[collection].aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection}.{stats['name']}")
+        except OperationFailure:
+            # $indexStats is not available on every deployment
+            pass
+    return report
+
+
+def planStages(plan):
+    stages = [plan.get("stage")]
+    for child in plan.get("inputStages", []) + [plan[key] for key in ("inputStage", "queryPlan") if key in plan]:
+        stages.extend(planStages(child))
+    # sharded clusters report one winning plan per shard
+    for shard in plan.get("shards", []):
+        stages.extend(planStages(shard.get("winningPlan", {})))
+    return stages
+
+
+def collectionScans(db):
+    # returns the hot queries whose winning plan contains a collection scan
+    scans = []
+    for collection, filter in hotQueries:
+        explain = db.command("explain", {"find": collection, "filter": filter}, verbosity="queryPlanner")
+        if "COLLSCAN" in planStages(explain["queryPlanner"]["winningPlan"]):
+            scans.append({"collection": collection, "filter": list(filter.keys())})
+    return scans
@@ -0,0 +1,51 @@
+import threading
+from pymongo import monitoring
+from metrics import Counter, Gauge, Histogram
+
+mongoOperationSeconds = Histogram("visar_mongo_operation_seconds", "Duration of the MongoDB commands", ["collection", "operation"],
+                                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+mongoOperationErrors = Counter("visar_mongo_operation_errors_total", "Failed MongoDB commands", ["collection", "operation"])
+mongoOperationsInFlight = Gauge("visar_mongo_operations_in_flight", "MongoDB commands waiting for their reply", ["collection", "operation"])
+
+
+class CommandMetrics(monitoring.CommandListener):
+    '''
+    Times every command the client sends, pass it to MongoClient(event_listeners=[...]).
+
+    Only the started event carries the command, so the collection is remembered by request id until the command
+    succeeds or fails.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # (connection, request id) -> (collection, operation)
+
+    @staticmethod
+    def collectionOf(event):
+        if event.command_name == "getMore":
+            return event.command.get("collection", "-")
+        target = event.command.get(event.command_name)
+        return target if isinstance(target, str) else "-"
+
+    def started(self, event):
+        labels = (self.collectionOf(event), event.command_name)
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = labels
+        mongoOperationsInFlight.inc(collection=labels[0], operation=labels[1])
+
+    def finish(self, event):
+        with self.lock:
+            labels = self.pending.pop((event.connection_id, event.request_id), None)
+        if labels is None:
+            return None
+        mongoOperationsInFlight.dec(collection=labels[0], operation=labels[1])
+        mongoOperationSeconds.observe(event.duration_micros / 1e6, collection=labels[0], operation=labels[1])
+        return labels
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        labels = self.finish(event)
+        if labels is not None:
+            mongoOperationErrors.inc(collection=labels[0], operation=labels[1])
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict
+from llm_gateway import TokenBucket
+from llm_scheduler import currentCaller
+
+log = logging.getLogger("visar.prefetch")
+
+
+class Prefetcher:
+    '''
+    Speculative work in the background, e.g. the discussion points of the keywords /keyword just returned, so the
+    /prompts request that usually follows is answered from the cache.
+
+    A prefetch is a list of (estimated tokens, coroutine function) items run at most `concurrency` at a time. An item
+    only starts while `isIdle(tokens)` says there is spare capacity and while the speculation budget of
+    `tokensPerMinute` has room for it, the rest of the prefetch is dropped otherwise: speculation never queues in
+    front of real requests and never spends more than its budget.
+
+    Prefetches are keyed by (username, text). Starting one cancels the earlier ones of the same user (who moved on),
+    cancel() drops one whose results are no longer needed, and at most `maxPending` run at a time, the oldest is
+    cancelled beyond that. The calls are made as bulk work of the user.
+    '''
+
+    def __init__(self, tokensPerMinute, isIdle, concurrency=2, maxPending=32):
+        self.budget = TokenBucket(tokensPerMinute)
+        self.isIdle = isIdle
+        self.concurrency = concurrency
+        self.maxPending = maxPending
+        self.tasks = OrderedDict()  # (username, text) -> task
+        self.counters = {"started": 0, "items": 0, "failed": 0, "skippedBusy": 0, "skippedBudget": 0, "cancelled": 0}
+
+    def start(self, username, text, items):
+        # must be called on the event loop the items run on
+        key = (username, text)
+        if username != "anonymous":
+            for other in [other for other in self.tasks if other[0] == username and other != key]:
+                self.cancel(*other)
+        if key in self.tasks:
+            return
+        while len(self.tasks) >= self.maxPending:
+            self.cancel(*next(iter(self.tasks)))
+        # the prefetch outlives the request, it must not run in the request's context (e.g. its trace)
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task, self.run(username, items))
+        self.tasks[key] = task
+        task.add_done_callback(lambda _: self.tasks.pop(key, None) if self.tasks.get(key) is task else None)
+        self.counters["started"] += 1
+
+    def cancel(self, username, text):
+        task = self.tasks.pop((username, text), None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.counters["cancelled"] += 1
+
+    def tryReserve(self, tokens):
+        # take the tokens out of the speculation budget only if they are there, speculation never goes into debt
+        if self.budget.reserve(tokens) > 0:
+            self.budget.refund(tokens)
+            return False
+        return True
+
+    async def run(self, username, items):
+        currentCaller.set((username, "bulk"))
+        pending = list(items)
+        running = set()
+        try:
+            while pending or running:
+                while pending and len(running) < self.concurrency:
+                    tokens, function = pending[0]
+                    if not self.isIdle(tokens):
+                        self.counters["skippedBusy"] += len(pending)
+                        pending = []
+                    elif not self.tryReserve(tokens):
+                        self.counters["skippedBudget"] += len(pending)
+                        pending = []
+                    else:
+                        pending.pop(0)
+                        running.add(asyncio.ensure_future(function()))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    self.counters["items"] += 1
+                    if task.exception() is not None:
+                        self.counters["failed"] += 1
+                        log.info("prefetch failed: %s", task.exception())
+        finally:
+            for task in running:
+                task.cancel()
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.tasks))
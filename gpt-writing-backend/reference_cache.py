@@ -0,0 +1,51 @@
+import time
+import threading
+
+
+class ReadThroughCache:
+    '''
+    In-process read-through cache for reference data that almost never changes, e.g. the problem set.
+
+    get() returns the cached value or calls `loader(key)` on a miss. Entries live until they are invalidated
+    explicitly or, when `ttl` is set, until they are `ttl` seconds old. Missing values (None) are cached as well.
+    A value whose key was invalidated while it was being loaded is returned but not cached, it may be stale.
+    '''
+
+    def __init__(self, loader, ttl=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (loadedAt, value)
+        self.generations = {}  # key -> number of invalidations of the key
+        self.generation = 0  # number of invalidations of everything
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or time.time() - entry[0] < self.ttl):
+                self.counters["hits"] += 1
+                return entry[1]
+            self.counters["misses"] += 1
+            generation = (self.generation, self.generations.get(key, 0))
+        # load outside the lock, two concurrent misses of the same key simply load it twice
+        value = self.loader(key)
+        with self.lock:
+            if generation == (self.generation, self.generations.get(key, 0)):
+                self.entries[key] = (time.time(), value)
+        return value
+
+    def invalidate(self, key=None):
+        # drop one entry, or everything when no key is given
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.generation += 1
+            else:
+                self.entries.pop(key, None)
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
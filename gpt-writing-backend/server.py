@@ -1,10 +1,39 @@
 import re
 import os
 import json
-from openai import OpenAI
-from flask import Flask, redirect, render_template, request, url_for, make_response, jsonify
+import time
+import threading
+import asyncio
+import signal
+import sys
+import hmac
+import logging
+from datetime import datetime, timezone
+from collections import deque
+from flask import Flask, redirect, render_template, request, url_for, make_response, jsonify, Response, stream_with_context, g
 from flask_cors import CORS, cross_origin
-from pymongo import MongoClient
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from completion_cache import CompletionCache
+from similarity_cache import SimilarityCache
+from interaction_logger import BufferedWriter
+from draft_storage import draftSections, sectionHash, encodeSection, decodeDraft
+from mongo_indexes import ensureIndexes
+from reference_cache import ReadThroughCache
+from llm_gateway import LLMGateway
+from llm_replay import FixtureStore, ReplayBackend
+from llm_scheduler import FairScheduler, currentCaller, runAs
+from single_flight import SingleFlight
+from prefetch import Prefetcher
+from metrics import Counter, Gauge, Histogram, exposition
+from mongo_metrics import CommandMetrics
+from tracing import Tracer, MongoCommandSpans
+from logging_setup import setupLogging, routeLogger, Payload
+from dep_graph import DependencyGraph, DependencyGraphError
+from jobs import JobRunner
+from data_export import exportQuery, exportBatches, exportRow, jsonLine, ExportError
 
 app = Flask(__name__)
 cors = CORS(app)
@@ -14,23 +43,130 @@ model_type = "gpt-3.5-turbo"
 tempature = 0.6
 max_tokens = 2048
 enablePreload = True # enable the preload of editor state, editor node, and flow node
-test = False
+depGraphConcurrency = 8 # maximum number of parallel LLM calls when generating one level of the dependency graph
+sketchConcurrency = 8 # maximum number of keywords /generateFromSketch generates at the same time
+llmMode = "live" # "live", "record" (call OpenAI and also write every completion to llmFixturesPath) or "replay" (serve the recorded completions, OpenAI is never called), see llm_replay.py
+llmFixturesPath = "llm_fixtures.jsonl" # fixture store of the record and replay modes
+replayTiming = "observed" # "observed" replays every completion after the latency it had when it was recorded, "instant" right away
+enableCompletionCache = True # reuse the results of identical chat completion requests (see completion_cache.py)
+completionCacheTTL = 7 * 24 * 3600 # seconds before a cached completion expires
+completionCacheMemoryEntries = 1024 # size of the in-memory LRU tier
+completionCacheDiskEntries = 100000 # size of the on-disk SQLite tier
+cacheDisabledEndpoints = {"rewrite"} # endpoints that sample on purpose (e.g. n=8 candidates) and must not be served from the cache
+enableSimilarityCache = True # serve the /keyword and /prompts results of earlier, similarly worded requests (see similarity_cache.py)
+similarityThreshold = 0.7 # cosine similarity of two prompts above which a result is reused, prompts with the same content words score 1 (README.md)
+similarityCacheEntries = 2000 # prompts remembered per route
+similarityAuditRate = 0.05 # share of the reused results that are also generated fresh to measure false reuse
+enablePrefetch = True # after /keyword, generate the discussion points of the returned keywords in the background while the LLM is idle, so /prompts is answered from the cache
+prefetchTokenShare = 0.2 # share of llmTokensPerMinute the prefetches may spend
+prefetchConcurrency = 2 # parallel LLM calls of one prefetch
+enableSingleFlight = True # identical concurrent chat completion requests share one upstream call (see single_flight.py), except for cacheDisabledEndpoints
+enableStreaming = True # allow the paragraph-generating routes to stream tokens as server-sent events
+promptsMode = "parallel" # how /prompts queries the keywords: "serial", "parallel" (one request per keyword) or "batched" (one request for all)
+promptsConcurrency = 8 # maximum number of parallel requests of /prompts in "parallel" mode
+enableWriteBehindLogging = True # acknowledge interaction data right away and insert it in batches (see interaction_logger.py)
+interactionLogBatchSize = 200 # insert pending interaction data once this many events are queued
+interactionLogFlushInterval = 1.0 # or once the oldest queued event is this many seconds old
+interactionLogMaxPending = 10000 # events queued beyond this are rejected with 503 until the writer catches up
+interactionLogSpillPath = "interaction_spill.jsonl" # events that could not be inserted are kept here and inserted again once MongoDB takes writes
+adminToken = None # token of POST /invalidateProblemCache, sent as "Authorization: Bearer <token>". The route is disabled while None
+exportToken = None # token of GET /export/<collection> for research analysis, sent as "Authorization: Bearer <token>". The route is disabled while None
+compressDrafts = False # store large draft sections compressed (see draft_storage.py), existing drafts can be converted with `python manage.py migrate-drafts`
+draftCodec = "zstd" # "zstd" (needs the zstandard package, falls back to gzip) or "gzip"
+draftCompressMinBytes = 512 # sections smaller than this are always stored as they are
+problemCacheTTL = 3600 # seconds a cached problem set entry is trusted, POST /invalidateProblemCache drops it earlier
+llmTimeout = 60 # seconds an LLM call may take, including the time it is queued and retried
+llmMaxRetries = 4 # retries of an LLM call on 429, 5xx, timeouts and connection errors, with jittered exponential backoff
+llmRequestsPerMinute = 3500 # client-side request budget, calls beyond it are queued (match the RPM limit of the OpenAI account)
+llmTokensPerMinute = 90000 # client-side token budget, calls beyond it are queued (match the TPM limit of the OpenAI account)
+llmMaxConnections = 64 # size of the HTTP connection pool to OpenAI
+llmMaxConcurrent = 48 # LLM calls running at the same time, the others wait in the fair scheduler (see llm_scheduler.py)
+llmInteractiveReserve = 16 # of llmMaxConcurrent, kept for interactive calls so bulk generations cannot take them all
+llmUserConcurrency = 6 # LLM calls of one user running at the same time, per priority class
+llmUserTokensPerMinute = 30000 # estimated tokens one user may spend per minute before the other users go first
+llmBulkRoutes = {"/generateFromDepGraph", "/generateFromSketch"} # routes whose LLM calls are bulk work, the calls of every other route are interactive
+enableTracing = False # record a span tree of sampled requests to traceFile, see tracing.py
+traceSampleRate = 0.1 # share of the requests that are traced, a request with the header "X-Trace: 1" always is
+traceFile = "traces.json" # Chrome trace event format, open it in ui.perfetto.dev or chrome://tracing
+profileSlowRequests = False # run a sampling profiler while traced requests run and keep the profiles of the slow ones
+slowRequestSeconds = 10 # traced requests slower than this get their profile written to profileDirectory (folded stacks)
+profileDirectory = "profiles"
+jobWorkers = 4 # background jobs (POST /jobs/<kind>) that run at the same time, the others are queued
+jobMaxQueued = 100 # jobs queued beyond the running ones, more are rejected with 503
+logLevel = "INFO" # level of the backend logs, "DEBUG" also logs the request payloads, prompts and completions
+routeLogLevels = {} # levels of single routes, e.g. {"generateFromDepGraph": "DEBUG"}
+logMaxMessageLength = 2000 # longer log messages are cut
+ensureIndexesOnStartup = True # create the indexes declared in mongo_indexes.py when the server starts, check them with `python manage.py check-indexes`
+
+logQueue = setupLogging(logLevel, routeLogLevels, logMaxMessageLength)
+log = logging.getLogger("visar")
 
 with open('openai_key.json') as key_file:
-    OpenAIClient = OpenAI(api_key=json.load(key_file)['key'])
+    openai_key = json.load(key_file)['key']
+
+# every call to OpenAI goes through the gateway (see llm_gateway.py)
+llmGateway = LLMGateway(openai_key, requestsPerMinute=llmRequestsPerMinute, tokensPerMinute=llmTokensPerMinute,
+                        timeout=llmTimeout, maxRetries=llmMaxRetries, maxConnections=llmMaxConnections)
+# where the completions come from, the gateway itself unless completions are recorded or replayed
+llmBackend = llmGateway if llmMode == "live" else ReplayBackend(llmGateway, FixtureStore(llmFixturesPath), llmMode, replayTiming)
+# the order in which the calls of the different users and priority classes reach the backend
+llmScheduler = FairScheduler(llmBackend, maxConcurrent=llmMaxConcurrent, interactiveReserve=llmInteractiveReserve,
+                             userConcurrency=llmUserConcurrency, userTokensPerMinute=llmUserTokensPerMinute)
 
 with open('mongoDB_key.json') as key_file:
     mongoDB_key = json.load(key_file)['key']
 
+tracer = Tracer(traceFile, traceSampleRate, enabled=enableTracing,
+                profileSlowSeconds=slowRequestSeconds if profileSlowRequests else None, profileDirectory=profileDirectory)
+
 # Update your mongoDB key here. You need to create a new mongoDB database called "gptwriting", and create collections called "users" and "interactionData" in the database.
 try:
-    client = MongoClient(mongoDB_key)
+    client = MongoClient(mongoDB_key, event_listeners=[CommandMetrics(), MongoCommandSpans(tracer)])
     db = client.gptwriting
-    print("Successfully connect to mongoDB")
+    log.info("Successfully connect to mongoDB")
 except:
-    print("fail to connect to mongoDB")
+    log.exception("fail to connect to mongoDB")
+
+if ensureIndexesOnStartup:
+    try:
+        ensureIndexes(db)
+    except Exception as e:
+        log.warning("fail to ensure the mongoDB indexes: %s", e)
+
+# long generations submitted as background jobs, their node results are stored so a retry resumes them
+jobRunner = JobRunner(db.jobs, db.jobResults, workers=jobWorkers, maxQueued=jobMaxQueued)
+
+interactionLogWriter = BufferedWriter(db.interactionData, batchSize=interactionLogBatchSize,
+                                      flushInterval=interactionLogFlushInterval, maxPending=interactionLogMaxPending,
+                                      spillPath=interactionLogSpillPath)
+
+# the only draft fields sent back to the client when it loads a draft
+preloadProjection = {"_id": 0, "editorState": 1, "flowSlice": 1, "editorSlice": 1, "version": 1, "sectionHashes": 1}
+
+# problem set documents by id, they only change when the study is set up
+problemCache = ReadThroughCache(
+    lambda topicId: db.problemset.find_one({"id": topicId}, {"_id": 0, "topic": 1, "description": 1}), ttl=problemCacheTTL)
+
+completionCache = CompletionCache("completion_cache.sqlite3", memoryEntries=completionCacheMemoryEntries,
+                                  diskEntries=completionCacheDiskEntries, ttl=completionCacheTTL)
+
+# speculative discussion points, only while the scheduler has spare slots and the gateway budget would not queue them
+prefetcher = Prefetcher(llmTokensPerMinute * prefetchTokenShare,
+                        lambda tokens: llmScheduler.idle() and llmGateway.tokenBudget.level >= tokens,
+                        concurrency=prefetchConcurrency)
+
+similarityCache = SimilarityCache(threshold=similarityThreshold, capacity=similarityCacheEntries, ttl=completionCacheTTL,
+                                  auditRate=similarityAuditRate)
+
+
+
+def draftState(state):
+    # the editor sections of a stored draft as the client loads them, a section the draft does not have is empty
+    return {field: state.get(field, "") for field in ("editorState", "flowSlice", "editorSlice")}
 
 
+signupLog = routeLogger("signup")
+
 
 @app.route("/signup", methods=["POST"])
 def signup():
@@ -39,24 +175,36 @@ def signup():
         username = response["username"]
         #password = response["password"]
         condition = response["condition"]
-        print(f"username: {username}")
-        user = db.users.find_one({"username": username})
-        if user is not None:
+        signupLog.debug("username: %s", username)
+
+        def existingUser(user):
             # there is no login, but "sign up" at this time
             if enablePreload:
                 # get the states from drafe collections
-                state = db.drafts.find_one({"username": username, "sessionId": user["latestSessionId"]})
+                state = decodeDraft(db.drafts.find_one({"username": username, "sessionId": user["latestSessionId"]}, preloadProjection))
                 if state is None:
                     return jsonify({"status": "success", "message": "Login successfully", "preload": False, "editorState": "", "flowSlice": "", "editorSlice": "", "taskProblem": "", "taskDescription": ""})
-                return jsonify({"status": "success", "message": "Login successfully", "preload": True, "editorState": state["editorState"], "flowSlice": state["flowSlice"], "editorSlice": state["editorSlice"], "taskProblem": "", "taskDescription": ""})
+                return jsonify({"status": "success", "message": "Login successfully", "preload": True, **draftState(state), "taskProblem": "", "taskDescription": ""})
             # return existing user
             return jsonify({"status": "success", "message": "Login successfully", "preload": False, "editorState": "", "flowSlice": "", "editorSlice": "", "taskProblem": "", "taskDescription": ""})
+
+        user = db.users.find_one({"username": username})
+        if user is not None:
+            return existingUser(user)
         #db.users.insert_one({"username": username, "password": password, "condition": condition, "latestSessionId": -1, "condTopicMapping": {"1": 1, "2": 2, "3": 3, "4": 4, "5": 5}})
-        db.users.insert_one({"username": username, "condition": condition, "latestSessionId": -1, "condTopicMapping": {"1": 1, "2": 2, "3": 3, "4": 4, "5": 5}})
-        print("Signup successfully")
+        try:
+            db.users.insert_one({"username": username, "condition": condition, "latestSessionId": -1, "condTopicMapping": {"1": 1, "2": 2, "3": 3, "4": 4, "5": 5}})
+        except DuplicateKeyError:
+            # a concurrent signup of the same username inserted it first (see username_unique in mongo_indexes.py)
+            signupLog.info("Signup raced with another one: %s", username)
+            return existingUser(db.users.find_one({"username": username}))
+        signupLog.info("Signup successfully: %s", username)
         return jsonify({"status": "success", "message": "Login successfully", "preload": False, "editorState": "", "flowSlice": "", "editorSlice": "", "taskProblem": "", "taskDescription": ""})
 
 # Only for user logging purpose
+loginLog = routeLogger("login")
+
+
 @app.route("/login", methods=["POST"])
 def login():
     if request.method == "POST":
@@ -64,40 +212,143 @@ def login():
         username = response["username"]
         password = response["password"]
         condition = response["condition"]
-        print(f"username: {username}, password: {password}")
+        loginLog.debug("username: %s", username)
         user = db.users.find_one({"username": username})
         if user is None:
-            print("User not found")
+            loginLog.info("User not found: %s", username)
             return jsonify({"status": "fail", "message": "User not found"})
         if user["password"] != password:
-            print("Password incorrect")
+            loginLog.info("Password incorrect: %s", username)
             return jsonify({"status": "fail", "message": "Password incorrect"})
-        print("Login successfully")
+        loginLog.info("Login successfully: %s", username)
         # load state from database
 
         topicId = user["condTopicMapping"][condition]
 
-        problem = db.problemset.find_one({"id": topicId})
+        problem = problemCache.get(topicId)
 
         if user["latestSessionId"] != -1 and enablePreload:
-            state = db.drafts.find_one(
-                {"username": username, "sessionId": user["latestSessionId"]})
-            return jsonify({"status": "success", "message": "Login successfully", "preload": True, "editorState": state["editorState"], "flowSlice": state["flowSlice"], "editorSlice": state["editorSlice"], "taskProblem": problem["topic"], "taskDescription": problem["description"]})
+            state = decodeDraft(db.drafts.find_one(
+                {"username": username, "sessionId": user["latestSessionId"]}, preloadProjection))
+            return jsonify({"status": "success", "message": "Login successfully", "preload": True, **draftState(state), "taskProblem": problem["topic"], "taskDescription": problem["description"]})
         else:
             return jsonify({"status": "success", "message": "Login successfully", "preload": False, "editorState": "", "flowSlice": "", "editorSlice": "", "taskProblem": problem["topic"], "taskDescription": problem["description"]})
 
+# Everything the client needs after logging in, in one request: the user, the task problem and the latest draft.
+# The user and the draft come from a single aggregation, the problem from the in-process problem cache.
+bootstrapLog = routeLogger("bootstrap")
+
+
+@app.route("/bootstrap", methods=["POST"])
+def bootstrap():
+    if request.method == "POST":
+        response = request.get_json()
+        username = response["username"]
+        condition = response["condition"]
+
+        pipeline = [
+            {"$match": {"username": username}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "username": 1, "password": 1, "condition": 1, "latestSessionId": 1, "condTopicMapping": 1}},
+        ]
+        if enablePreload:
+            pipeline.append({"$lookup": {
+                "from": "drafts",
+                "let": {"sessionId": "$latestSessionId"},
+                "pipeline": [
+                    {"$match": {"username": username, "$expr": {"$eq": ["$sessionId", "$$sessionId"]}}},
+                    {"$limit": 1},
+                    {"$project": preloadProjection},
+                ],
+                "as": "drafts",
+            }})
+        user = next(db.users.aggregate(pipeline), None)
+
+        if user is None:
+            bootstrapLog.info("User not found: %s", username)
+            return jsonify({"status": "fail", "message": "User not found"})
+        if user.get("password") is None or user["password"] != response.get("password"):
+            bootstrapLog.info("Password incorrect: %s", username)
+            return jsonify({"status": "fail", "message": "Password incorrect"})
+
+        problem = None
+        topicId = user.get("condTopicMapping", {}).get(condition)
+        if topicId is not None:
+            problem = problemCache.get(topicId)
+
+        res = {
+            "status": "success",
+            "message": "Login successfully",
+            "user": {"username": user["username"], "condition": user.get("condition"), "latestSessionId": user["latestSessionId"]},
+            "taskProblem": problem["topic"] if problem is not None else "",
+            "taskDescription": problem["description"] if problem is not None else "",
+            "preload": False,
+            "editorState": "",
+            "flowSlice": "",
+            "editorSlice": "",
+        }
+        drafts = user.get("drafts", [])
+        if len(drafts) > 0:
+            state = decodeDraft(drafts[0])
+            res.update({"preload": True, **draftState(state),
+                        "version": state.get("version", 0), "sectionHashes": state.get("sectionHashes", {})})
+        return jsonify(res)
+
+def hasBearerToken(token):
+    # the request carries "Authorization: Bearer <token>", always False while the token is not configured
+    return token is not None and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")
+
+
+# drop cached problem set entries after the problemset collection was edited: {"id": topic id} or {} for all
+@app.route("/invalidateProblemCache", methods=["POST"])
+def invalidateProblemCache():
+    if request.method == "POST":
+        if not hasBearerToken(adminToken):
+            return jsonify({"status": "fail", "message": "Invalidating the problem cache is not allowed"}), 403
+        response = request.get_json(silent=True) or {}
+        problemCache.invalidate(response.get("id"))
+        return jsonify({"status": "success", "message": "Problem cache invalidated"})
+
+def interactionDocument(event):
+    username = event["username"]
+    sessionId = event["sessionId"]
+    type = event["type"]
+    interactionData = event["interactionData"]
+    # the time the server received the event, the document itself may be inserted a little later
+    return {"username": username, "sessionId": sessionId, "type": type, "interactionData": interactionData, "timestamp": datetime.now(timezone.utc)}
+
+
 @app.route("/logInteractionData", methods=["POST"])
 def logInteractionData():
     if request.method == "POST":
         response = request.get_json()
-        username = response["username"]
-        sessionId = response["sessionId"]
-        type = response["type"]
-        interactionData = response["interactionData"]
-        db.interactionData.insert_one(
-            {"username": username, "sessionId": sessionId, "type": type, "interactionData": interactionData})
+        document = interactionDocument(response)
+        if not enableWriteBehindLogging:
+            db.interactionData.insert_one(document)
+        elif not interactionLogWriter.add(document):
+            return jsonify({"status": "fail", "message": "Interaction data queue is full, please retry later"}), 503
         return jsonify({"status": "success", "message": "Interaction data logged successfully"})
 
+# log several interaction events in one request: {"events": [{"username", "sessionId", "type", "interactionData"}, ...]}
+@app.route("/logInteractionDataBatch", methods=["POST"])
+def logInteractionDataBatch():
+    if request.method == "POST":
+        response = request.get_json()
+        documents = [interactionDocument(event) for event in response["events"]]
+        if len(documents) == 0:
+            return jsonify({"status": "success", "message": "Interaction data logged successfully", "accepted": 0})
+        if not enableWriteBehindLogging:
+            db.interactionData.insert_many(documents)
+            accepted = len(documents)
+        else:
+            accepted = interactionLogWriter.addMany(documents)
+        if accepted < len(documents):
+            return jsonify({"status": "fail", "message": "Interaction data queue is full, please retry the remaining events later", "accepted": accepted}), 503
+        return jsonify({"status": "success", "message": "Interaction data logged successfully", "accepted": accepted})
+
+loadDraftLog = routeLogger("loadDraft")
+
+
 @app.route("/loadDraft", methods=["POST"])
 def loadDraft():
     if request.method == "POST":
@@ -106,66 +357,439 @@ def loadDraft():
         user = db.users.find_one({"username": username})
         if user is not None:
             sessionId = user["latestSessionId"]
-            state = db.drafts.find_one(
-                {"username": username, "sessionId": sessionId})
+            state = decodeDraft(db.drafts.find_one(
+                {"username": username, "sessionId": sessionId}, preloadProjection))
             if state is None:
-                print("Draft not found")
+                loadDraftLog.info("Draft not found: %s", username)
                 return jsonify({"status": "fail", "message": "Draft not found"})
-            print("Draft loaded successfully")
-            return jsonify({"status": "success", "message": "Draft loaded successfully", "editorState": state["editorState"], "flowSlice": state["flowSlice"], "editorSlice": state["editorSlice"]})
+            loadDraftLog.debug("Draft loaded successfully: %s", username)
+            return jsonify({"status": "success", "message": "Draft loaded successfully", **draftState(state), "version": state.get("version", 0), "sectionHashes": state.get("sectionHashes", {})})
         else:
-            print("User not found")
+            loadDraftLog.info("User not found: %s", username)
             return jsonify({"status": "fail", "message": "User not found"})
 
+def saveDraftSections(username, sessionId, condition, sections, baseVersion=None):
+    # Save the given sections of a draft with $set, skipping the sections whose hash did not change. Every write
+    # increments the version of the draft. When baseVersion is given and the stored draft has moved on since, nothing
+    # is written. Saves without baseVersion (the full saves of the current client) are last-writer-wins and never
+    # conflict. A new draft must get every section. Returns (status, version, sectionHashes, saved) where status is
+    # "saved", "unchanged", "conflict" or "incomplete".
+    current = db.drafts.find_one({"username": username, "sessionId": sessionId},
+                                 {"version": 1, "sectionHashes": 1, "condition": 1})
+    currentVersion = current.get("version", 0) if current is not None else 0
+    currentHashes = current.get("sectionHashes", {}) if current is not None else {}
+    if baseVersion is not None and baseVersion != currentVersion:
+        return "conflict", currentVersion, currentHashes, []
+    if current is None and any(field not in sections for field in draftSections):
+        return "incomplete", currentVersion, currentHashes, []
+
+    changes = {}
+    hashes = {}
+    for field, value in sections.items():
+        valueHash = sectionHash(value)
+        if currentHashes.get(field) != valueHash:
+            changes[field] = encodeSection(value, draftCodec, draftCompressMinBytes) if compressDrafts else value
+            hashes[f"sectionHashes.{field}"] = valueHash
+    if current is None or current.get("condition") != condition:
+        changes["condition"] = condition
+    if len(changes) == 0:
+        return "unchanged", currentVersion, currentHashes, []
+
+    draftFilter = {"username": username, "sessionId": sessionId}
+    if baseVersion is not None:
+        # compare-and-set: drafts saved before versioning have no version field, which counts as version 0
+        draftFilter["version"] = currentVersion if currentVersion > 0 else {"$exists": False}
+
+    def update(upsert):
+        return db.drafts.find_one_and_update(
+            draftFilter,
+            {"$set": {**changes, **hashes}, "$inc": {"version": 1}},
+            projection={"version": 1, "sectionHashes": 1},
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER)
+
+    try:
+        updated = update(upsert=current is None)
+    except DuplicateKeyError:
+        # the first save of the draft raced with another one, a full save still wins by updating what was inserted
+        updated = update(upsert=False) if baseVersion is None else None
+    if updated is None:
+        # another save of the same draft got in between
+        latest = db.drafts.find_one({"username": username, "sessionId": sessionId}, {"version": 1, "sectionHashes": 1})
+        return "conflict", latest.get("version", 0), latest.get("sectionHashes", {}), []
+
+    db.users.update_one({"username": username}, { "$set": { "latestSessionId" : sessionId  }})
+    return "saved", updated["version"], updated["sectionHashes"], [field for field in changes if field in draftSections]
+
+
+# Saving a draft. Clients either send every section as before, or use the versioned protocol:
+# {"username", "sessionId", "condition", "baseVersion": version of the last save, "sections": {only the changed sections}}
+# Both only write the sections whose hash changed. A versioned save based on an outdated version is rejected with 409,
+# a full save never is: the last one wins.
+saveDraftLog = routeLogger("saveDraft")
+
+
 @app.route("/saveDraft", methods=["POST"])
 def saveDraft():
     if request.method == "POST":
         response = request.get_json()
         username = response["username"]
         sessionId = response["sessionId"]
-        draft = response["draft"]
-        depGraph = response["depGraph"]
-        editorState = response["editorState"]
-        flowSlice = response["flowSlice"]
-        editorSlice = response["editorSlice"]
         condition = response["condition"]
         # depGraph = json.loads(response["depGraph"])
 
-        db.drafts.replace_one({"username": username, "sessionId": sessionId}, {
-                              "username": username, "sessionId": sessionId, "draft": draft, "condition": condition, "depGraph": depGraph, "editorState": editorState, "flowSlice": flowSlice, "editorSlice": editorSlice}, upsert=True)
+        if "baseVersion" in response:
+            baseVersion = response["baseVersion"]
+            sections = {field: value for field, value in response["sections"].items() if field in draftSections}
+        else:
+            baseVersion = None
+            sections = {field: response[field] for field in draftSections}
+
+        status, version, hashes, saved = saveDraftSections(username, sessionId, condition, sections, baseVersion)
+
+        if status == "incomplete":
+            return jsonify({"status": "fail", "message": f"The first save of a draft needs every section: {', '.join(draftSections)}"}), 400
+        if status == "conflict":
+            saveDraftLog.info("Draft conflict: base version %s, stored version %s", baseVersion, version)
+            return jsonify({"status": "conflict", "message": "Draft has been saved from another place, reload it before saving", "version": version, "sectionHashes": hashes}), 409
+        if status == "unchanged":
+            return jsonify({"status": "success", "message": "Draft unchanged", "version": version, "sectionHashes": hashes, "saved": saved})
+        return jsonify({"status": "success", "message": "Draft saved successfully", "version": version, "sectionHashes": hashes, "saved": saved})
+
+
+# Streaming export of interactionData or drafts as JSON lines, with the filters of `python manage.py export`:
+# ?username=&sessionId=&type= (each may be repeated), since= and until= (ISO 8601), flatten=1 for dotted columns.
+# Documents come in _id order, a client that lost the connection continues with after=<_id of the last line>.
+@app.route("/export/<collection>", methods=["GET"])
+def exportData(collection):
+    if not hasBearerToken(exportToken):
+        return jsonify({"status": "fail", "message": "Export is not allowed"}), 403
+    try:
+        query = exportQuery(collection, usernames=request.args.getlist("username"), sessionIds=request.args.getlist("sessionId"),
+                            types=request.args.getlist("type"), since=request.args.get("since"), until=request.args.get("until"),
+                            after=request.args.get("after"))
+    except ExportError as e:
+        return jsonify({"status": "fail", "message": str(e)}), 400
+    flat = request.args.get("flatten") in ("1", "true")
+    g.metricsStreaming = True
+
+    def lines():
+        try:
+            for batch in exportBatches(db[collection], query, batchSize=1000):
+                yield "".join(jsonLine(exportRow(collection, document, flat)) for document in batch)
+        finally:
+            finishRequestMetrics()
+
+    return Response(stream_with_context(lines()), mimetype="application/x-ndjson")
+
+
+# Every LLM call of the server goes through the gateway on an event loop. The Flask worker threads hand
+# the route handlers over to a background loop and wait for their result (see flaskResponse), while asgi_server.py
+# runs the very same handlers on its own event loop.
+llmLoop = None
+llmLoopLock = threading.Lock()
+
+
+def runOnLoop(coroutine):
+    global llmLoop
+    with llmLoopLock:
+        if llmLoop is None:
+            llmLoop = asyncio.new_event_loop()
+            threading.Thread(target=llmLoop.run_forever, name="llmLoop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, llmLoop).result()
+
+
+def iterateOnLoop(asyncIterator):
+    # iterate an async generator of the LLM loop from a Flask worker thread
+    while True:
+        try:
+            yield runOnLoop(asyncIterator.__anext__())
+        except StopAsyncIteration:
+            return
+
+
+async def gatherBounded(coroutines, limit):
+    # run the coroutines concurrently, at most `limit` at a time, and return their results in order
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+
+singleFlight = SingleFlight()
+
+
+async def chatCompletion(messages, endpoint, n=1):
+    # every chat completion request goes through here, returns the content of each returned choice
+    useCache = enableCompletionCache and endpoint not in cacheDisabledEndpoints
+    key = CompletionCache.makeKey(model_type, messages, tempature, n, max_tokens)
+    if useCache:
+        choices = await completionCache.getAsync(key)
+        if choices is not None:
+            tracer.record("completionCache hit", 0, endpoint=endpoint)
+            return choices
+
+    async def request():
+        with tracer.span("llm", endpoint=endpoint, n=n):
+            response = await llmScheduler.create(
+                endpoint=endpoint,
+                model=model_type,
+                messages=messages,
+                temperature=tempature,
+                max_tokens=max_tokens,
+                n=n
+            )
+        choices = [choice.message.content for choice in response.choices]
+        if useCache:
+            await completionCache.setAsync(key, choices)
+        return choices
+
+    if enableSingleFlight and endpoint not in cacheDisabledEndpoints:
+        # the callers share the list of choices, hand out copies
+        return list(await singleFlight.do(key, request, label=endpoint))
+    return await request()
+
+
+async def streamChatCompletion(messages, endpoint):
+    # same as chatCompletion, but yields the content of the first choice piece by piece as the model produces it
+    useCache = enableCompletionCache and endpoint not in cacheDisabledEndpoints
+    if useCache:
+        key = CompletionCache.makeKey(model_type, messages, tempature, 1, max_tokens)
+        choices = await completionCache.getAsync(key)
+        if choices is not None:
+            tracer.record("completionCache hit", 0, endpoint=endpoint)
+            yield choices[0]
+            return
+
+    # the span is recorded once the stream ends, a generator can be suspended in another context
+    start = time.perf_counter()
+    stream = await llmScheduler.create(
+        endpoint=endpoint,
+        model=model_type,
+        messages=messages,
+        temperature=tempature,
+        max_tokens=max_tokens,
+        n=1,
+        stream=True
+    )
+    text = ""
+    async for chunk in stream:
+        if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+            continue
+        text += chunk.choices[0].delta.content
+        yield chunk.choices[0].delta.content
+    tracer.record("llm stream", time.perf_counter() - start, endpoint=endpoint)
+
+    if useCache:
+        await completionCache.setAsync(key, [text])
+
+
+async def similarCached(namespace, scope, text, compute):
+    # the result of compute(), or the result of an earlier request whose text was similar enough
+    if not enableSimilarityCache:
+        return await compute()
+    hit = similarityCache.lookup(namespace, scope, text)
+    if hit is None:
+        value = await compute()
+        similarityCache.store(namespace, scope, text, value)
+        return value
+    tracer.record("similarityCache hit", 0, namespace=namespace, score=round(hit.score, 3))
+    auditSometimes(hit, scope, text, compute)
+    return list(hit.value)
+
+
+def auditSometimes(hit, scope, text, compute):
+    # a share of the reused results is generated fresh in the background to measure false reuse
+    if hit.score < 0.999 and similarityCache.shouldAudit():
+        asyncio.get_running_loop().create_task(auditReuse(hit, scope, text, compute))
+
+
+async def auditReuse(hit, scope, text, compute):
+    # generate the reused result fresh, nobody waits for it so it is bulk work
+    currentCaller.set((currentCaller.get()[0], "bulk"))
+    try:
+        fresh = await compute()
+    except Exception as e:
+        log.info("similarity cache audit of %s failed: %s", hit.namespace, e)
+        return
+    if not similarityCache.audit(hit, fresh):
+        log.info("similarity cache reused a different %s result (similarity %.2f) for %s", hit.namespace, hit.score, Payload(text))
+        similarityCache.store(hit.namespace, scope, text, fresh)
+
+
+# time to first token of the streamed routes, the latest samples are kept per route
+timeToFirstToken = {}
+timeToFirstTokenLock = threading.Lock()
+
+
+def recordTimeToFirstToken(endpoint, seconds):
+    with timeToFirstTokenLock:
+        if endpoint not in timeToFirstToken:
+            timeToFirstToken[endpoint] = {"count": 0, "samples": deque(maxlen=1000)}
+        timeToFirstToken[endpoint]["count"] += 1
+        timeToFirstToken[endpoint]["samples"].append(seconds)
+
+
+def timeToFirstTokenStats():
+    stats = {}
+    with timeToFirstTokenLock:
+        for endpoint, record in timeToFirstToken.items():
+            samples = sorted(record["samples"])
+            stats[endpoint] = {
+                "count": record["count"],
+                "mean": sum(samples) / len(samples),
+                "p50": samples[len(samples) // 2],
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "max": samples[-1],
+            }
+    return stats
+
+
+def wantsStream(req):
+    # a client opts into streaming with {"stream": true} in the body or by accepting text/event-stream
+    return enableStreaming and req.get("stream") is True
+
+
+class StreamedCompletion:
+    # Returned by the handlers of the streaming routes instead of a JSON body. The completion is sent as server-sent
+    # events: every "token" event carries a piece of the text, the final "done" event carries the same JSON body as
+    # the non-streaming route, so the client can simply replace what it rendered.
+
+    def __init__(self, messages, endpoint, field, finalize):
+        self.messages = messages
+        self.endpoint = endpoint
+        self.field = field
+        self.finalize = finalize
+        self.start = time.time()
+        # the stream is iterated outside of the handler, its call is still made for the handler's caller
+        self.caller = currentCaller.get()
+
+    async def events(self):
+        currentCaller.set(self.caller)
+        text = ""
+        firstToken = None
+        try:
+            async for delta in streamChatCompletion(self.messages, self.endpoint):
+                if firstToken is None:
+                    firstToken = time.time() - self.start
+                    recordTimeToFirstToken(self.endpoint, firstToken)
+                text += delta
+                yield f"event: token\ndata: {json.dumps({'delta': delta})}\n\n"
+        except Exception as e:
+            log.warning("[%s] streaming failed: %s", self.endpoint, e)
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
+        yield f"event: done\ndata: {json.dumps({self.field: self.finalize(text), 'timeToFirstToken': firstToken})}\n\n"
+
+
+sseHeaders = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
-        db.users.update_one({"username": username}, { "$set": { "latestSessionId" : sessionId  }})
 
-        return jsonify({"status": "success", "message": "Draft saved successfully"})
+def callerOf(payload, path, headers):
+    # (username, priority class) the LLM calls of a request are scheduled for (see llm_scheduler.py)
+    username = payload.get("username") if isinstance(payload.get("username"), str) else None
+    return (username or headers.get("X-Username") or "anonymous", "bulk" if path in llmBulkRoutes else "interactive")
 
 
-def implementSupportingArgument(supportingArgument, argumentSupported):
+def acceptsEventStream(accept):
+    # whether the Accept header of a request prefers server-sent events, the Flask and the ASGI server both decide with this
+    return parse_accept_header(accept, MIMEAccept).best == "text/event-stream"
 
-    if test:
-        return "This is a test mode response (SA)"
 
+def flaskResponse(handler):
+    # run the handler of an LLM route on the LLM loop and turn its result into a Flask response
+    payload = request.get_json()
+    if acceptsEventStream(request.headers.get("Accept")):
+        payload["stream"] = True
+    result = runOnLoop(runAs(callerOf(payload, request.path, request.headers), handler(payload)))
+    if isinstance(result, StreamedCompletion):
+        g.metricsStreaming = True
+
+        def events():
+            try:
+                yield from iterateOnLoop(result.events())
+            finally:
+                finishRequestMetrics()
+
+        return Response(stream_with_context(events()), mimetype="text/event-stream", headers=sseHeaders)
+    with tracer.span("encodeResponse"):
+        return jsonify(result)
+
+
+def paragraphText(text):
+    return text.strip().replace("\n", " ")
+
+
+httpRequests = Counter("visar_http_requests_total", "Handled HTTP requests", ["route", "method", "status"])
+httpRequestSeconds = Histogram("visar_http_request_seconds", "Duration of the HTTP requests, until the last event of a stream", ["route", "method"])
+httpRequestsInFlight = Gauge("visar_http_requests_in_flight", "HTTP requests being handled", ["route"])
+
+
+def routeLabel():
+    # the route rule rather than the path, so the number of label values stays bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def startRequestMetrics():
+    g.metricsStart = time.perf_counter()
+    g.metricsStatus = 500
+    httpRequestsInFlight.inc(route=routeLabel())
+    g.trace = tracer.startTrace(routeLabel(), force=request.headers.get("X-Trace") == "1", method=request.method)
+
+
+@app.after_request
+def recordResponseStatus(res):
+    g.metricsStatus = res.status_code
+    return res
+
+
+def finishRequestMetrics():
+    start = g.pop("metricsStart", None)
+    if start is None:
+        return
+    route = routeLabel()
+    httpRequestsInFlight.dec(route=route)
+    httpRequests.inc(route=route, method=request.method, status=g.metricsStatus)
+    httpRequestSeconds.observe(time.perf_counter() - start, route=route, method=request.method)
+    tracer.finishTrace(g.pop("trace", None), status=g.metricsStatus)
+
+
+@app.teardown_request
+def finishResponseMetrics(error):
+    # a streamed response is measured when its stream ends (see flaskResponse)
+    if not g.get("metricsStreaming"):
+        finishRequestMetrics()
+
+
+# Prometheus scrape endpoint: routes, LLM calls (llm_gateway.py) and MongoDB commands (mongo_metrics.py)
+@app.route("/metrics", methods=["GET"])
+def prometheusMetrics():
+    return Response(exposition(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify({"completionCache": completionCache.stats(), "timeToFirstToken": timeToFirstTokenStats(), "interactionLog": interactionLogWriter.stats(), "problemCache": problemCache.stats(), "llm": llmGateway.stats(), "singleFlight": singleFlight.stats(), "replay": llmBackend.stats() if llmBackend is not llmGateway else None, "tracing": tracer.stats(), "logging": logQueue.stats(), "jobs": jobRunner.stats(), "scheduler": llmScheduler.stats(), "similarityCache": similarityCache.stats(), "prefetch": prefetcher.stats()})
+
+
+async def implementSupportingArgument(supportingArgument, argumentSupported):
     messages = [
         {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to support an argument by considering a provided supporting argument."},
         {"role": "user", "content": f'''Please write a paragraph that supports the argument: "{argumentSupported}" by realizing the following kind of supporting evidence: "{supportingArgument}"'''},
     ]
 
     # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
-
-    return response.choices[0].message.content.strip().replace("\n", " ")
+    choices = await chatCompletion(messages, "implementSupportingArgument")
 
+    return choices[0].strip().replace("\n", " ")
 
-def implementCounterArgument(keyword, counterArgument, argumentAttacked):
 
-    print("called implementCounterArgument")
-
-    if test:
-        return "This is a test mode response (CA)"
+async def implementCounterArgument(keyword, counterArgument, argumentAttacked):
+    routeLogger("implementCounterArgument").debug("called implementCounterArgument")
 
     messages = [
         {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to argue against an argument by considering a provided counter argument."},
@@ -173,62 +797,34 @@ def implementCounterArgument(keyword, counterArgument, argumentAttacked):
     ]
 
     # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
+    choices = await chatCompletion(messages, "implementCounterArgument")
 
-    return response.choices[0].message.content.strip().replace("\n", " ")
+    return choices[0].strip().replace("\n", " ")
 
 
-def implementElaboration(prompt, context):
-
-    if test:
-        return "This is a test mode response (Elaboration)"
-
+async def implementElaboration(prompt, context):
     messages = [
         {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to elaborate on a particular given discussion point to support my argument.'''},
         {"role": "user", "content": f'''Please write a paragraph that elaborates on my argument "{context}" by considering the following discussion point "{prompt}":'''}
     ]
 
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
+    choices = await chatCompletion(messages, "implementElaboration")
 
-    return response.choices[0].message.content.strip().replace("\n", " ")
+    return choices[0].strip().replace("\n", " ")
 
 
-def generateStartingSentence(keyword, discussionPoints, globalContext):
-
-    if test:
-        return "This is a test mode response (Starting Sentence)"
-
+async def generateStartingSentence(keyword, discussionPoints, globalContext):
     messages = [
         {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to write a starting sentence of the paragraph that support user's argument from a particular perspective.'''},
         {"role": "user", "content": f'''Write a starting sentence for the paragraph that elaborates on the argument {globalContext} from the perspective of {keyword}'''}
     ]
 
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
-
-    return response.choices[0].message.content.strip().replace("\n", " ")
+    choices = await chatCompletion(messages, "generateStartingSentence")
 
+    return choices[0].strip().replace("\n", " ")
 
-@app.route("/implementTopicSentence", methods=["POST"])
-def implementTopicSentence():
-    if test:
-        return "This is a test mode response (Topic Sentence)"
 
-    response = request.get_json()
+async def implementTopicSentenceHandler(response):
     prompt = response['prompt']
 
     messages = [
@@ -236,175 +832,143 @@ def implementTopicSentence():
         {"role": "user", "content": f'''Please write a sentence that claim my argument "{prompt}":'''}
     ]
 
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
+    choices = await chatCompletion(messages, "implementTopicSentence")
 
     res = {
-            "response": response.choices[0].message.content.strip().replace("\n", " ")
+            "response": choices[0].strip().replace("\n", " ")
     }
 
-    return jsonify(res)
+    return res
 
 
-def generateTopicSentence(prompt, context):
-    if test:
-        return "This is a test mode response (Elaboration)"
+@app.route("/implementTopicSentence", methods=["POST"])
+def implementTopicSentence():
+    return flaskResponse(implementTopicSentenceHandler)
 
+
+async def generateTopicSentence(prompt, context):
     messages = [
         {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to elaborate on a particular given discussion point to support my argument.'''},
         {"role": "user", "content": f'''Please write a sentence that claim my argument "{prompt}":'''}
     ]
 
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
+    choices = await chatCompletion(messages, "generateTopicSentence")
+
+    return choices[0].strip().replace("\n", " ")
+
+async def implementCounterArgumentHandler(response):
+    counterArgument = response["prompt"]
+    argumentAttacked = response["context"]
+
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to argue against an argument by considering a provided counter argument."},
+        {"role": "user", "content": f'''Plesae write a paragraph that argues against the argument: "{argumentAttacked}" by considering the following counter argument: "{counterArgument}"'''},
+    ]
+
+    # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
+    if wantsStream(response):
+        return StreamedCompletion(messages, "implementCounterArgument", "response", paragraphText)
+
+    choices = await chatCompletion(messages, "implementCounterArgument")
+
+    res = {
+        "response": choices[0].strip().replace("\n", " ")
+    }
+
+    return res
 
-    return response.choices[0].message.content.strip().replace("\n", " ")
 
 @app.route("/implementCounterArgument", methods=["POST"])
 def gpt_implement_counter_argument():
+    return flaskResponse(implementCounterArgumentHandler)
 
-    if test:
-        return "This is a test mode response (Starting Sentence)"
 
-    if request.method == "POST":
-        response = request.get_json()
-        counterArgument = response["prompt"]
-        argumentAttacked = response["context"]
+async def implementSupportingArgumentHandler(response):
+    supportingArgument = response["prompt"]
+    argumentSupported = response["context"]
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to argue against an argument by considering a provided counter argument."},
-            {"role": "user", "content": f'''Plesae write a paragraph that argues against the argument: "{argumentAttacked}" by considering the following counter argument: "{counterArgument}"'''},
-        ]
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to support an argument by considering a provided supporting argument."},
+        {"role": "user", "content": f'''Please write a paragraph that supports the argument: "{argumentSupported}" by realizing the following kind of supporting evidence: "{supportingArgument}"'''},
+    ]
 
-        # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
+    # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
+    if wantsStream(response):
+        return StreamedCompletion(messages, "implementSupportingArgument", "response", paragraphText)
 
-        res = {
-            "response": response.choices[0].message.content.strip().replace("\n", " ")
-        }
+    choices = await chatCompletion(messages, "implementSupportingArgument")
 
-        return jsonify(res)
+    res = {
+        "response": choices[0].strip().replace("\n", " ")
+    }
+
+    return res
 
 
 @app.route("/implementSupportingArgument", methods=["POST"])
 def gpt_implement_supporting_argument():
+    return flaskResponse(implementSupportingArgumentHandler)
 
-    if test:
-        return "This is a test mode response (Starting Sentence)"
 
-    if request.method == "POST":
-        response = request.get_json()
-        supportingArgument = response["prompt"]
-        argumentSupported = response["context"]
+async def implementElaborationHandler(response):
+    prompt = response["prompt"]
+    context = response["context"]
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to support an argument by considering a provided supporting argument."},
-            {"role": "user", "content": f'''Please write a paragraph that supports the argument: "{argumentSupported}" by realizing the following kind of supporting evidence: "{supportingArgument}"'''},
-        ]
+    messages = [
+        {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to elaborate on a particular given discussion point to support my argument.'''},
+        {"role": "user", "content": f'''Please write a paragraph that elaborates on my argument "{context}" by considering the following discussion point "{prompt}":'''}
+    ]
 
-        # prompt = f'''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost"'''
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
+    if wantsStream(response):
+        return StreamedCompletion(messages, "implementElaboration", "response", paragraphText)
 
-        res = {
-            "response": response.choices[0].message.content.strip().replace("\n", " ")
-        }
+    choices = await chatCompletion(messages, "implementElaboration")
 
-        return jsonify(res)
+    res = {
+        "response": choices[0].strip().replace("\n", " ")
+    }
+
+    return res
 
 
 @app.route("/implementElaboration", methods=["POST"])
 def gpt_implement_elaboration():
+    return flaskResponse(implementElaborationHandler)
 
-    if test:
-        return "This is a test mode response (Starting Sentence)"
 
-    if request.method == "POST":
-        response = request.get_json()
-        prompt = response["prompt"]
-        context = response["context"]
+async def implementKeywordHandler(response):
+    prompt = response["prompt"]
+    context = response["context"]
 
-        messages = [
-            {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to elaborate on a particular given discussion point to support my argument.'''},
-            {"role": "user", "content": f'''Please write a paragraph that elaborates on my argument "{context}" by considering the following discussion point "{prompt}":'''}
-        ]
+    routeLogger("implementKeyword").debug("request: %s", Payload(response))
 
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
+    messages = [
+        {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to write a starting sentence of the paragrah that support user's argument from a particular perspective.'''},
+        {"role": "user", "content": f'''Write a starting sentence for the paragraph that elaborates on the argument {context} from the perspective of {prompt}'''}
+    ]
 
-        res = {
-            "response": response.choices[0].message.content.strip().replace("\n", " ")
-        }
+    choices = await chatCompletion(messages, "implementKeyword")
 
-        return jsonify(res)
+    res = {
+        "response": choices[0].strip().replace("\n", " ")
+    }
+
+    return res
 
 
 @app.route("/implementKeyword", methods=["POST"])
 def gpt_keyword_sentence():
-
-    if test:
-        return "This is a test mode response (Starting Sentence)"
-
-    if request.method == "POST":
-        response = request.get_json()
-        prompt = response["prompt"]
-        context = response["context"]
-
-        print("[implement keyword] request: ", response)
-
-        messages = [
-            {"role": "system", "content": f'''You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to write a starting sentence of the paragrah that support user's argument from a particular perspective.'''},
-            {"role": "user", "content": f'''Write a starting sentence for the paragraph that elaborates on the argument {context} from the perspective of {prompt}'''}
-        ]
-
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
-
-        res = {
-            "response": response.choices[0].message.content.strip().replace("\n", " ")
-        }
-
-        return jsonify(res)
+    return flaskResponse(implementKeywordHandler)
 
 
 @app.route("/", methods=["GET", "POST"])
 def gpt_inference():
     if request.method == "GET":
         prompt = request.args.get("prompt")
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            prompt=prompt,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
-        print(f"response: {response.choices[0].text}")
+        choices = runOnLoop(chatCompletion([{"role": "user", "content": prompt}], "inference"))
+        log.debug("[inference] response: %s", Payload(choices[0]))
         res = {
-            "response": response.choices[0].text.strip()
+            "response": choices[0].strip()
         }
         return jsonify(res)
 
@@ -420,18 +984,29 @@ def keyword():
         return jsonify(res)
 
 
-@app.route("/keyword", methods=["POST"])
-def gpt_fetch_keywords():
+keywordLog = routeLogger("keyword")
 
-    print("[keyword] request: ", request)
-    # test mode
-    if test == True:
-        return jsonify({"response": ["Quality of life", "Economy", "Population", "Education", "Location", "Safety", "Job opportunity"]})
 
-    if request.method == "POST":
-        response = request.get_json()
-        prompt = response["prompt"]
+async def keywordHandler(response):
+    keywordLog.debug("request: %s", Payload(response))
+    prompt = response["prompt"]
 
+    keywords = await similarCached("keyword", "", prompt, lambda: fetchKeywords(prompt))
+
+    keywordLog.debug("returned keywords: %s", Payload(keywords))
+    if enablePrefetch and (enableSimilarityCache or (enableCompletionCache and promptsMode != "batched")):
+        # the user picks some of the keywords next and asks /prompts for them with the same text as context
+        prefetcher.start(currentCaller.get()[0], prompt, [
+            (LLMGateway.estimateTokens({"messages": discussionPointMessages(key, prompt), "max_tokens": max_tokens}),
+             lambda key=key: cachedDiscussionPoints(key, prompt)) for key in keywords])
+
+    res = {
+        "response": keywords
+    }
+    return res
+
+
+async def fetchKeywords(prompt):
 #         elaborate_example = '''
 # Aspects for for elaborating: "Houston is a good city":
 # 1. Quality of life
@@ -462,12 +1037,12 @@ def gpt_fetch_keywords():
 # 6. Job opportunities
 #         '''
 
-        print(f"prompt: {prompt}")
+    keywordLog.debug("prompt: %s", Payload(prompt))
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant. You are given a argument and need to think of key aspects to elaborate on or evidence to support the argument."},
-            {"role": "user", "content": '''Please list key aspects that are worth to discuss in order to support argument: "Houston is a good city"'''},
-            {"role": "assistant", "content": '''
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant. You are given a argument and need to think of key aspects to elaborate on or evidence to support the argument."},
+        {"role": "user", "content": '''Please list key aspects that are worth to discuss in order to support argument: "Houston is a good city"'''},
+        {"role": "assistant", "content": '''
 1. Quality of life
 2. Economy
 3. Population
@@ -475,8 +1050,8 @@ def gpt_fetch_keywords():
 5. Location
 6. Safety
 7. Job opportunity'''},
-            {"role": "user", "content": '''Please list key aspects that are worth to discuss in order to support argument: "Computer Science is a good major"'''},
-            {"role": "assistant", "content": '''
+        {"role": "user", "content": '''Please list key aspects that are worth to discuss in order to support argument: "Computer Science is a good major"'''},
+        {"role": "assistant", "content": '''
 1. Social demand
 2. Job opportunity
 3. Promise
@@ -484,223 +1059,283 @@ def gpt_fetch_keywords():
 5. Enrollment
 6. Popularity
 7. Job security'''},
-            {"role": "user", "content": f'''Please list key aspects that are worth to discuss in order to support argument: "{prompt}"'''},
-        ]
-
-        # if mode == "elaborate":
-        #     prompt = elaborate_example + "\n\n" + "Aspects for elaborating: " + prompt
-        # if mode == "evidence":
-        #     prompt = evidence_example + "\n\n" + "Types of evidence for supporting: " + prompt
-
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
-
-        res = response.choices[0].message.content.strip()
-
-        print(f"response: {res}")
-        keywords = []
-        # get the keyword part of the response
-        res = res.strip().splitlines()
-        for index, r in enumerate(res):
-            if len(r) == 0:
-                continue
-            if index == 0 and not r[0].isdigit():
-                continue
-            pattern = r"^\d{1,2}. ?(.*)|^- ?(.*)|(.*)"
-            # only consider the first match, findall returns the matched part for each group in the first match
-            keyword = re.findall(pattern, r)[0]
-            keyword = [k for k in keyword if len(k) > 0][0]
-
-            if keyword is None:
-                continue
-
-            if any(x in [":", "-"] for x in keyword):
-                keyword = keyword.split(":")[0]
-            keywords.append(keyword)
-
-        print(f"returned keywords: {keywords}")
+        {"role": "user", "content": f'''Please list key aspects that are worth to discuss in order to support argument: "{prompt}"'''},
+    ]
 
-        res = {
-            "response": keywords
-        }
-        return jsonify(res)
+    # if mode == "elaborate":
+    #     prompt = elaborate_example + "\n\n" + "Aspects for elaborating: " + prompt
+    # if mode == "evidence":
+    #     prompt = evidence_example + "\n\n" + "Types of evidence for supporting: " + prompt
 
+    choices = await chatCompletion(messages, "keyword")
 
-@app.route("/prompts", methods=["POST"])
-def gpt_fetch_prompts():
-    if request.method == "POST":
-        response = request.get_json()
-        keywords = response["keywords"]
-        context = response["context"]
+    res = choices[0].strip()
 
-        prompts = []
-        res = []
+    keywordLog.debug("response: %s", Payload(res))
+    keywords = []
+    # get the keyword part of the response
+    res = res.strip().splitlines()
+    for index, r in enumerate(res):
+        if len(r) == 0:
+            continue
+        if index == 0 and not r[0].isdigit():
+            continue
+        pattern = r"^\d{1,2}. ?(.*)|^- ?(.*)|(.*)"
+        # only consider the first match, findall returns the matched part for each group in the first match
+        keyword = re.findall(pattern, r)[0]
+        keyword = [k for k in keyword if len(k) > 0][0]
 
-        print("[prompts] request: " + str(response))
+        if keyword is None:
+            continue
 
-        # test mode
+        if any(x in [":", "-"] for x in keyword):
+            keyword = keyword.split(":")[0]
+        keywords.append(keyword)
 
-        if test == True:
-            res = []
-            for key in keywords:
-                res.append(
-                    {"keyword": key, "prompt": "What is the relationship between " + key + " and " + context + "?"})
-            return jsonify({"response": res})
+    return keywords
 
-        # dev mode
-        for key in keywords:
 
-            messages = [
-                {"role": "system", "content": "You are a helpful writing assistant. You are given a pair of argument and perspective, you need to think of key discussion points from the perspective to support the given argument."},
-                {"role": "user", "content": '''Please list key discussion points that are worth to include in order to support arguemnt: "Houston is a good city" from perspective of transportation'''},
-                {"role": "assistant", "content": f'''
+# few-shot turns shared by every discussion point request
+discussionPointExamples = [
+    {"role": "system", "content": "You are a helpful writing assistant. You are given a pair of argument and perspective, you need to think of key discussion points from the perspective to support the given argument."},
+    {"role": "user", "content": '''Please list key discussion points that are worth to include in order to support arguemnt: "Houston is a good city" from perspective of transportation'''},
+    {"role": "assistant", "content": f'''
 1. Public transportation system in Houston
 2. Initiatives or plans to improve the public transportation infrastructure in Houston
 3. Bicycle or walking paths that connect the different parts of the city
 4. Convenience to get around Houston without a car
 5. Public affordable transportation options
 6. Transportation options that can help reduce traffic congestion in Houston'''},
-                {"role": "user", "content": '''Please list key discussion points that are worth to include in order to support arguemnt: "Notre Dame is a great school to attend" from perspective of academic exllenence'''},
-                {"role": "assistant", "content": f'''
+    {"role": "user", "content": '''Please list key discussion points that are worth to include in order to support arguemnt: "Notre Dame is a great school to attend" from perspective of academic exllenence'''},
+    {"role": "assistant", "content": f'''
 1.High quality educational programs and curricula
 2. Low student-to-faculty ratio
 3. Research opportunities and resources
 4. Extracurricular activities
 5. Access to specialized facilities
 6. Highly qualified and experienced faculty members'''},
-                {"role": "user", "content": f'''Please list key discussion points that are worth to include in order to support arguemnt: "{context}" from perspective of {key}'''},
-            ]
+]
 
-            response = OpenAIClient.chat.completions.create(
-                model=model_type,
-                messages=messages,
-                temperature=tempature,
-                max_tokens=max_tokens
-            )
-            print(
-                f"DP response: {response.choices[0].message.content.strip()}")
-
-            res = response.choices[0].message.content.strip().splitlines()
-            for index, r in enumerate(res):
-                if len(r) == 0:
-                    continue
-                if index == 0 and (not r[0].isdigit() or r[0] != "-"):
-                    continue
-                # print(f"Line: {r}")
-                pattern = r"^\d{1,2}. ?(.*)|^- ?(.*)|(.*)"
-                prompt = re.findall(pattern, r)[0]
-                prompt = [p for p in prompt if len(p) > 0][0]
-                if any(x in [":", "-"] for x in prompt):
-                    prompt = prompt.split(":")[0]
-                prompts.append({"keyword": key, "prompt": prompt})
-
-            res = {
-                "response": prompts
-            }
-        return jsonify(res)
+# few-shot turns for asking the discussion points of several perspectives in one request
+batchedDiscussionPointExamples = [
+    {"role": "system", "content": "You are a helpful writing assistant. You are given an argument and several perspectives, you need to think of key discussion points from each perspective to support the given argument."},
+    {"role": "user", "content": '''Please list key discussion points that are worth to include in order to support arguemnt: "Houston is a good city" from each of the following perspectives: transportation; economy. Start the list of every perspective with a line "Perspective: <perspective>".'''},
+    {"role": "assistant", "content": '''Perspective: transportation
+1. Public transportation system in Houston
+2. Initiatives or plans to improve the public transportation infrastructure in Houston
+3. Bicycle or walking paths that connect the different parts of the city
+4. Convenience to get around Houston without a car
+5. Public affordable transportation options
+6. Transportation options that can help reduce traffic congestion in Houston
+Perspective: economy
+1. Job market and employment rate in Houston
+2. Major industries such as energy, healthcare and aerospace
+3. Cost of living compared to other large cities
+4. Absence of a state income tax in Texas
+5. Growth of small businesses and startups
+6. Average household income in Houston'''},
+]
 
 
-@app.route("/rewrite", methods=["POST"])
-def gpt_rewrite():
-    if request.method == "POST":
-        response = request.get_json()
-        print("response: ", response)
+@app.route("/keyword", methods=["POST"])
+def gpt_fetch_keywords():
+    return flaskResponse(keywordHandler)
+
+
+def parseDiscussionPoints(text, key):
+    prompts = []
+    res = text.strip().splitlines()
+    for index, r in enumerate(res):
+        if len(r) == 0:
+            continue
+        # an introduction before the list, e.g. "Here are some discussion points:"
+        if index == 0 and not (r[0].isdigit() or r[0] == "-"):
+            continue
+        # print(f"Line: {r}")
+        pattern = r"^\d{1,2}. ?(.*)|^- ?(.*)|(.*)"
+        prompt = re.findall(pattern, r)[0]
+        prompt = [p for p in prompt if len(p) > 0][0]
+        if any(x in [":", "-"] for x in prompt):
+            prompt = prompt.split(":")[0]
+        prompts.append({"keyword": key, "prompt": prompt})
+    return prompts
+
+
+promptsLog = routeLogger("prompts")
+
+
+def discussionPointMessages(key, context):
+    return discussionPointExamples + [
+        {"role": "user", "content": f'''Please list key discussion points that are worth to include in order to support arguemnt: "{context}" from perspective of {key}'''},
+    ]
 
-        mode = response["mode"]
-        curSent = response["curSent"]
 
-        print("[rewrite] request: ", response)
+async def fetchDiscussionPoints(key, context):
+    messages = discussionPointMessages(key, context)
 
-        if test:
-            return "This is a test mode response (Starting Sentence)"
+    choices = await chatCompletion(messages, "prompts")
+    promptsLog.debug("DP response: %s", Payload(choices[0]))
 
-        res = {}
+    return parseDiscussionPoints(choices[0], key)
 
-        if mode == "alternative":
 
-            prompt = response["basePrompt"]
+async def cachedDiscussionPoints(key, context):
+    # discussion points of the same perspective are reused for a similar argument
+    return await similarCached("prompts", key, context, lambda: fetchDiscussionPoints(key, context))
 
-            messages = [
-                {"role": "system", "content": "You are a helpful writing assistant. You are trying to rephrase a sentence in a different way."},
-                {"role": "user", "content": f"Rephrase the following sentence in a different way: {curSent}"}
-            ]
 
-            prompt = f"Rephrase the following sentence in a different way: {curSent}"
-            print(f"[/rewrite] prompt: {prompt}")
-            response = OpenAIClient.chat.completions.create(
-                model=model_type,
-                messages=messages,
-                temperature=tempature,
-                max_tokens=max_tokens,
-                n=8
-            )
+async def fetchDiscussionPointsBatched(keywords, context):
+    # ask for the discussion points of every perspective in one request and split the answer by its
+    # "Perspective: ..." headers. Perspectives missing from the answer are fetched one by one.
+    messages = batchedDiscussionPointExamples + [
+        {"role": "user", "content": f'''Please list key discussion points that are worth to include in order to support arguemnt: "{context}" from each of the following perspectives: {"; ".join(keywords)}. Start the list of every perspective with a line "Perspective: <perspective>".'''},
+    ]
 
-            candidates = [response.choices[i].message.content.strip().replace("\n", "")
-                          for i in range(min(8, len(response.choices)))]
-            res["candidates"] = candidates
+    choices = await chatCompletion(messages, "prompts")
+    promptsLog.debug("batched DP response: %s", Payload(choices[0]))
+
+    sections = {}
+    current = None
+    for line in choices[0].strip().splitlines():
+        header = re.match(r"^[#*\s]*perspective\s*:\s*(.*?)[*\s]*$", line, re.IGNORECASE)
+        if header:
+            current = header.group(1).strip().lower()
+            sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+
+    prompts = []
+    for key in keywords:
+        if key.strip().lower() in sections:
+            prompts.extend(parseDiscussionPoints("\n".join(sections[key.strip().lower()]), key))
+        else:
+            promptsLog.info("perspective %s missing from batched response", key)
+            prompts.extend(await fetchDiscussionPoints(key, context))
+    return prompts
 
-        if mode == "refine":
 
-            furInstruction = response["furInstruction"]
+async def promptsHandler(response):
+    keywords = response["keywords"]
+    context = response["context"]
 
-            messages = [
-                {"role": "system", "content": "You are a helpful writing assistant. You are trying to refine a sentence with user instruction."},
-                {"role": "user", "content": f'''Rephrase the following sentence "{curSent}" with the instruction: "{furInstruction}"'''}
-            ]
+    prompts = []
 
-            response = OpenAIClient.chat.completions.create(
-                model=model_type,
-                messages=messages,
-                temperature=tempature,
-                max_tokens=max_tokens,
-                n=8
-            )
+    promptsLog.debug("request: %s", Payload(response))
+    # the keywords are picked, the other prefetched ones are not needed. Calls in flight keep running, and
+    # identical requests of this handler share them (see single_flight.py)
+    prefetcher.cancel(currentCaller.get()[0], context)
 
-            candidates = [response.choices[i].message.content.strip().replace("\n", "")
-                          for i in range(min(8, len(response.choices)))]
-            res["candidates"] = candidates
+    mode = "batched" if response.get("batched") is True else promptsMode
+    if len(keywords) == 0:
+        pass
+    elif mode == "batched":
+        # only the perspectives that are not answered by the similarity cache go into the batch
+        hits = {key: similarityCache.lookup("prompts", key, context) if enableSimilarityCache else None for key in keywords}
+        missing = [key for key in keywords if hits[key] is None]
+        for key in keywords:
+            if hits[key] is not None:
+                auditSometimes(hits[key], key, context, lambda key=key: fetchDiscussionPoints(key, context))
+        fetched = {key: [] for key in missing}
+        if missing:
+            for point in await fetchDiscussionPointsBatched(missing, context):
+                fetched[point["keyword"]].append(point)
+            if enableSimilarityCache:
+                for key in missing:
+                    similarityCache.store("prompts", key, context, fetched[key])
+        for key in keywords:
+            prompts.extend(hits[key].value if hits[key] is not None else fetched[key])
+    elif mode == "parallel":
+        # one request per keyword, issued concurrently, the results keep the order of the keywords
+        for keywordPrompts in await gatherBounded([cachedDiscussionPoints(key, context) for key in keywords], promptsConcurrency):
+            prompts.extend(keywordPrompts)
+    else:
+        for key in keywords:
+            prompts.extend(await cachedDiscussionPoints(key, context))
 
-        if mode == "fix":
-            weaknesses = response["weaknesses"]
-            messages = [
-                {"role": "system", "content": "You are a helpful writing assistant. You are trying to fix the mentioned logical weaknesses in my argument."},
-                {"role": "user",
-                    "content": f'''I just made an argument: {curSent}. I know this argument has the following logical weaknesses: {"; ".join(weaknesses)}. Rewrite the argument to fix the logical weaknesses.'''''}
-            ]
+    res = {
+        "response": prompts
+    }
+    return res
 
-            response = OpenAIClient.chat.completions.create(
-                model=model_type,
-                messages=messages,
-                temperature=tempature,
-                max_tokens=max_tokens,
-                n=8
-            )
 
-            candidates = [response.choices[i].message.content.strip().replace("\n", "")
-                          for i in range(min(8, len(response.choices)))]
+@app.route("/prompts", methods=["POST"])
+def gpt_fetch_prompts():
+    return flaskResponse(promptsHandler)
 
-            candidates = [
-                c.split(":")[1] if ":" in c else c for c in candidates]
 
-            res["candidates"] = candidates
+rewriteLog = routeLogger("rewrite")
 
-        print("fix res:", res["candidates"])
 
-        return jsonify(res)
+async def rewriteHandler(response):
+    rewriteLog.debug("request: %s", Payload(response))
 
+    mode = response["mode"]
+    curSent = response["curSent"]
 
-@app.route("/getWeakness", methods=["POST"])
-def gpt_weakness_type():
-    req = request.get_json()
-    print(req)
+    res = {}
+
+    if mode == "alternative":
+
+        prompt = response["basePrompt"]
+
+        messages = [
+            {"role": "system", "content": "You are a helpful writing assistant. You are trying to rephrase a sentence in a different way."},
+            {"role": "user", "content": f"Rephrase the following sentence in a different way: {curSent}"}
+        ]
+
+        prompt = f"Rephrase the following sentence in a different way: {curSent}"
+        rewriteLog.debug("prompt: %s", Payload(prompt))
+        choices = await chatCompletion(messages, "rewrite", n=8)
+
+        candidates = [choices[i].strip().replace("\n", "")
+                      for i in range(min(8, len(choices)))]
+        res["candidates"] = candidates
+
+    if mode == "refine":
+
+        furInstruction = response["furInstruction"]
+
+        messages = [
+            {"role": "system", "content": "You are a helpful writing assistant. You are trying to refine a sentence with user instruction."},
+            {"role": "user", "content": f'''Rephrase the following sentence "{curSent}" with the instruction: "{furInstruction}"'''}
+        ]
+
+        choices = await chatCompletion(messages, "rewrite", n=8)
+
+        candidates = [choices[i].strip().replace("\n", "")
+                      for i in range(min(8, len(choices)))]
+        res["candidates"] = candidates
+
+    if mode == "fix":
+        weaknesses = response["weaknesses"]
+        messages = [
+            {"role": "system", "content": "You are a helpful writing assistant. You are trying to fix the mentioned logical weaknesses in my argument."},
+            {"role": "user",
+                "content": f'''I just made an argument: {curSent}. I know this argument has the following logical weaknesses: {"; ".join(weaknesses)}. Rewrite the argument to fix the logical weaknesses.'''''}
+        ]
+
+        choices = await chatCompletion(messages, "rewrite", n=8)
+
+        candidates = [choices[i].strip().replace("\n", "")
+                      for i in range(min(8, len(choices)))]
+
+        candidates = [
+            c.split(":")[1] if ":" in c else c for c in candidates]
+
+        res["candidates"] = candidates
+
+    rewriteLog.debug("candidates: %s", Payload(res["candidates"]))
+
+    return res
 
-    # test mode
-    if test == True:
-        return jsonify({"response": ["Quality of life", "Economy", "Population", "Education", "Location", "Safety", "Job opportunity"]})
+
+@app.route("/rewrite", methods=["POST"])
+def gpt_rewrite():
+    return flaskResponse(rewriteHandler)
+
+
+async def getWeaknessHandler(req):
+    routeLogger("getWeakness").debug("request: %s", Payload(req))
 
     prompt = req["context"]
 
@@ -760,14 +1395,9 @@ Based on the argumentation theory, find logical weaknesses of the argument: "Not
     prompt = elaborate_example + "\n\n" + \
         f'''Based on the argumentation theory, find logical weaknesses of the argument: "Notre Dame is a great school to attend because it has outstanding faculty"'''
 
-    response = OpenAIClient.chat.completions.create(
-        model=model_type,
-        messages=messages,
-        temperature=tempature,
-        max_tokens=max_tokens
-    )
+    choices = await chatCompletion(messages, "getWeakness")
 
-    output = response.choices[0].message.content.strip().replace("\n\n", "\n")
+    output = choices[0].strip().replace("\n\n", "\n")
     output = output.splitlines()
 
     resData = []
@@ -782,23 +1412,21 @@ Based on the argumentation theory, find logical weaknesses of the argument: "Not
                 resData.append(output[i].split(":")[1].strip())
 
     res = {"response": resData}
-    return jsonify(res)
+    return res
 
 
-@app.route("/supportingArguments", methods=["POST"])
-def gpt_supporting_argument():
-    if request.method == "POST":
-        response = request.get_json()
-        context = response["context"]
+@app.route("/getWeakness", methods=["POST"])
+def gpt_weakness_type():
+    return flaskResponse(getWeaknessHandler)
 
-        # test mode
-        if test == True:
-            return jsonify({"response": ["Quality of life", "Economy", "Population", "Education", "Location", "Safety", "Job opportunity"]})
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to raise the supporting arguments or evidences for the given argument."},
-            {"role": "user", "content": '''Please list kinds of supporting arguments or evidences that can increase the credibility of the argument: "The potential for computer scientists to create new technologies and applications that can change the world is immense. Computer science is a field that is constantly evolving, and its practitioners are tasked with finding new and innovative ways to solve problems and improve existing systems. From developing new software and applications to designing cutting-edge hardware, computer scientists have the ability to create products that can have a profound impact on society. For example, the rise of the internet and the rapid development of social media platforms have revolutionized the way people communicate and interact with one another. Similarly, advancements in artificial intelligence and machine learning have the potential to transform industries such as healthcare, transportation, and finance. In short, computer science is a field that offers unparalleled opportunities for innovation and has the potential to shape the future in profound ways."'''},
-            {"role": "assistant", "content": '''
+async def supportingArgumentsHandler(response):
+    context = response["context"]
+
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to raise the supporting arguments or evidences for the given argument."},
+        {"role": "user", "content": '''Please list kinds of supporting arguments or evidences that can increase the credibility of the argument: "The potential for computer scientists to create new technologies and applications that can change the world is immense. Computer science is a field that is constantly evolving, and its practitioners are tasked with finding new and innovative ways to solve problems and improve existing systems. From developing new software and applications to designing cutting-edge hardware, computer scientists have the ability to create products that can have a profound impact on society. For example, the rise of the internet and the rapid development of social media platforms have revolutionized the way people communicate and interact with one another. Similarly, advancements in artificial intelligence and machine learning have the potential to transform industries such as healthcare, transportation, and finance. In short, computer science is a field that offers unparalleled opportunities for innovation and has the potential to shape the future in profound ways."'''},
+        {"role": "assistant", "content": '''
 1. Statistics: Using statistical data to support the argument can improve its credibility. For instance, citing the percentage of computer scientists who have created technologies that have positively impacted society.
 2. Expert opinion: Quoting respected experts or professionals in the field can lend credibility to the argument. For instance, referencing interviews with renowned computer scientists who have spoken about the potential of computer science to shape the future.
 3. Historical examples: Citing historical examples of how computer science has influenced society can provide support for the argument. For example, referencing the development of the World Wide Web and how it has revolutionized the way people access and share information.
@@ -808,282 +1436,468 @@ def gpt_supporting_argument():
 7. Comparisons: Making comparisons to other fields or technologies can also enhance the credibility of the argument. For example, comparing the potential impact of computer science to that of other technological breakthroughs like the invention of the printing press or the steam engine.
 8. Real-world examples: Providing real-world examples of the impact of computer science on society can make the argument more tangible. For instance, discussing how social media has transformed the way people connect with each other or how self-driving cars are set to revolutionize the transportation industry.
 9 Future projections: Discussing potential future developments in computer science and their potential impact on society can help bolster the argument. For example, speculating on the possibilities of a future where artificial intelligence is used to solve some of the world's most pressing problems.'''},
-            {"role": "user", "content": f'''Please list kinds of supporting arguments or evidences that can increase the credibility of the argument: {context}"'''},
-        ]
+        {"role": "user", "content": f'''Please list kinds of supporting arguments or evidences that can increase the credibility of the argument: {context}"'''},
+    ]
 
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
+    choices = await chatCompletion(messages, "supportingArguments")
 
-        res = response.choices[0].message.content.strip()
-        res = res.strip().splitlines()
-        return jsonify({"response": res})
+    res = choices[0].strip()
+    res = res.strip().splitlines()
+    return {"response": res}
 
 
-@app.route("/counterArguments", methods=["POST"])
-def gpt_counter_argument():
-    if request.method == "POST":
-        response = request.get_json()
-        context = response["context"]
-        keyword = response["keyword"]
+@app.route("/supportingArguments", methods=["POST"])
+def gpt_supporting_argument():
+    return flaskResponse(supportingArgumentsHandler)
 
-        # test mode
-        if test == True:
-            return jsonify({"response": ["Quality of life", "Economy", "Population", "Education", "Location", "Safety", "Job opportunity"]})
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to raise the counter arguments for the given statement."},
-            {"role": "user", "content": '''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost from the perspective of transportation"'''},
-            {"role": "assistant", "content": '''
+async def counterArgumentsHandler(response):
+    context = response["context"]
+    keyword = response["keyword"]
+
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to raise the counter arguments for the given statement."},
+        {"role": "user", "content": '''Please list the counter arguments that can challenge the argument: "Houston is a good city because it has a convenient transportaion and afforable living cost from the perspective of transportation"'''},
+        {"role": "assistant", "content": '''
 1. Lack of Comprehensive Public Transportation System: While Houston has public transportation options such as buses and light rail, the public transportation system is not comprehensive, and many areas of the city may not be well-served by these options. This can limit accessibility to jobs and other important destinations for residents who rely on public transportation.
 2. Inadequate Bike Infrastructure: Houston has a relatively low bike score, indicating that the city's bike infrastructure may not be adequate for residents who prefer to bike for transportation. This can limit mobility options for some residents, particularly those who may not have access to a car
 3. High Traffic Congestion: Despite having convenient transportation options, Houston is known for its high traffic congestion, particularly during rush hour. This can cause significant delays for commuters, particularly those who rely on public transportation or who must travel long distances to reach their destinations.
 4. Poor Air Quality: Traffic congestion and other factors can contribute to poor air quality in Houston, which can have negative health effects on residents. This can be a particular concern for vulnerable populations such as children, the elderly, and those with respiratory problems.
 5. Limited Options for Alternative Transportation: While Houston has some options for alternative transportation, such as bike sharing and car sharing programs, these options may not be widely available or accessible to all residents.
 6. Lack of Walkability: Many areas of Houston are designed primarily for cars, which can make it difficult for residents to walk to their destinations. This can limit opportunities for exercise and may contribute to obesity and other health problems.'''},
-            {"role": "user", "content": f'''Please list the counter arguments that can challenge the argument: "{context}" from the perspective of "{keyword}. Directly list the counter arguments, do not include any prefix sentence."'''},
-        ]
+        {"role": "user", "content": f'''Please list the counter arguments that can challenge the argument: "{context}" from the perspective of "{keyword}. Directly list the counter arguments, do not include any prefix sentence."'''},
+    ]
 
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
+    choices = await chatCompletion(messages, "counterArguments")
 
-        res = response.choices[0].message.content.strip()
-        res = res.strip().splitlines()
+    res = choices[0].strip()
+    res = res.strip().splitlines()
 
-        res = [ r for r in res if len(r) > 0 and r[0].isdigit()]
+    res = [ r for r in res if len(r) > 0 and r[0].isdigit()]
 
-        return jsonify({"response": res})
+    return {"response": res}
 
 
 # depdentency graph data structure:
 '''
 DepGraph = {
     "FlowNodeKey1": {
-        "type": "type of relation with the parent node",
-        "prompt": "prompt of the node / content of the corresponding node in the flow graph",
-        "children": ["FlowNodeKey2", "FlowNodeKey3", ...] // list of children nodes,
-        "isImplemented": whether or not the corresponding text has been generated for this node
-        "parent": key of the parent node,
-        "text": concrete text generated for this node, only those implemented nodes have this field
+    "type": "type of relation with the parent node",
+    "prompt": "prompt of the node / content of the corresponding node in the flow graph",
+    "children": ["FlowNodeKey2", "FlowNodeKey3", ...] // list of children nodes,
+    "isImplemented": whether or not the corresponding text has been generated for this node
+    "parent": key of the parent node,
+    "text": concrete text generated for this node, only those implemented nodes have this field
+    "inputFingerprint": hash of the inputs the text was generated from, set by the server (see DependencyGraph.inputFingerprint)
     },
     "FlowNodeKey2": {
-        ...
+    ...
     }
 }
 '''
 
 
+@app.route("/counterArguments", methods=["POST"])
+def gpt_counter_argument():
+    return flaskResponse(counterArgumentsHandler)
+
+
+async def completionHandler(response):
+    prompt = response["prompt"]
+    routeLogger("completion").debug("prompt: %s", Payload(prompt))
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to complete the given prompt."},
+        {"role": "user", "content": f'''Please complete the following prompt: "{prompt}"'''},
+    ]
+
+    if wantsStream(response):
+        return StreamedCompletion(messages, "completion", "completion", lambda text: " " + text.strip())
+
+    choices = await chatCompletion(messages, "completion")
+
+    res = choices[0].strip()
+    return {"completion": " "+res}
+
+# generate text based on the given dependency graph
+
+
 @app.route("/completion", methods=["POST"])
 def gpt_completion():
-    if request.method == "POST":
-        response = request.get_json()
-        prompt = response["prompt"]
-        print("compltion prompt: ", prompt)
-        # test mode
-        if test == True:
-            return jsonify({"response": "The answer is 42."})
+    return flaskResponse(completionHandler)
+
+
+def needsRegeneration(depGraph, node, fingerprint, changed):
+    if not depGraph[node]["isImplemented"] or depGraph[node].get("needsUpdate"):
+        return True
+    if depGraph[node]["type"] == "root":
+        # the text of an implemented root is the user's own argument, it is an input rather than an output
+        return False
+    if "inputFingerprint" in depGraph[node]:
+        return depGraph[node]["inputFingerprint"] != fingerprint
+    # generated before fingerprints existed: trust the flags unless the parent text changed in this pass
+    return depGraph[node]["parent"] in changed
+
+
+depGraphLog = routeLogger("generateFromDepGraph")
+
+
+async def generateNodeText(graph, node):
+    # generate text for a single node of the dependency graph
+    # ASSUMPTION: the parent node is always implemented before its children
+    depGraph = graph.nodes
+    with tracer.span("generateNode", node=node, type=depGraph[node]["type"]):
+        prompt = depGraph[node]["prompt"]
+        parent = graph.parentOf(node)
+        generation = None
+        if depGraph[node]["type"] == "attackedBy":
+            # generate counter argument against the parent node, in the paragraph of its keyword
+            generation = await implementCounterArgument(
+                graph.keywordOf(node), depGraph[node]["prompt"], parent["text"])
+        elif depGraph[node]["type"] == "elaboratedBy":
+            # generate elaboration of the parent node
+            generation = await implementElaboration(
+                prompt, parent["text"])
+        elif depGraph[node]["type"] == "featuredBy":
+            # generate the starting sentence for the paragraph that this keyword is featured in
+            keyword = depGraph[node]["prompt"]
+            dps = [depGraph[dp_key]["prompt"]
+                   for dp_key in depGraph[node]["children"]]
+            generation = await generateStartingSentence(
+                keyword, dps, parent["text"])
+        elif depGraph[node]["type"] == "supportedBy":
+            # generate support for the parent node
+            generation = await implementSupportingArgument(
+                prompt, parent["text"])
+        elif depGraph[node]["type"] == "root":
+            generation = await generateTopicSentence(
+                depGraph[node]["prompt"], depGraph[node]["text"]
+            )
 
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to complete the given prompt."},
-            {"role": "user", "content": f'''Please complete the following prompt: "{prompt}"'''},
-        ]
+        depGraphLog.debug("node: %s, text: %s", node, Payload(generation))
+        return generation
 
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
 
-        res = response.choices[0].message.content.strip()
-        return jsonify({"completion": " "+res})
+async def generateFromDepGraphHandler(response, job=None):
+    depGraph = response["dependencyGraph"]
+    # The flowNode key of the root of the dependency graph, which is usually a node that is already implemented
+    rootKeys = response["rootKeys"]
 
-# generate text based on the given dependency graph
+    output = {}
+
+    # generate text through BFS traversal, one level (wave) at a time.
+    # A node only depends on the text of its parent, which always sits in an earlier level,
+    # so the LLM calls of all nodes in the same level can run concurrently.
+    graph = DependencyGraph(depGraph, rootKeys)
+    try:
+        graph.validate()
+    except DependencyGraphError as e:
+        depGraphLog.warning("%s", e)
+        output["error"] = str(e)
+        output["depGraph"] = depGraph
+        return output
+    orphans = graph.orphans()
+    if orphans:
+        depGraphLog.info("%d nodes are not reachable from the root and are skipped", len(orphans))
+
+    # Nodes whose input fingerprint is unchanged are skipped. A regenerated node changes the parent text of its
+    # children and therefore their fingerprints, so staleness propagates down the graph level by level.
+    changed = set()
+    regenerated = []
+
+    depGraphLog.debug("dependency graph: %s", Payload(depGraph))
+    depGraphLog.debug("levels: %s", Payload(graph.levels))
+
+    async def generate(node):
+        # a job reuses the text of a node generated by an earlier attempt and stores the ones it generates
+        if job is None:
+            return await generateNodeText(graph, node)
+        if node not in job.completed:
+            await job.nodeDone(node, await generateNodeText(graph, node))
+        return job.completed[node]
+
+    walked = 0
+    for level in graph.levels:
+        depGraphLog.debug("Current level: %s", Payload(level))
+        pending = []
+        # walk the level: check the parents and find the nodes whose inputs changed
+        with tracer.span("planLevel", nodes=len(level)):
+            for node in level:
+                if node in graph.missingParents:
+                    if depGraph[node]["isImplemented"] and not depGraph[node].get("needsUpdate"):
+                        continue
+                    depGraphLog.warning("parent of %s does not exist in graph", node)
+                    output["error"] = "parent does not exist in graph"
+                    output["depGraph"] = depGraph
+                    return output
+                fingerprint = graph.inputFingerprint(node)
+                if needsRegeneration(depGraph, node, fingerprint, changed):
+                    depGraphLog.debug("Stale node: %s", Payload(depGraph[node]))
+                    pending.append(node)
+                depGraph[node]["inputFingerprint"] = fingerprint
+
+        if pending:
+            # the generations only read the graph, the generated text is written back after the whole level is done
+            generations = await gatherBounded([generate(node) for node in pending], depGraphConcurrency)
+            for node, generation in zip(pending, generations):
+                if depGraph[node].get("text") != generation:
+                    changed.add(node)
+                depGraph[node]["text"] = generation
+                regenerated.append(node)
+
+        if job is not None:
+            walked += len(level)
+            await job.setProgress(walked, len(graph.reachable))
+
+    output["depGraph"] = depGraph
+    output["regenerated"] = regenerated
+    depGraphLog.debug("generateFromDepGraph returned, %d nodes regenerated", len(regenerated))
+    return output
 
 
 @app.route("/generateFromDepGraph", methods=["POST"])
 def generateText():
-    if request.method == "POST":
-        response = request.get_json()
-        depGraph = response["dependencyGraph"]
-        # The flowNode key of the root of the dependency graph, which is usually a node that is already implemented
-        rootKeys = response["rootKeys"]
-
-        output = {}
-
-        if len(rootKeys) == 0:
-            output["error"] = "The root does not exist in the dependency graph"
-            print("The root does not exist in the dependency graph")
-            return jsonify(output)
-
-
-
-        # generate text through BFS traversal
-        visited = []
-        queue = [root for root in rootKeys]
-
-        print("dependency graph: ", depGraph)
-        print("queue: ", queue)
-
-        while queue:
-            node = queue.pop(0)
-            print("Current node: ", node)
-            if node not in visited:
-                if node not in depGraph:
-                    raise Exception(
-                        f"The node {node} does not exist in the dependency graph")
-                visited.append(node)
-                queue.extend(depGraph[node]["children"])
-                print("visiting node: ", node)
-                if not depGraph[node]["isImplemented"] or depGraph[node]["needsUpdate"]:
-                    print("Unimplemented node: ", depGraph[node])
-                    generation = None
-                    # generate text for this node
-                    prompt = depGraph[node]["prompt"]
-                    parentKey = depGraph[node]["parent"]
-                    if depGraph[node]["type"] != "root" and parentKey not in depGraph:
-                        print("parent does not exist in graph")
-                        output["error"] = "parent does not exist in graph"
-                        output["depGraph"] = depGraph
-                        return jsonify(output) 
-                    parent = depGraph[parentKey] if depGraph[node]["type"] != "root" else None
-                    # ASSUMPTION: the parent node is always implemented before its children
-                    if depGraph[node]["type"] == "attackedBy":
-                        # generate counter argument against the parent node
-
-                        keywordNode = node
-                        while (depGraph[keywordNode]["type"] != "featuredBy"):
-                            keywordNode = depGraph[keywordNode]["parent"]
-
-                        generation = implementCounterArgument(
-                            depGraph[keywordNode]["prompt"], depGraph[node]["prompt"], parent["text"])
-                    elif depGraph[node]["type"] == "elaboratedBy":
-                        # generate elaboration of the parent node
-                        generation = implementElaboration(
-                            prompt, parent["text"])
-                    elif depGraph[node]["type"] == "featuredBy":
-                        # generate the starting sentence for the paragraph that this keyword is featured in
-                        keyword = depGraph[node]["prompt"]
-                        dps = [depGraph[dp_key]["prompt"]
-                               for dp_key in depGraph[node]["children"]]
-                        generation = generateStartingSentence(
-                            keyword, dps, parent["text"])
-                    elif depGraph[node]["type"] == "supportedBy":
-                        # generate support for the parent node
-                        generation = implementSupportingArgument(
-                            prompt, parent["text"])
-                    elif depGraph[node]["type"] == "root":
-                        generation = generateTopicSentence(
-                            depGraph[node]["prompt"], depGraph[node]["text"]
-                        )
-
-                    print(f"node: {node}, text: {generation}")
-                    depGraph[node]["text"] = generation
+    return flaskResponse(generateFromDepGraphHandler)
+
+
+sketchLog = routeLogger("generateFromSketch")
 
-        output["depGraph"] = depGraph
-        print("generateFromDepGraph returned")
-        return jsonify(output) 
+
+def sketchPointMessages(globalContext, keyword, questions):
+    points = "\n".join(f"{index}. {question}" for index, question in enumerate(questions, 1))
+    return [
+        {"role": "system", "content": "You are a helpful writing assistant focusing on argumentative essay tutoring. You are trying to elaborate on the discussion points of a paragraph that supports the user's argument."},
+        {"role": "user", "content": f'''Please elaborate the argument "{globalContext}" from the perspective of {keyword}. Write one paragraph for each of the following discussion points, by considering its questions. Keep the order of the list and start every paragraph with the number of its discussion point, e.g. "1. ".
+{points}'''}
+    ]
+
+
+def splitNumberedParagraphs(text, count):
+    # the paragraphs of an answer to sketchPointMessages by the number they start with, None for a missing one
+    paragraphs = {}
+    current = None
+    for line in text.strip().splitlines():
+        numbered = re.match(r"^[#*\s]*(\d{1,2})[.):][*\s]*(.*)$", line)
+        if numbered and 1 <= int(numbered.group(1)) <= count and int(numbered.group(1)) not in paragraphs:
+            current = int(numbered.group(1))
+            paragraphs[current] = [numbered.group(2)]
+        elif current is not None:
+            paragraphs[current].append(line)
+    texts = [" ".join(" ".join(paragraphs.get(index, [])).split()) for index in range(1, count + 1)]
+    return [text or None for text in texts]
+
+
+async def elaborateSketchPoint(globalContext, keyword, question):
+    messages = [{"role": "user", "content": f'''Please elaborate the argument "{globalContext}" from the perspective of {keyword} by considering the following questions: {question}'''}]
+    choices = await chatCompletion(messages, "generateFromSketch")
+    return choices[0].strip()
+
+
+async def elaborateSketchPoints(globalContext, keyword, questions):
+    # the paragraphs of all discussion points of a keyword from one request. Points missing from the answer are
+    # elaborated one by one.
+    choices = await chatCompletion(sketchPointMessages(globalContext, keyword, questions), "generateFromSketch")
+    sketchLog.debug("points response: %s", Payload(choices[0]))
+    paragraphs = splitNumberedParagraphs(choices[0], len(questions))
+    missing = [index for index, paragraph in enumerate(paragraphs) if paragraph is None]
+    if missing:
+        sketchLog.info("%d of %d discussion points of %s missing from the answer", len(missing), len(questions), keyword)
+        for index, paragraph in zip(missing, await asyncio.gather(
+                *[elaborateSketchPoint(globalContext, keyword, questions[index]) for index in missing])):
+            paragraphs[index] = paragraph
+    return paragraphs
+
+
+async def generateFromSketchHandler(response, job=None):
+    globalContext = response["selectedPrompts"]
+    keywords = response["keywords"]
+    discussionPoints = response["discussionPoints"]
+    depGraph = response["dependencyGraph"]
+
+    sketchLog.debug("depGraph: %s", Payload(depGraph))
+
+    output = {
+        "keywords": keywords,
+        "globalContext": globalContext,
+        "discussionPoints": discussionPoints,
+        "depGraph": depGraph,
+        "startSents": {},
+    }
+
+    generations = {}
+    sketched = [keyword for keyword in dict.fromkeys(keywords) if depGraph.get(keyword)]
+    done = 0
+
+    async def generate(node, coroutine):
+        # a job reuses the text generated by an earlier attempt and stores the ones it generates
+        if job is None:
+            return await coroutine
+        if node in job.completed:
+            coroutine.close()
+        else:
+            await job.nodeDone(node, await coroutine)
+        return job.completed[node]
+
+    async def generatePoints(keyword):
+        # one request for the discussion points of the keyword that an earlier attempt of the job did not generate
+        points = depGraph[keyword]
+        # keyed by keyword and prompt, two keywords may have a discussion point with the same prompt
+        nodes = [f"generation:{json.dumps([keyword, dp['prompt']], ensure_ascii=False)}" for dp in points]
+        texts = [job.completed.get(node) if job is not None else None for node in nodes]
+        pending = [index for index, node in enumerate(nodes) if job is None or node not in job.completed]
+        if pending:
+            paragraphs = await elaborateSketchPoints(globalContext, keyword, [points[index]["content"] for index in pending])
+            for index, paragraph in zip(pending, paragraphs):
+                texts[index] = paragraph
+                if job is not None:
+                    await job.nodeDone(nodes[index], paragraph)
+        return texts
+
+    async def sketchKeyword(keyword):
+        # the starting sentence and the paragraphs of a keyword only depend on the request, they run side by side
+        nonlocal done
+        with tracer.span("sketchKeyword", keyword=keyword, points=len(depGraph[keyword])):
+            startSent, texts = await asyncio.gather(
+                generate(f"startSent:{keyword}", generateStartingSentence(
+                    keyword, [d["prompt"] for d in depGraph[keyword]], globalContext)),
+                generatePoints(keyword))
+        if job is not None:
+            done += 1
+            await job.setProgress(done, len(sketched))
+        return startSent, texts
+
+    # every keyword is a paragraph of its own, the request takes as long as the slowest one
+    results = await gatherBounded([sketchKeyword(keyword) for keyword in sketched], sketchConcurrency)
+    for keyword, (startSent, texts) in zip(sketched, results):
+        output["startSents"][keyword] = startSent
+        for dp, text in zip(depGraph[keyword], texts):
+            generations[dp["prompt"]] = text
+
+    output["generations"] = generations
+    return output
 
 
 @app.route("/generateFromSketch", methods=["POST"])
 def get_generate_from_sketch():
-    if request.method == "POST":
-        response = request.get_json()
-        globalContext = response["selectedPrompts"]
-        keywords = response["keywords"]
-        discussionPoints = response["discussionPoints"]
-        depGraph = response["dependencyGraph"]
-
-        print(f"depGraph: {depGraph}")
-
-        output = {
-            "keywords": keywords,
-            "globalContext": globalContext,
-            "discussionPoints": discussionPoints,
-            "depGraph": depGraph,
-            "startSents": {},
-        }
+    return flaskResponse(generateFromSketchHandler)
 
-        # test mode
-        if test == True:
-            generations = {}
-            for k in keywords:
-                if depGraph.get(k) is None or len(depGraph[k]) == 0:
-                    continue
-                for dp in depGraph[k]:
-                    generations[dp["prompt"]
-                                ] = "This is a test generation for " + dp["prompt"]
-            output["generations"] = generations
-            return jsonify(output)
-
-        generations = {}
-
-        for keyword in keywords:
-            if depGraph.get(keyword) is None or len(depGraph[keyword]) == 0:
-                continue
-            startSent = generateStartingSentence(
-                keyword, [d["prompt"] for d in depGraph[keyword]], globalContext)
-            output["startSents"][keyword] = startSent
-            for dp in depGraph[keyword]:
-                gpt_prompt = f'''Please elaborate the argument "${globalContext}" from the perspective of ${keyword} by considering the following questions: ${dp["content"]}'''
-
-                response = OpenAIClient.chat.completions.create(
-                    model=model_type,
-                    prompt=gpt_prompt,
-                    temperature=tempature,
-                    max_tokens=max_tokens
-                )
-                generations[dp["prompt"]] = response.choices[0].text.strip()
-
-        output["generations"] = generations
-        return jsonify(output)
 
-@app.route("/synthesize", methods=["POST"])
-def synthesize_thesis():
-    if request.method == "POST":
-        response = request.get_json()
+async def synthesizeHandler(response):
+    keyPoints = response["keyPoints"]
+    keyPointsSentence = ""
 
-        keyPoints = response["keyPoints"]
-        keyPointsSentence = ""
+    for index, point in enumerate(keyPoints, 1):
+        keyPointsSentence += f"{index}. {point}\n"
 
-        for index, point in enumerate(keyPoints, 1):
-            keyPointsSentence += f"{index}. {point}\n"
-        
-        print("key point sentence is", keyPointsSentence)
-        messages = [
-            {"role": "system", "content": "You are a helpful writing assistant. Your student has gathered several key points/facts, but he cannot see the bigger picture of these ideas. Therefore, you are given those key points/facts, and you need to think of the thesis statement that introduces the main topic and purpose of those key points/facts."},
-            {"role": "user", "content": '''Here are several separate key points:
+    routeLogger("synthesize").debug("key point sentence: %s", Payload(keyPointsSentence))
+    messages = [
+        {"role": "system", "content": "You are a helpful writing assistant. Your student has gathered several key points/facts, but he cannot see the bigger picture of these ideas. Therefore, you are given those key points/facts, and you need to think of the thesis statement that introduces the main topic and purpose of those key points/facts."},
+        {"role": "user", "content": '''Here are several separate key points:
 1. In healthcare, AI algorithms can analyze medical data to provide accurate diagnoses and personalized treatment plans, while machine learning models predict disease outbreaks, enabling preventative measures. Additionally, robotic surgery, powered by AI, offers precision and reduces recovery time for patients.
 2. For sustainable development, AI optimizes the performance and efficiency of renewable energy sources like wind and solar power. Smart grids, managed by AI, balance energy supply and demand, reducing wastage. Furthermore, predictive maintenance, facilitated by AI, minimizes downtime and repair costs for renewable energy infrastructure.
 3. In education, AI-driven personalized learning platforms adapt to individual student needs, enhancing learning outcomes. Virtual tutors, powered by AI, provide round-the-clock assistance and support to students. Data analytics in education helps identify areas where students struggle, allowing for targeted interventions.
 
 Please synthesize these key points into a cohesive thesis statement.'''},
-            {"role": "assistant", "content":"The integration of artificial intelligence (AI) into various sectors can lead to significant advancements in healthcare, sustainable development through renewable energy, and education technology, ultimately transforming society."},
-            {"role": "user", "content":f'''Here are several separate key points:
-             {keyPointsSentence}
+        {"role": "assistant", "content":"The integration of artificial intelligence (AI) into various sectors can lead to significant advancements in healthcare, sustainable development through renewable energy, and education technology, ultimately transforming society."},
+        {"role": "user", "content":f'''Here are several separate key points:
+         {keyPointsSentence}
 Please synthesize these key points into a cohesive thesis statement.'''}
-        ]
+    ]
+
+    if wantsStream(response):
+        return StreamedCompletion(messages, "synthesize", "response", lambda text: text.strip())
+
+    choices = await chatCompletion(messages, "synthesize")
+
+    res = choices[0].strip()
+
+    response = {"response": res}
+    return response
+
+
+@app.route("/synthesize", methods=["POST"])
+def synthesize_thesis():
+    return flaskResponse(synthesizeHandler)
+
+
+# the LLM routes by path, asgi_server.py serves these natively on its event loop
+llmHandlers = {
+    "/implementTopicSentence": implementTopicSentenceHandler,
+    "/implementCounterArgument": implementCounterArgumentHandler,
+    "/implementSupportingArgument": implementSupportingArgumentHandler,
+    "/implementElaboration": implementElaborationHandler,
+    "/implementKeyword": implementKeywordHandler,
+    "/keyword": keywordHandler,
+    "/prompts": promptsHandler,
+    "/rewrite": rewriteHandler,
+    "/getWeakness": getWeaknessHandler,
+    "/supportingArguments": supportingArgumentsHandler,
+    "/counterArguments": counterArgumentsHandler,
+    "/completion": completionHandler,
+    "/generateFromDepGraph": generateFromDepGraphHandler,
+    "/generateFromSketch": generateFromSketchHandler,
+    "/synthesize": synthesizeHandler,
+}
+
+
+def bulkJob(handler):
+    # the LLM calls of a job are bulk work of the user who submitted it
+    async def run(payload, job):
+        return await runAs((job.username, "bulk"), handler(payload, job))
+    return run
+
+
+# the generations that can also run as background jobs, by kind
+jobRunner.register("generateFromDepGraph", bulkJob(generateFromDepGraphHandler))
+jobRunner.register("generateFromSketch", bulkJob(generateFromSketchHandler))
+
+
+def jobSummary(document):
+    summary = {"jobId": document["_id"], "kind": document["kind"], "status": document["status"], "progress": document.get("progress")}
+    for field in ("error", "result", "nodes", "resumedNodes"):
+        if document.get(field) is not None:
+            summary[field] = document[field]
+    return summary
+
+
+# submit a generation as a background job, with the request body of its route. The same request submitted again
+# returns the same job, or resumes it when it failed or was interrupted.
+@app.route("/jobs/<kind>", methods=["POST"])
+def submitJob(kind):
+    if kind not in jobRunner.kinds:
+        return jsonify({"status": "fail", "message": f"Unknown job kind {kind}"}), 404
+    response = request.get_json()
+    document = runOnLoop(jobRunner.submit(kind, response, callerOf(response, request.path, request.headers)[0]))
+    if document is None:
+        return jsonify({"status": "fail", "message": "Too many jobs are queued, please retry later"}), 503
+    return jsonify(jobSummary(document)), 202
+
+
+# poll a job: its status and progress, the results of the nodes done so far and the result once it is done. Only
+# the user who submitted the job sees it, given as ?username= or X-Username like in the request that submitted it.
+@app.route("/jobs/<jobId>", methods=["GET"])
+def jobStatus(jobId):
+    document = runOnLoop(jobRunner.status(jobId, callerOf(request.args, request.path, request.headers)[0]))
+    if document is None:
+        return jsonify({"status": "fail", "message": "Job not found"}), 404
+    return jsonify(jobSummary(document))
 
-        response = OpenAIClient.chat.completions.create(
-            model=model_type,
-            messages=messages,
-            temperature=tempature,
-            max_tokens=max_tokens
-        )
 
-        res = response.choices[0].message.content.strip()
+# follow a job as server-sent events, see JobRunner.events
+@app.route("/jobs/<jobId>/events", methods=["GET"])
+def jobEvents(jobId):
+    username = callerOf(request.args, request.path, request.headers)[0]
+    g.metricsStreaming = True
 
-        response = {"response": res}
-        return jsonify(response)
+    def events():
+        try:
+            yield from iterateOnLoop(jobRunner.events(jobId, username))
+        finally:
+            finishRequestMetrics()
 
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers=sseHeaders)
 
 
 if __name__ == '__main__':
+    # exit normally on SIGTERM (e.g. docker stop) so the pending interaction data is written by the atexit hooks
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True, port=5000, host="127.0.0.1")
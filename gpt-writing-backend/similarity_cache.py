@@ -0,0 +1,294 @@
+import re
+import time
+import zlib
+import random
+import threading
+import numpy as np
+from metrics import Counter, Histogram
+
+similarityLookups = Counter("visar_similarity_cache_lookups_total", "Lookups of the approximate-match cache", ["namespace", "result"])
+similarityScores = Histogram("visar_similarity_cache_best_score", "Similarity of the closest cached prompt at every lookup", ["namespace"],
+                             buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 0.99, 1))
+similarityAudits = Counter("visar_similarity_cache_audits_total", "Cache hits checked against a fresh result", ["namespace", "result"])
+
+
+# words that carry no meaning of their own in an argument, they are left out of the vectors
+stopWords = frozenset("""a an the and or but if so as at by for from in into of on onto to with about than then that this these those
+it its it's there their they them we our us you your i me my he him his she her be is are was were been being am do does did
+has have had having which who whom what when where while also just very too quite really much many""".split())
+
+# words that turn a statement around. Every one of them flips the polarity of the prompt.
+negations = frozenset("not no never nor none nobody nothing neither without cannot hardly barely".split())
+
+# evaluative words and their antonyms share one feature, the antonym flips the polarity, e.g. "a bad city" has the
+# features of "a good city" with the opposite polarity. Synonyms share the feature as well: "great" is "good".
+evaluations = {word: (feature, sign) for feature, sign, words in [
+    ("good", 1, "good great excellent nice wonderful fantastic amazing awesome fine best better beneficial positive favorable"),
+    ("good", -1, "bad terrible awful poor horrible dreadful worst worse harmful negative unfavorable"),
+    ("more", 1, "more most increase increases increased"),
+    ("more", -1, "less least fewer fewest decrease decreases decreased"),
+] for word in words.split()}
+
+
+def stem(word):
+    # a crude suffix stripper, so that "city" and "cities" or "charge" and "charging" share their feature
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith("es") and len(word) > 4 and word[-3] in "sxz":
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    if word.endswith("ing") and len(word) > 5:
+        return word[:-3]
+    if word.endswith("ed") and len(word) > 4:
+        return word[:-2]
+    return word
+
+
+def terms(text):
+    # the content words of a prompt, stemmed, and its polarity (1 or -1)
+    words = re.findall(r"\w+(?:'\w+)?", text.lower().replace("\u2019", "'"))
+    features = []
+    flips = 0
+    balance = 0
+    for word in words:
+        if word in negations or word.endswith("n't"):
+            flips += 1
+        elif word in evaluations:
+            feature, sign = evaluations[word]
+            features.append(feature)
+            balance += sign
+        elif word not in stopWords:
+            features.append(stem(word.split("'")[0]))
+    if balance < 0:
+        flips += 1
+    return features, -1 if flips % 2 else 1
+
+
+def features(text):
+    return terms(text)[0]
+
+
+def sameWords(first, second):
+    # whether two prompts have the same content words in the same order. Any added word may change the claim, "a good
+    # city" and "a good city to avoid" differ by one, "remote work is better than office work" and "office work is
+    # better than remote work" reorder them, "nuclear power is the best way" and "solar power is the best way" replace one.
+    return first == second
+
+
+def vectorize(text, dimensions, words=None):
+    # hashed word frequencies (1 + log count), without the IDF which depends on what is cached
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature in features(text) if words is None else words:
+        vector[zlib.crc32(feature.encode("utf-8")) % dimensions] += 1
+    nonzero = vector > 0
+    vector[nonzero] = 1 + np.log(vector[nonzero])
+    return vector
+
+
+def resultText(value):
+    # the text of a cached result, to compare it with a fresh one
+    if isinstance(value, dict):
+        return " ".join(resultText(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return " ".join(resultText(item) for item in value)
+    return str(value)
+
+
+class Hit:
+    def __init__(self, namespace, value, score):
+        self.namespace = namespace
+        self.value = value
+        self.score = score
+
+
+class SimilarityIndex:
+    # the prompts of one namespace: a fixed matrix of hashed TF vectors, rows are reused when entries are evicted.
+    # `weighted` holds the same rows weighted by IDF and normalized, so a lookup is a single matrix-vector product.
+    # The IDF is a snapshot that is refreshed whenever the number of entries changed by a quarter. A prompt only
+    # matches the prompts of its own polarity with the same content words (see sameWords), the `candidates` closest
+    # ones are checked.
+
+    def __init__(self, capacity, dimensions, candidates=8):
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.weighted = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.scopeHashes = np.zeros(capacity, dtype=np.int64)
+        self.polarities = np.zeros(capacity, dtype=np.int8)
+        self.expiresAt = np.zeros(capacity)
+        self.lastUsed = np.zeros(capacity)
+        self.scopes = [None] * capacity
+        self.values = [None] * capacity
+        self.words = [None] * capacity
+        self.candidates = candidates
+        self.documentFrequency = np.zeros(dimensions, dtype=np.float32)
+        self.entries = 0
+        self.idf = np.ones(dimensions, dtype=np.float32)
+        self.idfEntries = 0
+
+    def weigh(self, vector):
+        weighted = vector * self.idf
+        return weighted / max(float(np.linalg.norm(weighted)), 1e-9)
+
+    def refreshWeights(self):
+        if abs(self.entries - self.idfEntries) * 4 <= self.idfEntries:
+            return
+        # the prompt that is looked up counts as a document as well, so in a small cache a word that is new to it
+        # does not outweigh the words the prompts share
+        self.idf = (np.log((2 + self.entries) / (2 + self.documentFrequency)) + 1).astype(np.float32)
+        self.idfEntries = self.entries
+        weighted = self.vectors * self.idf
+        self.weighted = weighted / np.maximum(np.linalg.norm(weighted, axis=1, keepdims=True), 1e-9)
+
+    def evict(self, row):
+        self.documentFrequency -= self.vectors[row] > 0
+        self.used[row] = False
+        self.scopes[row] = None
+        self.values[row] = None
+        self.words[row] = None
+        self.entries -= 1
+
+    def closest(self, scope, words, polarity, vector, now):
+        # (row, cosine similarity) of the closest live entry of the scope that matches, None if there is none
+        if self.entries == 0:
+            return None
+        candidates = self.used & (self.scopeHashes == zlib.crc32(scope.encode("utf-8"))) & (self.polarities == polarity)
+        expired = candidates & (self.expiresAt <= now)
+        if expired.any():
+            for row in np.flatnonzero(expired):
+                self.evict(row)
+            candidates &= ~expired
+        if not candidates.any():
+            return None
+        scores = self.weighted @ self.weigh(vector)
+        scores[~candidates] = -1
+        for row in np.argsort(-scores)[:self.candidates]:
+            if scores[row] < 0:
+                break
+            # the scope is compared as well, two scopes may have the same hash
+            if self.scopes[row] == scope and sameWords(self.words[row], words):
+                return int(row), float(scores[row])
+        return None
+
+    def insert(self, scope, words, polarity, vector, value, expiresAt, now):
+        free = np.flatnonzero(~self.used)
+        if len(free) > 0:
+            row = int(free[0])
+            evicted = False
+        else:
+            row = int(np.argmin(self.lastUsed))
+            self.evict(row)
+            evicted = True
+        self.vectors[row] = vector
+        self.used[row] = True
+        self.scopeHashes[row] = zlib.crc32(scope.encode("utf-8"))
+        self.polarities[row] = polarity
+        self.expiresAt[row] = expiresAt
+        self.lastUsed[row] = now
+        self.scopes[row] = scope
+        self.values[row] = value
+        self.words[row] = words
+        self.documentFrequency += vector > 0
+        self.entries += 1
+        self.weighted[row] = self.weigh(vector)
+        self.refreshWeights()
+        return evicted
+
+
+class SimilarityCache:
+    '''
+    Serves a stored result for a prompt that is worded differently from one answered before, e.g. "Houston is a
+    good city" and "houston is a great city!".
+
+    Prompts are compared by the cosine similarity of their TF-IDF vectors over their content words, hashed into
+    `dimensions` features. Stop words are left out, words are stemmed, and evaluative words share a feature with
+    their synonyms and antonyms (see terms). Results are only reused within their namespace (the route) and scope
+    (e.g. the perspective of a discussion point request), only above `threshold`, and only between prompts of the
+    same polarity with the same content words: "Houston is not a good city", "Houston is a bad city", "Houston is a
+    good city to avoid" and "Dallas is a good city" never reuse the result of "Houston is a good city". Every namespace holds at most `capacity`
+    entries in a fixed NumPy matrix, the least recently used one is evicted, and entries expire after `ttl` seconds.
+
+    A share (`auditRate`) of the hits is audited: the caller computes the fresh result as well and reports it with
+    audit(). A fresh result whose text is less than `auditAgreement` similar to the reused one counts as a false
+    reuse. The caller then stores the fresh result for its own prompt, which from then on is closer than the one
+    that was reused.
+    '''
+
+    def __init__(self, threshold=0.85, capacity=2000, dimensions=1024, ttl=7 * 24 * 3600, auditRate=0.05, auditAgreement=0.5):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.dimensions = dimensions
+        self.ttl = ttl
+        self.auditRate = auditRate
+        self.auditAgreement = auditAgreement
+        self.lock = threading.Lock()
+        self.indexes = {}  # namespace -> SimilarityIndex
+        self.counters = {}  # namespace -> counters
+
+    def index(self, namespace):
+        if namespace not in self.indexes:
+            self.indexes[namespace] = SimilarityIndex(self.capacity, self.dimensions)
+            self.counters[namespace] = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0, "audits": 0, "falseReuses": 0}
+        return self.indexes[namespace]
+
+    def lookup(self, namespace, scope, text):
+        # the Hit of the most similar matching prompt above the threshold, None on a miss
+        words, sign = terms(text)
+        vector = vectorize(text, self.dimensions, words)
+        now = time.time()
+        with self.lock:
+            index = self.index(namespace)
+            closest = index.closest(scope, words, sign, vector, now)
+            if closest is not None:
+                similarityScores.observe(closest[1], namespace=namespace)
+            if closest is None or closest[1] < self.threshold:
+                self.counters[namespace]["misses"] += 1
+                similarityLookups.inc(namespace=namespace, result="miss")
+                return None
+            row, score = closest
+            index.lastUsed[row] = now
+            self.counters[namespace]["hits"] += 1
+            similarityLookups.inc(namespace=namespace, result="hit")
+            return Hit(namespace, index.values[row], score)
+
+    def store(self, namespace, scope, text, value):
+        words, sign = terms(text)
+        vector = vectorize(text, self.dimensions, words)
+        now = time.time()
+        with self.lock:
+            index = self.index(namespace)
+            closest = index.closest(scope, words, sign, vector, now)
+            if closest is not None and closest[1] >= 0.999:
+                # the same prompt again, keep the newer result
+                index.values[closest[0]] = value
+                index.expiresAt[closest[0]] = now + self.ttl
+                index.lastUsed[closest[0]] = now
+            elif index.insert(scope, words, sign, vector, value, now + self.ttl, now):
+                self.counters[namespace]["evictions"] += 1
+            self.counters[namespace]["writes"] += 1
+
+    def shouldAudit(self):
+        return random.random() < self.auditRate
+
+    def audit(self, hit, fresh):
+        # compare a reused result with the fresh one, returns whether the reuse was acceptable
+        reused = vectorize(resultText(hit.value), self.dimensions)
+        current = vectorize(resultText(fresh), self.dimensions)
+        agreement = float(reused @ current / max(np.linalg.norm(reused) * np.linalg.norm(current), 1e-9))
+        agreed = agreement >= self.auditAgreement
+        with self.lock:
+            self.counters[hit.namespace]["audits"] += 1
+            if not agreed:
+                self.counters[hit.namespace]["falseReuses"] += 1
+        similarityAudits.inc(namespace=hit.namespace, result="agree" if agreed else "false_reuse")
+        return agreed
+
+    def stats(self):
+        with self.lock:
+            stats = {}
+            for namespace, counters in self.counters.items():
+                lookups = counters["hits"] + counters["misses"]
+                stats[namespace] = dict(counters, entries=self.indexes[namespace].entries,
+                                        hitRate=counters["hits"] / lookups if lookups else 0.0,
+                                        falseReuseRate=counters["falseReuses"] / counters["audits"] if counters["audits"] else 0.0)
+            return dict(stats, threshold=self.threshold)
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls: while a call for a key is in flight, every other caller with the same key
+    waits for that call and gets its result (or its exception) instead of making its own.
+
+    The shared call runs as a task, so a caller that goes away (e.g. a disconnected client) does not cancel it for the
+    others. Calls are only shared between callers on the same event loop.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # (loop, key) -> task
+        self.counters = {"calls": 0, "collapsed": 0}
+        self.collapsedBy = {}  # label -> collapsed calls
+
+    async def do(self, key, function, label=None):
+        # returns the result of `await function()`, or of the identical call already in flight
+        loop = asyncio.get_running_loop()
+        flightKey = (loop, key)
+        with self.lock:
+            self.counters["calls"] += 1
+            task = self.flights.get(flightKey)
+            if task is not None:
+                self.counters["collapsed"] += 1
+                self.collapsedBy[label] = self.collapsedBy.get(label, 0) + 1
+            else:
+                task = loop.create_task(function())
+                self.flights[flightKey] = task
+                task.add_done_callback(lambda _: self.forget(flightKey))
+        return await asyncio.shield(task)
+
+    def forget(self, flightKey):
+        with self.lock:
+            self.flights.pop(flightKey, None)
+
+    def stats(self):
+        with self.lock:
+            calls = self.counters["calls"]
+            return dict(self.counters, inFlight=len(self.flights), collapsedBy=dict(self.collapsedBy),
+                        collapseRate=self.counters["collapsed"] / calls if calls else 0.0)
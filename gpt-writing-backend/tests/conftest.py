@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import types
+import importlib
+import pytest
+
+# The tests run the Flask app against an in-memory MongoDB (the mongomock package, like bench/serve.py) and a fake
+# OpenAI client that answers from a script. Run them from the repository root with `python -m pytest gpt-writing-backend/tests`.
+
+backendDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, backendDir)
+
+
+class FakeCompletions:
+    # chat.completions of the OpenAI client: every call is recorded and answered by `reply(params)`
+
+    def __init__(self):
+        self.calls = []
+        self.reply = lambda params: "1. First point\n2. Second point"
+
+    async def create(self, **params):
+        self.calls.append(params)
+        text = self.reply(params)
+        message = types.SimpleNamespace(content=text)
+        choice = types.SimpleNamespace(message=message, text=text, finish_reason="stop")
+        return types.SimpleNamespace(choices=[choice] * params.get("n", 1), usage=None)
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    mongomock = pytest.importorskip("mongomock")
+    import pymongo
+    workDir = tmp_path_factory.mktemp("visar")
+    with open(workDir / "openai_key.json", "w") as key_file:
+        json.dump({"key": "test"}, key_file)
+    with open(workDir / "mongoDB_key.json", "w") as key_file:
+        json.dump({"key": "mongodb://127.0.0.1:27017"}, key_file)
+    os.chdir(workDir)
+    pymongo.MongoClient = mongomock.MongoClient
+    server = importlib.import_module("server")
+    # mongomock has no $lookup with let, the editor state is loaded without the preload
+    server.enablePreload = False
+    return server
+
+
+@pytest.fixture
+def llm(server, monkeypatch):
+    completions = FakeCompletions()
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions))
+    monkeypatch.setattr(server.llmGateway, "client", lambda: client)
+    monkeypatch.setattr(server, "enableCompletionCache", False)
+    monkeypatch.setattr(server, "enableSimilarityCache", False)
+    monkeypatch.setattr(server, "enablePrefetch", False)
+    return completions
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
@@ -0,0 +1,38 @@
+import pytest
+
+corsNames = ["access-control-allow-origin", "access-control-allow-headers", "access-control-allow-methods", "vary"]
+
+
+@pytest.fixture
+def asgiClient(server):
+    pytest.importorskip("a2wsgi")
+    testclient = pytest.importorskip("starlette.testclient")
+    import asgi_server
+    return testclient.TestClient(asgi_server.asgiApp, raise_server_exceptions=False)
+
+
+def corsOf(res):
+    return {name: res.headers.get(name) for name in corsNames}
+
+
+@pytest.mark.parametrize("headers", [
+    # the frontend sends an Access-Control-Allow-Origin request header
+    {"Origin": "http://localhost:3000", "Access-Control-Request-Method": "POST", "Access-Control-Request-Headers": "Access-Control-Allow-Origin, Content-Type"},
+    {"Access-Control-Request-Method": "POST", "Access-Control-Request-Headers": "content-type"},
+])
+def test_preflightMatchesFlask(client, asgiClient, headers):
+    flask = client.options("/keyword", headers=headers)
+    asgi = asgiClient.options("/keyword", headers=headers)
+    assert asgi.status_code == flask.status_code == 200
+    assert corsOf(asgi) == corsOf(flask)
+    assert asgi.headers["access-control-allow-headers"].lower() == headers["Access-Control-Request-Headers"].lower()
+
+
+@pytest.mark.parametrize("body, status", [({"json": {}}, 500), ({"content": "{not json", "headers": {"Content-Type": "application/json"}}, 400)])
+def test_errorsCarryCorsHeaders(client, asgiClient, llm, server, monkeypatch, body, status):
+    monkeypatch.setitem(server.app.config, "PROPAGATE_EXCEPTIONS", False)
+    origin = {"Origin": "http://localhost:3000"}
+    flask = client.post("/keyword", headers={**origin, **body.get("headers", {})}, data=body.get("content"), json=body.get("json"))
+    asgi = asgiClient.post("/keyword", headers={**origin, **body.get("headers", {})}, content=body.get("content"), json=body.get("json"))
+    assert asgi.status_code == flask.status_code == status
+    assert corsOf(asgi) == corsOf(flask)
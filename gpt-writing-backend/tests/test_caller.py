@@ -0,0 +1,23 @@
+from llm_scheduler import currentCaller
+
+# the headers the editor sends with its LLM calls (ElaborateFloatGroup.js), the username is not part of the body
+editorHeaders = {
+    "X-Username": "alice",
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*",
+}
+
+
+def test_llmCallsRunForTheEditorUser(client, llm):
+    callers = []
+
+    def reply(params):
+        callers.append(currentCaller.get())
+        return "1. Job market in Houston\n2. Cost of living"
+
+    llm.reply = reply
+    body = {"keywords": ["economy"], "context": "Houston is a good city"}
+    response = client.post("/prompts", json=body, headers=editorHeaders)
+    assert response.status_code == 200
+    assert callers and all(caller == ("alice", "interactive") for caller in callers)
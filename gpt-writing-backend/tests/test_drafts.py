@@ -0,0 +1,37 @@
+fullSections = {"draft": "d", "depGraph": "{}", "editorState": "e", "flowSlice": "f", "editorSlice": "s"}
+
+
+def signup(client, username):
+    assert client.post("/signup", json={"username": username, "condition": "1"}).get_json()["status"] == "success"
+
+
+def test_partialFirstSaveIsRejected(client):
+    signup(client, "partial-first")
+    res = client.post("/saveDraft", json={"username": "partial-first", "sessionId": 1, "condition": "1", "baseVersion": 0,
+                                          "sections": {"draft": "only the draft"}})
+    assert res.status_code == 400
+    assert client.post("/loadDraft", json={"username": "partial-first"}).get_json()["status"] == "fail"
+
+    res = client.post("/saveDraft", json={"username": "partial-first", "sessionId": 1, "condition": "1", "baseVersion": 0,
+                                          "sections": fullSections})
+    assert res.status_code == 200
+    res = client.post("/saveDraft", json={"username": "partial-first", "sessionId": 1, "condition": "1", "baseVersion": 1,
+                                          "sections": {"editorState": "e2"}})
+    assert res.get_json()["version"] == 2
+    loaded = client.post("/loadDraft", json={"username": "partial-first"}).get_json()
+    assert (loaded["editorState"], loaded["flowSlice"], loaded["editorSlice"]) == ("e2", "f", "s")
+
+
+def test_missingSectionsLoadEmpty(client, server, monkeypatch):
+    # a draft stored without some sections, e.g. by a partial first save before they were rejected
+    signup(client, "partial-stored")
+    server.db.drafts.insert_one({"username": "partial-stored", "sessionId": 3, "draft": "d", "version": 1})
+    server.db.users.update_one({"username": "partial-stored"}, {"$set": {"latestSessionId": 3}})
+
+    loaded = client.post("/loadDraft", json={"username": "partial-stored"}).get_json()
+    assert loaded["status"] == "success"
+    assert (loaded["editorState"], loaded["flowSlice"], loaded["editorSlice"]) == ("", "", "")
+
+    monkeypatch.setattr(server, "enablePreload", True)
+    res = client.post("/signup", json={"username": "partial-stored", "condition": "1"})
+    assert res.status_code == 200 and res.get_json()["editorState"] == ""
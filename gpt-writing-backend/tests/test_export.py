@@ -0,0 +1,28 @@
+import pytest
+
+exportToken = "export-token"
+
+
+@pytest.fixture
+def exportClient(client, server, monkeypatch):
+    monkeypatch.setattr(server, "exportToken", exportToken)
+    return client
+
+
+def export(client, collection, query):
+    return client.get(f"/export/{collection}?{query}", headers={"Authorization": f"Bearer {exportToken}"})
+
+
+@pytest.mark.parametrize("query", ["after=not-an-id", "since=yesterday", "until=tomorrow"])
+def test_invalidFilterIsRejected(exportClient, query):
+    response = export(exportClient, "drafts", query)
+    assert response.status_code == 400
+    assert response.get_json()["status"] == "fail"
+
+
+def test_exportContinuesAfterTheLastLine(exportClient, server):
+    ids = server.db.interactionData.insert_many([{"username": "export-test", "type": "click"} for _ in range(2)]).inserted_ids
+    response = export(exportClient, "interactionData", f"username=export-test&after={ids[0]}")
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 1 and str(ids[1]) in lines[0]
@@ -0,0 +1,28 @@
+import asyncio
+import pytest
+from jobs import JobRunner
+
+
+def test_concurrentIdenticalSubmitsRunOnce():
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().db
+    runner = JobRunner(db.jobs, db.results)
+    runs = []
+
+    async def generate(payload, job):
+        runs.append(payload)
+        await job.nodeDone("node", "text")
+        return "result"
+
+    runner.register("generate", generate)
+
+    async def main():
+        submitted = await asyncio.gather(*[runner.submit("generate", {"prompt": "p"}, "alice") for _ in range(3)])
+        while runner.running:
+            await asyncio.sleep(0.01)
+        return submitted
+
+    submitted = asyncio.run(main())
+    assert len({document["_id"] for document in submitted}) == 1
+    assert runs == [{"prompt": "p"}]
+    assert runner.stats()["submitted"] == 1
@@ -0,0 +1,36 @@
+import pytest
+
+pointsOf = {
+    "economy": "1. Job market in Houston\n2. Cost of living",
+    "safety": "1. Crime rate\n2. Emergency services: response times",
+}
+
+
+def batchedReply(params):
+    return "\n".join(f"Perspective: {key}\n{points}" for key, points in pointsOf.items())
+
+
+def parallelReply(params):
+    prompt = params["messages"][-1]["content"]
+    return next(points for key, points in pointsOf.items() if prompt.endswith(f"perspective of {key}"))
+
+
+@pytest.mark.parametrize("reply", [
+    "1. Job market in Houston\n2. Cost of living",
+    "Here are some discussion points:\n1. Job market in Houston\n2. Cost of living",
+    "- Job market in Houston\n- Cost of living",
+])
+def test_parseKeepsTheFirstPoint(server, reply):
+    assert [point["prompt"] for point in server.parseDiscussionPoints(reply, "economy")] == ["Job market in Houston", "Cost of living"]
+
+
+def test_batchedReturnsTheParallelPoints(client, llm, monkeypatch, server):
+    body = {"keywords": ["economy", "safety"], "context": "Houston is a good city"}
+    monkeypatch.setattr(server, "promptsMode", "parallel")
+    llm.reply = parallelReply
+    parallel = client.post("/prompts", json=body).get_json()["response"]
+    monkeypatch.setattr(server, "promptsMode", "batched")
+    llm.reply = batchedReply
+    batched = client.post("/prompts", json=body).get_json()["response"]
+    assert len(parallel) == 4
+    assert batched == parallel
@@ -0,0 +1,24 @@
+from reference_cache import ReadThroughCache
+
+
+def test_invalidateDuringLoadIsNotLost():
+    stored = {"topic": "old"}
+
+    def loader(key):
+        value = stored[key]
+        # the document is edited and the cache invalidated while this load is in flight
+        stored[key] = "new"
+        cache.invalidate(key if len(loads) == 0 else None)
+        loads.append(key)
+        return value
+
+    loads = []
+    cache = ReadThroughCache(loader)
+    assert cache.get("topic") == "old"
+    assert cache.get("topic") == "new"
+    # the same for invalidating everything
+    stored["topic"] = "old"
+    cache.invalidate()
+    assert cache.get("topic") == "old"
+    cache.loader = lambda key: stored[key]
+    assert cache.get("topic") == "new"
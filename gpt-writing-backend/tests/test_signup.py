@@ -0,0 +1,15 @@
+def test_concurrentSignupOfTheSameUsername(client, server, monkeypatch):
+    assert client.post("/signup", json={"username": "racing", "condition": "1"}).status_code == 200
+    # the second signup looks the username up before the first one inserted it
+    findOne = server.db.users.find_one
+    lookups = []
+
+    def racingFindOne(*args, **kwargs):
+        lookups.append(args)
+        return None if len(lookups) == 1 else findOne(*args, **kwargs)
+
+    monkeypatch.setattr(server.db.users, "find_one", racingFindOne)
+    res = client.post("/signup", json={"username": "racing", "condition": "1"})
+    assert res.status_code == 200
+    assert res.get_json()["status"] == "success"
+    assert server.db.users.count_documents({"username": "racing"}) == 1
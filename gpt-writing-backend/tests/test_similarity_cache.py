@@ -0,0 +1,44 @@
+import pytest
+from similarity_cache import SimilarityCache
+
+
+@pytest.fixture
+def cache():
+    cache = SimilarityCache(threshold=0.7)
+    cache.store("/keyword", "", "Houston is a good city", "cached")
+    return cache
+
+
+@pytest.mark.parametrize("prompt", [
+    "Houston is a good city",
+    "houston is a great city!",
+    "Houston is a good cities",
+])
+def test_rewordingHits(cache, prompt):
+    hit = cache.lookup("/keyword", "", prompt)
+    assert hit is not None and hit.value == "cached"
+
+
+@pytest.mark.parametrize("prompt", [
+    "Houston is not a good city",
+    "Houston isn't a good city",
+    "Houston is a bad city",
+    "Houston is a good city to avoid",
+    "Houston is a great city to live in",
+    "Houston is a good city for oil companies",
+    "Houston is a good city for business but not to live in",
+    "Dallas is a good city",
+])
+def test_differentClaimMisses(cache, prompt):
+    assert cache.lookup("/keyword", "", prompt) is None
+
+
+def test_addedWordsMissInBothDirections():
+    cache = SimilarityCache(threshold=0.7)
+    cache.store("/keyword", "", "Public transportation should be free for students", "students")
+    assert cache.lookup("/keyword", "", "Public transportation should be free") is None
+
+
+def test_resultsStayInTheirScope(cache):
+    assert cache.lookup("/keyword", "economy", "Houston is a good city") is None
+    assert cache.lookup("/prompts", "", "Houston is a good city") is None
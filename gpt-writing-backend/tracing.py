@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+import itertools
+import contextvars
+import collections
+from contextlib import contextmanager
+from pymongo import monitoring
+from mongo_metrics import CommandMetrics
+
+# The span that code running now belongs to. Context variables follow asyncio tasks and run_coroutine_threadsafe,
+# so the spans of the LLM handlers end up in the trace of the request that started them.
+currentSpan = contextvars.ContextVar("currentSpan", default=None)
+
+
+class Span:
+    def __init__(self, trace, name, parent, attributes):
+        self.trace = trace
+        self.name = name
+        self.spanId = next(trace.tracer.ids)
+        self.parentId = parent.spanId if parent is not None else None
+        self.attributes = attributes
+        # concurrent tasks of the same request get their own lane, so their spans do not overlap in the viewer
+        try:
+            self.lane = id(asyncio.current_task())
+        except RuntimeError:
+            self.lane = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+
+class Trace:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.traceId = next(tracer.ids)
+        self.spans = []
+        self.lock = threading.Lock()
+        self.samples = collections.Counter()  # folded stack -> samples, filled by the profiler
+        self.root = Span(self, name, None, attributes)
+        self.spans.append(self.root)
+        self.token = None
+
+
+class Tracer:
+    '''
+    Opt-in per-request tracing.
+
+    A sampled request gets a trace: a tree of spans (the route, the nodes of a dependency graph, every LLM call,
+    every MongoDB command, the encoding of the response). Finished traces are appended to `path` in the Chrome trace
+    event format, which Perfetto (ui.perfetto.dev) and chrome://tracing open directly.
+
+    With `profileSlowSeconds` set, a sampling profiler records the stacks of every thread of the process while traced
+    requests run. The samples of a request that took longer than `profileSlowSeconds` are written to
+    `profileDirectory` in the folded stack format (flamegraph.pl, speedscope).
+    '''
+
+    def __init__(self, path="traces.json", sampleRate=0.1, enabled=False, profileSlowSeconds=None,
+                 profileDirectory="profiles", profileInterval=0.01):
+        self.path = path
+        self.sampleRate = sampleRate
+        self.enabled = enabled
+        self.profileSlowSeconds = profileSlowSeconds
+        self.profileDirectory = profileDirectory
+        self.profileInterval = profileInterval
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.active = set()  # traces being profiled
+        self.profiler = None
+        self.counters = {"traces": 0, "profiles": 0}
+
+    def startTrace(self, name, force=False, **attributes):
+        # start the trace of a request and make its root the current span. Returns the trace, or None when the
+        # request is not sampled. `force` traces the request regardless of the sample rate.
+        if not self.enabled or (not force and random.random() >= self.sampleRate):
+            return None
+        trace = Trace(self, name, attributes)
+        if self.profileSlowSeconds is not None:
+            self.startProfiler()
+            with self.lock:
+                self.active.add(trace)
+        trace.token = currentSpan.set(trace.root)
+        return trace
+
+    def finishTrace(self, trace, **attributes):
+        if trace is None:
+            return
+        try:
+            currentSpan.reset(trace.token)
+        except ValueError:
+            # finished from another context than the one it started in, e.g. at the end of a streamed response
+            pass
+        root = trace.root
+        root.end = time.perf_counter()
+        root.attributes.update(attributes)
+        with self.lock:
+            self.active.discard(trace)
+        if self.profileSlowSeconds is not None and root.end - root.start >= self.profileSlowSeconds and trace.samples:
+            root.attributes["profile"] = self.writeProfile(trace)
+        self.writeTrace(trace)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        # a child of the current span, a no-op outside of a sampled request
+        parent = currentSpan.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, parent, attributes)
+        with parent.trace.lock:
+            parent.trace.spans.append(span)
+        token = currentSpan.set(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            currentSpan.reset(token)
+
+    def record(self, name, duration, **attributes):
+        # add a span that just finished after `duration` seconds, e.g. one reported by a driver callback
+        parent = currentSpan.get()
+        if parent is None:
+            return
+        span = Span(parent.trace, name, parent, attributes)
+        span.end = time.perf_counter()
+        span.start = span.end - duration
+        with parent.trace.lock:
+            parent.trace.spans.append(span)
+
+    def writeTrace(self, trace):
+        events = []
+        for span in trace.spans:
+            if span.end is None:
+                # still running, e.g. a background task the request did not wait for
+                continue
+            events.append({"name": span.name, "ph": "X", "pid": trace.traceId, "tid": span.lane,
+                           "ts": round(span.start * 1e6), "dur": round((span.end - span.start) * 1e6),
+                           "args": dict(span.attributes, spanId=span.spanId, parentId=span.parentId)})
+        events.append({"name": "process_name", "ph": "M", "pid": trace.traceId, "args": {"name": f"{trace.root.name} #{trace.traceId}"}})
+        # the array format of the trace event format may omit its closing bracket, so events are simply appended
+        with self.lock:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, "a", encoding="utf-8") as traceFile:
+                if new:
+                    traceFile.write("[\n")
+                for event in events:
+                    traceFile.write(json.dumps(event, default=str) + ",\n")
+            self.counters["traces"] += 1
+
+    def writeProfile(self, trace):
+        os.makedirs(self.profileDirectory, exist_ok=True)
+        path = os.path.join(self.profileDirectory, f"{trace.traceId}-{trace.root.name.strip('/').replace('/', '_') or 'root'}.folded")
+        with open(path, "w", encoding="utf-8") as profileFile:
+            for stack, count in trace.samples.most_common():
+                profileFile.write(f"{stack} {count}\n")
+        self.counters["profiles"] += 1
+        return path
+
+    def startProfiler(self):
+        with self.lock:
+            if self.profiler is None:
+                self.profiler = threading.Thread(target=self.sample, name="SamplingProfiler", daemon=True)
+                self.profiler.start()
+
+    def sample(self):
+        names = {}
+        while True:
+            time.sleep(self.profileInterval)
+            with self.lock:
+                traces = list(self.active)
+            if not traces:
+                continue
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == threading.get_ident():
+                    continue
+                functions = []
+                while frame is not None:
+                    functions.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks.append(";".join([names.get(ident, str(ident))] + functions[::-1]))
+            for trace in traces:
+                with trace.lock:
+                    trace.samples.update(stacks)
+
+    def stats(self):
+        return dict(self.counters, enabled=self.enabled, sampleRate=self.sampleRate, active=len(self.active))
+
+
+class MongoCommandSpans(monitoring.CommandListener):
+    # adds a span for every MongoDB command of a traced request, pass it to MongoClient(event_listeners=[...])
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.lock = threading.Lock()
+        self.collections = {}  # (connection, request id) -> collection
+
+    def started(self, event):
+        if currentSpan.get() is not None:
+            with self.lock:
+                self.collections[(event.connection_id, event.request_id)] = CommandMetrics.collectionOf(event)
+
+    def finish(self, event, **attributes):
+        with self.lock:
+            collection = self.collections.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            self.tracer.record(f"mongo {event.command_name} {collection}", event.duration_micros / 1e6, **attributes)
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        self.finish(event, failure=str(event.failure))
@@ -41,12 +41,14 @@ export const generateRewrite = createAsyncThunk(
   "editor/generateRewrite",
   async (args, { getState }) => {
     // const state = getState();
+    const username = getState().editor.username;
     console.log("[generateRewrite] args:", args);
     // const { basePrompt, mode, furInstruction, curSent } = args;
     const res = await fetch("http://127.0.0.1:5000/rewrite", {
       method: "POST",
       mode: "cors",
       headers: {
+        "X-Username": username,
         "Access-Control-Allow-Origin": "*",
         "Content-Type": "application/json",
         Accept: "application/json",
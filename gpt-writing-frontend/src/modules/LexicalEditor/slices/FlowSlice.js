@@ -77,6 +77,7 @@ export const generateFromDepGraph = createAsyncThunk(
     const dependencyGraph = JSON.parse(
       JSON.stringify(state.flow.dependencyGraph)
     );
+    const username = state.editor.username;
     let rootKeys = [];
 
     // Assume there is an unique root of the dependency graph, fetch the root key
@@ -97,6 +98,7 @@ export const generateFromDepGraph = createAsyncThunk(
       method: "POST",
       mode: "cors",
       headers: {
+        "X-Username": username,
         "Access-Control-Allow-Origin": "*",
         "Content-Type": "application/json",
         Accept: "application/json",
@@ -121,11 +123,13 @@ export const generateFromSketch = createAsyncThunk(
   "flow/generateFromSketch",
   async (editor, { getState }) => {
     const state = getState();
+    const username = state.editor.username;
 
     const res = await fetch("http://127.0.0.1:5000/generateFromSketch", {
       method: "POST",
       mode: "cors",
       headers: {
+        "X-Username": username,
         "Access-Control-Allow-Origin": "*",
         "Content-Type": "application/json",
         Accept: "application/json",
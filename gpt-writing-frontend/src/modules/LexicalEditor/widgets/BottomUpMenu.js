@@ -36,6 +36,7 @@ const BottomUpMenu = ({ editor }) => {
   const dispatch = useDispatch();
   const nodeMappings = useSelector((state) => state.flow.flowEditorNodeMapping);
   const depGraph = useSelector((state) => state.flow.dependencyGraph);
+  const username = useSelector((state) => state.editor.username);
 
   // State to track when to call addThesisToEditor
   const [shouldAddThesis, setShouldAddThesis] = useState(false);
@@ -115,6 +116,7 @@ const BottomUpMenu = ({ editor }) => {
       method: "POST",
       mode: "cors",
       headers: {
+        "X-Username": username,
         Accept: "application/json",
         "Content-Type": "application/json",
         "Access-Control-Allow-Origin": "*",
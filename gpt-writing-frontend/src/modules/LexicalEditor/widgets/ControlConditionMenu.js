@@ -37,6 +37,7 @@ export default function ControlConditionMenu ({ editor }) {
   const dispatch = useDispatch()
   const nodeData = useSelector(state => state.flow.nodeData)
   const nodeMappings = useSelector(state => state.flow.flowEditorNodeMapping)
+  const username = useSelector(state => state.editor.username)
   const showDependencies = useCallback(() => {
     const selection = $getSelection()
 
@@ -99,6 +100,7 @@ export default function ControlConditionMenu ({ editor }) {
       method: 'POST',
       mode: 'cors',
       headers: {
+        'X-Username': username,
         'Content-Type': 'application/json',
         Accept: 'application/json',
         'Access-Control-Allow-Origin': '*'
@@ -118,7 +120,7 @@ export default function ControlConditionMenu ({ editor }) {
           editor.dispatchCommand(SHOW_LOADING_COMMAND, {show: false})
         })
       })
-  }, [])
+  }, [username])
 
   useEffect(() => {
     const buttonElem = buttonRef.current
@@ -82,6 +82,7 @@ export default function CounterArgumentMenu ({ editor }) {
   const [fetchingAlertOpen, setFetchingAlertOpen] = useState(false)
   const depGraph = useSelector(state => state.flow.dependencyGraph)
   const nodeMappings = useSelector(state => state.flow.flowEditorNodeMapping)
+  const username = useSelector(state => state.editor.username)
 
   const updateFloatingGroup = useCallback(() => {
     const selection = $getSelection()
@@ -174,6 +175,7 @@ export default function CounterArgumentMenu ({ editor }) {
         method: 'POST',
         mode: 'cors',
         headers: {
+          'X-Username': username,
           Accept: 'application/json',
           'Content-Type': 'application/json',
           'Access-Control-Allow-Origin': '*'
@@ -190,7 +192,7 @@ export default function CounterArgumentMenu ({ editor }) {
           setPage(1)
         })
     })
-  }, [curSelectedNodeKey, nodeMappings])
+  }, [curSelectedNodeKey, nodeMappings, username])
 
   useEffect(() => {
     // console.log(`isElaborate changed: ${isElaborate}`)
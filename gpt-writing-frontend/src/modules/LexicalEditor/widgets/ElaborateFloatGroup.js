@@ -78,6 +78,7 @@ export default function ElaborateFLoatingGroup({ editor }) {
   );
   const promptStatus = useSelector((state) => state.editor.promptStatus);
   const prompts = useSelector((state) => state.editor.prompts);
+  const username = useSelector((state) => state.editor.username);
   const [isElaborate, setElaborate] = useState(false);
   const [isFetchingKeyword, setFetchingKeyword] = useState(false);
   const [promptedText, setPromptedText] = useState("");
@@ -156,6 +157,7 @@ export default function ElaborateFLoatingGroup({ editor }) {
       method: 'POST',
       mode: 'cors',
       headers: {
+        'X-Username': username,
         "Accept": 'application/json',
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*',
@@ -177,7 +179,7 @@ export default function ElaborateFLoatingGroup({ editor }) {
       }).catch(error => {
         console.log("error is ", error)
       });
-  }, [dispatch]);
+  }, [dispatch, username]);
 
   const fetchDiscussionPoints = () => {
     dispatch(setPromptStatus("fetching"));
@@ -188,6 +190,7 @@ export default function ElaborateFLoatingGroup({ editor }) {
       method: "POST",
       mode: "cors",
       headers: {
+        "X-Username": username,
         "Accept": "application/json",
         "Content-Type": "application/json",
         "Access-Control-Allow-Origin": "*",
@@ -80,6 +80,7 @@ export default function SupportingEvidenceMenu ({ editor }) {
   const [fetchingAlertOpen, setFetchingAlertOpen] = useState(false)
   const depGraph = useSelector(state => state.flow.dependencyGraph)
   const nodeMappings = useSelector(state => state.flow.flowEditorNodeMapping)
+  const username = useSelector(state => state.editor.username)
 
   const updateFloatingGroup = useCallback(() => {
     const selection = $getSelection()
@@ -165,6 +166,7 @@ export default function SupportingEvidenceMenu ({ editor }) {
         method: 'POST',
         mode: 'cors',
         headers: {
+          'X-Username': username,
           Accept: 'application/json',
           'Content-Type': 'application/json',
           'Access-Control-Allow-Origin': '*'
@@ -180,7 +182,7 @@ export default function SupportingEvidenceMenu ({ editor }) {
           setPage(1)
         })
     })
-  }, [curSelectedNodeKey, nodeMappings])
+  }, [curSelectedNodeKey, nodeMappings, username])
 
   useEffect(() => {
     // console.log(`isElaborate changed: ${isElaborate}`)
@@ -102,6 +102,7 @@ export default function UpdateModal () {
   const selectedPrompts = useSelector(state => state.editor.selectedPrompts)
   const depGraph = useSelector(state => state.flow.dependencyGraph)
   const nodeMappings = useSelector(state => state.flow.flowEditorNodeMapping)
+  const username = useSelector(state => state.editor.username)
   const [type, setType] = useState('')
   const [newText, setNewText] = useState('')
   const [chips, setChips] = useState([])
@@ -237,6 +238,7 @@ export default function UpdateModal () {
         method: 'POST',
         mode: 'cors',
         headers: {
+          'X-Username': username,
           Accept: 'application/json',
           'Content-Type': 'application/json',
           'Access-Control-Allow-Origin': '*'
@@ -412,6 +414,7 @@ export default function UpdateModal () {
         method: 'POST',
         mode: 'cors',
         headers: {
+          'X-Username': username,
           Accept: 'application/json',
           'Content-Type': 'application/json',
           'Access-Control-Allow-Origin': '*'
@@ -65,6 +65,7 @@ export default function WeaknessFloatGroup ({ editor }) {
   const [showPanel, setShowPanel] = useState(false)
   const itemPerPage = 5
   const weaknesses = useSelector(state => state.editor.weaknesses)
+  const username = useSelector(state => state.editor.username)
   const [page, setPage] = useState(1)
   const [isFectching, setIsFetching] = useState(false)
   const promptStatus = useSelector(state => state.editor.promptStatus)
@@ -133,6 +134,7 @@ export default function WeaknessFloatGroup ({ editor }) {
         method: 'POST',
         mode: 'cors',
         headers: {
+          'X-Username': username,
           Accept: 'application/json',
           'Content-Type': 'application/json',
           'Access-Control-Allow-Origin': '*'